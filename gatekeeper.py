@@ -10,14 +10,23 @@ License: MIT
 """
 
 import os
+import re
+import hmac
+import json
+import sqlite3
+import asyncio
+import bisect
 import logging
-from typing import Optional, Dict, Any
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager, AsyncExitStack
+from typing import Optional, Dict, Any, List, Tuple
 from datetime import datetime
 
-from fastapi import FastAPI, HTTPException, Query, status
-from fastapi.responses import JSONResponse
+import httpx
+from fastapi import FastAPI, Header, HTTPException, Query, status
+from fastapi.responses import JSONResponse, PlainTextResponse
 from pydantic import BaseModel, Field
-import pynetbox
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -40,17 +49,402 @@ app = FastAPI(
 # Configuration
 NETBOX_URL = os.getenv("NETBOX_URL")
 NETBOX_TOKEN = os.getenv("NETBOX_TOKEN")
+NETBOX_VERIFY_SSL = os.getenv("NETBOX_VERIFY_SSL", "true").lower() not in ("0", "false", "no")
+# NetBox HTTP client: pooled keep-alive connections, bounded in-flight
+# requests and a per-request timeout (seconds)
+NETBOX_MAX_CONNECTIONS = int(os.getenv("NETBOX_MAX_CONNECTIONS", "20"))
+NETBOX_TIMEOUT_SECONDS = float(os.getenv("NETBOX_TIMEOUT_SECONDS", "10"))
+NETBOX_PAGE_SIZE = 1000
+# Max values per multi-value filter (keeps query strings short)
+NETBOX_FILTER_CHUNK = 100
+# Max MACs accepted by one batch port request
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "500"))
 DEFAULT_START_PORT = 10001
 CUSTOM_FIELD_NAME = "automation_proxy_port"
+MAC_CUSTOM_FIELD_NAME = "mac_address"
+# Port index refresh intervals (seconds). Incremental refreshes only pull
+# devices changed since the last sync; full reloads catch deletions.
+PORT_INDEX_REFRESH_SECONDS = int(os.getenv("PORT_INDEX_REFRESH_SECONDS", "30"))
+PORT_INDEX_RELOAD_SECONDS = int(os.getenv("PORT_INDEX_RELOAD_SECONDS", "3600"))
+# MAC lookup cache: hits live MAC_CACHE_TTL_SECONDS, misses MAC_CACHE_NEGATIVE_TTL_SECONDS
+MAC_CACHE_SIZE = int(os.getenv("MAC_CACHE_SIZE", "4096"))
+MAC_CACHE_TTL_SECONDS = int(os.getenv("MAC_CACHE_TTL_SECONDS", "300"))
+MAC_CACHE_NEGATIVE_TTL_SECONDS = int(os.getenv("MAC_CACHE_NEGATIVE_TTL_SECONDS", "30"))
 
+# Tunnel parameters returned by /provision/register. PROXY_HOST_KEYS_FILE
+# holds the proxy's SSH host public keys (ssh_host_*.pub or ssh-keyscan
+# output) so probes can pin them.
+PROXY_HOST = os.getenv("PROXY_HOST")
+PROXY_USER = os.getenv("PROXY_USER", "tunnelmgr")
+PROXY_SSH_PORT = int(os.getenv("PROXY_SSH_PORT", "22"))
+PROXY_HOST_KEYS_FILE = os.getenv("PROXY_HOST_KEYS_FILE", "/etc/gatekeeper/proxy_host_keys")
+TUNNEL_SERVER_ALIVE_INTERVAL = int(os.getenv("TUNNEL_SERVER_ALIVE_INTERVAL", "30"))
+TUNNEL_SERVER_ALIVE_COUNT_MAX = int(os.getenv("TUNNEL_SERVER_ALIVE_COUNT_MAX", "3"))
+# Registrations are queued (persisted in REGISTRATION_DB) and launched as
+# jobs of the register_probe template (extra vars must be prompted on
+# launch). Probes authenticate with the shared REGISTRATION_KEY, by
+# default the AWX host config key the callback uses.
+AWX_API_URL = os.getenv("AWX_API_URL")
+AWX_OAUTH_TOKEN = os.getenv("AWX_OAUTH_TOKEN")
+AWX_REGISTER_TEMPLATE_ID = os.getenv("AWX_REGISTER_TEMPLATE_ID")
+AWX_VERIFY_SSL = os.getenv("AWX_VERIFY_SSL", "true").lower() not in ("0", "false", "no")
+REGISTRATION_KEY = os.getenv("REGISTRATION_KEY") or os.getenv("AWX_HOST_CONFIG_KEY")
+REGISTRATION_DB = os.getenv("REGISTRATION_DB", "/var/lib/gatekeeper/registrations.db")
+REGISTRATION_WORKERS = int(os.getenv("REGISTRATION_WORKERS", "4"))
+# With the 60s backoff cap, 10 attempts ride out about 5 minutes of AWX outage
+REGISTRATION_ATTEMPTS = int(os.getenv("REGISTRATION_ATTEMPTS", "10"))
 
-# Initialize NetBox connection
-try:
-    nb = pynetbox.api(NETBOX_URL, NETBOX_TOKEN)
-    logger.info(f"Connected to NetBox at {NETBOX_URL}")
-except Exception as e:
-    logger.error(f"Failed to connect to NetBox: {e}")
-    nb = None
+# Ensure URL has a scheme
+if NETBOX_URL and not NETBOX_URL.startswith("http"):
+    NETBOX_URL = f"https://{NETBOX_URL}"
+
+
+class Metrics:
+    """
+    Minimal in-process Prometheus-style metrics registry.
+
+    Counters and fixed-bucket histograms keyed by metric name and label
+    values, rendered in the Prometheus text exposition format. Recording
+    is a dict update plus a bisect over the buckets, cheap enough to leave
+    on in production.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self._help: Dict[str, tuple] = {}
+        self._counters: Dict[str, Dict[tuple, float]] = {}
+        self._histograms: Dict[str, Dict[tuple, list]] = {}
+
+    def counter(self, name: str, help_text: str) -> None:
+        self._help[name] = ("counter", help_text)
+        self._counters.setdefault(name, {})
+
+    def histogram(self, name: str, help_text: str) -> None:
+        self._help[name] = ("histogram", help_text)
+        self._histograms.setdefault(name, {})
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        """
+        Increment a counter.
+        """
+        key = tuple(sorted(labels.items()))
+        series = self._counters[name]
+        series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        """
+        Record one observation in a histogram.
+        """
+        key = tuple(sorted(labels.items()))
+        series = self._histograms[name]
+        state = series.get(key)
+        if state is None:
+            # [bucket counts..., +Inf count, sum]
+            state = series[key] = [0] * (len(self.BUCKETS) + 1) + [0.0]
+        state[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        state[-1] += seconds
+
+    @contextmanager
+    def time(self, name: str, **labels):
+        """
+        Time a block into a histogram.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @staticmethod
+    def _labels(key: tuple, extra: str = "") -> str:
+        parts = [f'{k}="{v}"' for k, v in key]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self, gauges: Optional[Dict[str, tuple]] = None) -> str:
+        """
+        Render all metrics in Prometheus text format.
+
+        Args:
+            gauges: Extra point-in-time values, name -> (help, value)
+
+        Returns:
+            Exposition text
+        """
+        lines = []
+        for name, (kind, help_text) in self._help.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                for key, value in self._counters[name].items():
+                    lines.append(f"{name}{self._labels(key)} {value}")
+                continue
+            for key, state in self._histograms[name].items():
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS, state):
+                    cumulative += count
+                    le = self._labels(key, 'le="%s"' % bound)
+                    lines.append(f"{name}_bucket{le} {cumulative}")
+                cumulative += state[len(self.BUCKETS)]
+                le = self._labels(key, 'le="+Inf"')
+                lines.append(f"{name}_bucket{le} {cumulative}")
+                lines.append(f"{name}_sum{self._labels(key)} {state[-1]}")
+                lines.append(f"{name}_count{self._labels(key)} {cumulative}")
+        for name, (help_text, value) in (gauges or {}).items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+def stage_timer(stage: str):
+    """
+    Time an internal stage into gatekeeper_stage_duration_seconds.
+    """
+    return metrics.time("gatekeeper_stage_duration_seconds", stage=stage)
+
+
+metrics.counter("gatekeeper_http_requests_total", "HTTP requests by handler, method and status")
+metrics.histogram("gatekeeper_http_request_duration_seconds", "HTTP request latency by handler")
+metrics.histogram("gatekeeper_stage_duration_seconds", "Internal stage latency")
+metrics.counter("gatekeeper_netbox_requests_total", "NetBox API calls by method, endpoint and status")
+metrics.histogram("gatekeeper_netbox_request_duration_seconds", "NetBox API call latency")
+metrics.counter("gatekeeper_mac_lookups_total", "Uncached MAC lookups by resolving tier")
+metrics.counter("gatekeeper_mac_cache_requests_total", "MAC cache lookups by result")
+metrics.counter("gatekeeper_port_index_requests_total", "Port index MAC lookups by result")
+metrics.counter("gatekeeper_registrations_total", "Queued probe registrations by result")
+
+NETBOX_ID_SEGMENT_RE = re.compile(r'/\d+/')
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording request counts and latency per route.
+
+    Requests are labelled with the route template (e.g.
+    ``/provision/request-port``), never the raw URL, to keep label
+    cardinality bounded.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            handler = getattr(scope.get("route"), "path", "<unmatched>")
+            metrics.observe("gatekeeper_http_request_duration_seconds",
+                            time.perf_counter() - start, handler=handler)
+            metrics.inc("gatekeeper_http_requests_total",
+                        handler=handler, method=scope["method"], status=str(status_code))
+
+
+app.add_middleware(MetricsMiddleware)
+
+
+
+class NetBoxClient:
+    """
+    Async NetBox REST client on a pooled httpx connection.
+
+    Keeps connections alive between requests, caps the number of
+    concurrent NetBox calls and applies a per-request timeout, so slow
+    NetBox responses never block the event loop.
+    """
+
+    def __init__(self, url: str, token: Optional[str],
+                 max_connections: int = NETBOX_MAX_CONNECTIONS,
+                 timeout: float = NETBOX_TIMEOUT_SECONDS,
+                 verify: bool = NETBOX_VERIFY_SSL,
+                 transport: Optional[httpx.AsyncBaseTransport] = None):
+        self.url = url.rstrip('/')
+        self.token = token
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.verify = verify
+        self.transport = transport
+        self._client: Optional[httpx.AsyncClient] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    async def start(self) -> None:
+        """
+        Open the connection pool (must run inside the event loop).
+        """
+        if self._client is not None:
+            return
+        headers = {"Accept": "application/json"}
+        if self.token:
+            headers["Authorization"] = f"Token {self.token}"
+        self._client = httpx.AsyncClient(
+            base_url=f"{self.url}/api/",
+            headers=headers,
+            timeout=httpx.Timeout(self.timeout),
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_connections,
+            ),
+            verify=self.verify,
+            transport=self.transport,
+        )
+        self._semaphore = asyncio.Semaphore(self.max_connections)
+
+    async def close(self) -> None:
+        """
+        Close the connection pool.
+        """
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def request(self, method: str, path: str, params: Optional[Dict[str, Any]] = None,
+                      json: Any = None) -> Any:
+        """
+        Send one NetBox API request.
+
+        Args:
+            method: HTTP method
+            path: API path relative to /api/ (e.g. "dcim/devices/")
+            params: Query parameters (list values are repeated)
+            json: JSON request body
+
+        Returns:
+            Decoded JSON response (None for empty bodies)
+
+        Raises:
+            httpx.HTTPStatusError: On non-2xx responses
+            httpx.TransportError: On connection errors and timeouts
+        """
+        if self._client is None:
+            await self.start()
+        endpoint = NETBOX_ID_SEGMENT_RE.sub('/{id}/', path)
+        result = "error"
+        async with self._semaphore:
+            start = time.perf_counter()
+            try:
+                response = await self._client.request(method, path, params=params, json=json)
+                result = str(response.status_code)
+            finally:
+                metrics.observe("gatekeeper_netbox_request_duration_seconds",
+                                time.perf_counter() - start, method=method, endpoint=endpoint)
+                metrics.inc("gatekeeper_netbox_requests_total",
+                            method=method, endpoint=endpoint, status=result)
+        response.raise_for_status()
+        if not response.content:
+            return None
+        return response.json()
+
+    async def list(self, path: str, **filters) -> List[Dict[str, Any]]:
+        """
+        Fetch every object matching the filters.
+
+        The first page reports the total count; remaining pages are then
+        fetched concurrently.
+
+        Args:
+            path: API list path
+            **filters: NetBox filter parameters
+
+        Returns:
+            List of objects
+        """
+        params = dict(filters, limit=NETBOX_PAGE_SIZE, offset=0)
+        first = await self.request("GET", path, params=params)
+        results = list(first.get("results", []))
+        count = first.get("count", len(results))
+        if count > len(results):
+            pages = await asyncio.gather(*[
+                self.request("GET", path, params=dict(params, offset=offset))
+                for offset in range(NETBOX_PAGE_SIZE, count, NETBOX_PAGE_SIZE)
+            ])
+            for page in pages:
+                results.extend(page.get("results", []))
+        return results
+
+    async def list_in(self, path: str, field: str, values: List[Any],
+                      **filters) -> List[Dict[str, Any]]:
+        """
+        Fetch every object whose field matches any of the values.
+
+        Values are sent as a repeated multi-value filter, chunked to
+        NETBOX_FILTER_CHUNK per request, with chunks fetched concurrently.
+
+        Args:
+            path: API list path
+            field: Filter name (e.g. "mac_address", "id")
+            values: Values to match
+            **filters: Additional NetBox filter parameters
+
+        Returns:
+            List of objects
+        """
+        values = list(values)
+        if not values:
+            return []
+        chunks = await asyncio.gather(*[
+            self.list(path, **dict(filters, **{field: values[i:i + NETBOX_FILTER_CHUNK]}))
+            for i in range(0, len(values), NETBOX_FILTER_CHUNK)
+        ])
+        return [obj for chunk in chunks for obj in chunk]
+
+    async def get(self, path: str, object_id: int) -> Optional[Dict[str, Any]]:
+        """
+        Fetch one object by ID.
+
+        Returns:
+            Object, or None if it does not exist
+        """
+        try:
+            return await self.request("GET", f"{path}{object_id}/")
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 404:
+                return None
+            raise
+
+    async def create(self, path: str, data: Any) -> Any:
+        """
+        Create one object (dict) or several in one bulk request (list).
+        """
+        return await self.request("POST", path, json=data)
+
+    async def update(self, path: str, object_id: int, data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Partially update one object.
+        """
+        return await self.request("PATCH", f"{path}{object_id}/", json=data)
+
+    async def bulk_update(self, path: str, data: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Partially update several objects in one request (each item carries its "id").
+        """
+        return await self.request("PATCH", path, json=data)
+
+
+# NetBox connection (opened on startup)
+if NETBOX_URL:
+    netbox = NetBoxClient(NETBOX_URL, NETBOX_TOKEN)
+    logger.info(f"Using NetBox at {NETBOX_URL}")
+else:
+    logger.error("NETBOX_URL not configured")
+    netbox = None
 
 
 # Response models
@@ -62,6 +456,55 @@ class PortResponse(BaseModel):
     timestamp: str = Field(..., description="Response timestamp")
 
 
+class PortBatchRequest(BaseModel):
+    macs: List[str] = Field(..., description="Probe MAC addresses (eth0)")
+
+
+class PortBatchResponse(BaseModel):
+    results: List[PortResponse] = Field(..., description="Port assignments, in request order")
+    errors: Dict[str, str] = Field(default_factory=dict, description="Rejected MACs and reasons")
+    timestamp: str = Field(..., description="Response timestamp")
+
+
+class RegisterRequest(BaseModel):
+    mac: str = Field(..., description="Probe MAC address (eth0)")
+    tenant_name: str = Field(..., description="Tenant display name")
+    tenant_slug: str = Field(..., description="Tenant slug")
+    site_name: str = Field(..., description="Site display name")
+    site_slug: str = Field(..., description="Site slug")
+    public_key: str = Field(..., description="Probe SSH public key (OpenSSH format)")
+    hostname: Optional[str] = Field(None, description="Probe hostname")
+
+
+class TunnelParameters(BaseModel):
+    proxy_host: Optional[str] = Field(None, description="Proxy SSH host")
+    proxy_user: str = Field(..., description="Proxy SSH user")
+    proxy_ssh_port: int = Field(..., description="Proxy SSH port")
+    remote_port: int = Field(..., description="Reverse-forward listen port on the proxy")
+    local_port: int = Field(22, description="Probe port forwarded to")
+    server_alive_interval: int = Field(..., description="ServerAliveInterval (seconds)")
+    server_alive_count_max: int = Field(..., description="ServerAliveCountMax")
+
+
+class RegisterResponse(BaseModel):
+    mac: str = Field(..., description="Probe MAC address")
+    port: int = Field(..., description="Assigned proxy port")
+    existing: bool = Field(..., description="Whether port was pre-existing")
+    device_name: Optional[str] = Field(None, description="NetBox device name")
+    proxy_host_keys: List[str] = Field(default_factory=list, description="Proxy SSH host keys (type key)")
+    tunnel: TunnelParameters = Field(..., description="Reverse tunnel parameters")
+    registration: str = Field(..., description="queued, updated (already queued) or disabled")
+    timestamp: str = Field(..., description="Response timestamp")
+
+
+class RegistrationStatus(BaseModel):
+    mac: str = Field(..., description="Probe MAC address")
+    status: str = Field(..., description="pending, launched, successful or failed")
+    job: Optional[int] = Field(None, description="AWX job id")
+    error: Optional[str] = Field(None, description="Why the registration failed")
+    updated_at: str = Field(..., description="Last status change")
+
+
 class ErrorResponse(BaseModel):
     error: str = Field(..., description="Error message")
     detail: Optional[str] = Field(None, description="Additional error details")
@@ -89,25 +532,930 @@ def normalize_mac(mac: str) -> str:
     return ':'.join([mac_clean[i:i+2] for i in range(0, 12, 2)])
 
 
-def get_max_assigned_port() -> int:
+PROBE_NAME_RE = re.compile(r'^probe-([0-9a-f]{2}(?:[:\-]?[0-9a-f]{2}){5})$')
+
+
+def mac_from_device_name(name: Optional[str]) -> Optional[str]:
     """
-    Find the maximum assigned automation_proxy_port in NetBox.
+    Extract the MAC address from a probe device name.
+
+    Gatekeeper names pending devices ``probe-<mac without colons>`` while the
+    registration playbook uses ``probe-<mac with colons>``; both are accepted.
+
+    Args:
+        name: NetBox device name
 
     Returns:
-        Maximum port number currently assigned
+        Normalized MAC address, or None if the name is not a probe name
     """
-    if not nb:
-        raise RuntimeError("NetBox connection not available")
+    if not name:
+        return None
+    match = PROBE_NAME_RE.match(name.lower())
+    if not match:
+        return None
+    return normalize_mac(match.group(1))
 
-    try:
-        devices = nb.dcim.devices.all()
-        max_port = DEFAULT_START_PORT - 1
 
+def device_port(device: Dict[str, Any]) -> Optional[int]:
+    """
+    Return the automation_proxy_port of a NetBox device, if set.
+    """
+    port = (device.get('custom_fields') or {}).get(CUSTOM_FIELD_NAME)
+    if port and isinstance(port, int):
+        return port
+    return None
+
+
+def device_mac(device: Dict[str, Any]) -> Optional[str]:
+    """
+    Derive the probe MAC address for a NetBox device record.
+
+    Uses the ``mac_address`` custom field when set, otherwise the
+    ``probe-<mac>`` naming convention.
+
+    Args:
+        device: NetBox device record
+
+    Returns:
+        Normalized MAC address or None
+    """
+    cf_mac = (device.get('custom_fields') or {}).get(MAC_CUSTOM_FIELD_NAME)
+    if cf_mac:
+        try:
+            return normalize_mac(cf_mac)
+        except ValueError:
+            pass
+    return mac_from_device_name(device.get('name'))
+
+
+class PortIndex:
+    """
+    In-process index of automation_proxy_port assignments.
+
+    Loaded once from a single NetBox query filtered on the port custom field,
+    then kept current by incremental refreshes on ``last_updated``. Lookups
+    and allocations are served from memory without NetBox reads.
+
+    The index is only mutated on the event loop; NetBox is read with the
+    async ``fetch_*`` methods and the results applied afterwards.
+    """
+
+    def __init__(self):
+        self.by_mac: Dict[str, int] = {}
+        self.by_port: Dict[int, str] = {}
+        self._device_ports: Dict[int, int] = {}
+        self._port_macs: Dict[int, str] = {}
+        self._added_at: Dict[int, float] = {}
+        self._ports: List[int] = []
+        self.watermark: Optional[str] = None
+        self.loaded_at: Optional[datetime] = None
+
+    @property
+    def loaded(self) -> bool:
+        return self.loaded_at is not None
+
+    def _remove_device(self, device_id: int) -> None:
+        """
+        Drop the port held by a device, if any.
+        """
+        self._added_at.pop(device_id, None)
+        port = self._device_ports.pop(device_id, None)
+        if port is None:
+            return
+        self.by_port.pop(port, None)
+        mac = self._port_macs.pop(port, None)
+        if mac and self.by_mac.get(mac) == port:
+            del self.by_mac[mac]
+        i = bisect.bisect_left(self._ports, port)
+        if i < len(self._ports) and self._ports[i] == port:
+            del self._ports[i]
+
+    def add(self, port: int, device_name: str, device_id: Optional[int] = None,
+            mac: Optional[str] = None) -> None:
+        """
+        Record a port assignment.
+
+        Args:
+            port: Assigned proxy port
+            device_name: NetBox device name holding the port
+            device_id: NetBox device ID (used to track later changes)
+            mac: Normalized probe MAC address, if known
+        """
+        if device_id is not None:
+            self._remove_device(device_id)
+            self._device_ports[device_id] = port
+            self._added_at[device_id] = time.monotonic()
+        if port not in self.by_port:
+            bisect.insort(self._ports, port)
+        self.by_port[port] = device_name
+        if mac:
+            self.by_mac[mac] = port
+            self._port_macs[port] = mac
+
+    def apply(self, device: Dict[str, Any]) -> None:
+        """
+        Apply a NetBox device record to the index.
+
+        Args:
+            device: NetBox device record
+        """
+        port = device_port(device)
+        if port and port >= DEFAULT_START_PORT:
+            self.add(port, device['name'], device['id'], device_mac(device))
+        else:
+            self._remove_device(device['id'])
+
+        last_updated = device.get('last_updated')
+        if last_updated and (self.watermark is None or last_updated > self.watermark):
+            self.watermark = last_updated
+
+    async def fetch_all(self, client: NetBoxClient) -> List[Dict[str, Any]]:
+        """
+        Fetch every device holding a proxy port (single filtered query).
+
+        Args:
+            client: NetBox client
+
+        Returns:
+            List of device records
+        """
+        return await client.list(
+            "dcim/devices/", **{f"cf_{CUSTOM_FIELD_NAME}__gte": DEFAULT_START_PORT}
+        )
+
+    async def fetch_changed(self, client: NetBoxClient) -> List[Dict[str, Any]]:
+        """
+        Fetch devices changed since the last sync.
+
+        Args:
+            client: NetBox client
+
+        Returns:
+            List of device records
+        """
+        return await client.list("dcim/devices/", last_updated__gte=self.watermark)
+
+    def update(self, devices: List[Dict[str, Any]]) -> int:
+        """
+        Apply changed device records to the index.
+
+        Args:
+            devices: Device records from fetch_changed()
+
+        Returns:
+            Number of device records applied
+        """
         for device in devices:
-            port = device.custom_fields.get(CUSTOM_FIELD_NAME)
-            if port and isinstance(port, int):
-                max_port = max(max_port, port)
+            self.apply(device)
+        if devices:
+            logger.debug(f"Port index refreshed: {len(devices)} changed devices")
+        return len(devices)
+
+    def reconcile(self, devices: List[Dict[str, Any]], started: float) -> None:
+        """
+        Replace the index contents with a full device listing.
+
+        Devices missing from the listing are dropped (freeing their ports),
+        except those added locally after the listing was started.
+
+        Args:
+            devices: Device records from fetch_all()
+            started: time.monotonic() value taken before fetch_all() ran
+        """
+        seen = set()
+        for device in devices:
+            self.apply(device)
+            seen.add(device['id'])
+        for device_id in list(self._device_ports):
+            if device_id not in seen and self._added_at.get(device_id, 0) < started:
+                self._remove_device(device_id)
+        self.loaded_at = datetime.utcnow()
+        logger.info(f"Port index loaded: {len(self._ports)} ports, max {self.max_port()}")
+
+    async def load(self, client: NetBoxClient) -> None:
+        """
+        Rebuild the index from NetBox.
+
+        Args:
+            client: NetBox client
+        """
+        started = time.monotonic()
+        self.reconcile(await self.fetch_all(client), started)
+
+    def max_port(self) -> int:
+        """
+        Return the highest assigned port (or the base before the first port).
+        """
+        return self._ports[-1] if self._ports else DEFAULT_START_PORT - 1
+
+    def lowest_free(self, start: int = DEFAULT_START_PORT) -> int:
+        """
+        Return the lowest unassigned port >= start.
+
+        Binary search over the sorted port list: below the first gap,
+        ``ports[j + k] == start + k`` holds, so the gap is found in O(log n).
+
+        Args:
+            start: Lowest acceptable port
+
+        Returns:
+            Lowest free port number
+        """
+        ports = self._ports
+        j = bisect.bisect_left(ports, start)
+        lo, hi = 0, len(ports) - j
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if ports[j + mid] == start + mid:
+                lo = mid + 1
+            else:
+                hi = mid
+        return start + lo
+
+    def __len__(self) -> int:
+        return len(self._ports)
+
+
+class PortAllocator:
+    """
+    Serialized port allocation engine.
+
+    Hands out the lowest free port (reusing gaps left by removed probes)
+    under an asyncio lock and tracks in-flight reservations so concurrent
+    requests never receive the same port. Each candidate is reconciled
+    against NetBox with a single filtered query before it is handed out.
+    """
+
+    def __init__(self, index: PortIndex):
+        self.index = index
+        self._lock: Optional[asyncio.Lock] = None
+        self._reserved: Dict[int, str] = {}
+        self._mac_locks: Dict[str, asyncio.Lock] = {}
+        self._mac_waiters: Dict[str, int] = {}
+
+    @asynccontextmanager
+    async def mac_lock(self, mac: str):
+        """
+        Serialize requests for the same MAC address.
+
+        A probe retrying while its first request is still in flight waits
+        for that request and then finds its port in the index.
+
+        Args:
+            mac: Normalized MAC address
+        """
+        lock = self._mac_locks.setdefault(mac, asyncio.Lock())
+        self._mac_waiters[mac] = self._mac_waiters.get(mac, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._mac_waiters[mac] -= 1
+            if not self._mac_waiters[mac]:
+                del self._mac_waiters[mac]
+                del self._mac_locks[mac]
+
+    async def _reserve(self, mac: str, start: int) -> int:
+        """
+        Reserve the lowest port >= start that is neither assigned nor reserved.
+        """
+        if self._lock is None:
+            # Created lazily so it binds to the running event loop
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            port = self.index.lowest_free(start)
+            while port in self._reserved:
+                port = self.index.lowest_free(port + 1)
+            self._reserved[port] = mac
+            return port
+
+    async def _claimed_in_netbox(self, port: int) -> List[Dict[str, Any]]:
+        """
+        Return NetBox devices already holding a port.
+        """
+        return await netbox.list("dcim/devices/", **{f"cf_{CUSTOM_FIELD_NAME}": port})
+
+    @asynccontextmanager
+    async def allocate(self, mac: str):
+        """
+        Reserve a free port for the duration of the block.
+
+        The caller must record the port in the index (``PortIndex.add``)
+        before leaving the block; the reservation is released on exit, so
+        a failed device create frees the port again.
+
+        Args:
+            mac: Normalized MAC address
+
+        Yields:
+            Reserved port number
+        """
+        start = DEFAULT_START_PORT
+        with stage_timer("allocate_port"):
+            while True:
+                port = await self._reserve(mac, start)
+                try:
+                    claimed = await self._claimed_in_netbox(port)
+                except Exception:
+                    self._reserved.pop(port, None)
+                    raise
+                if not claimed:
+                    break
+                # Assigned outside gatekeeper since the last refresh
+                logger.warning(f"Port {port} already assigned in NetBox, skipping")
+                for device in claimed:
+                    self.index.apply(device)
+                self._reserved.pop(port, None)
+                start = port + 1
+
+        try:
+            yield port
+        finally:
+            self._reserved.pop(port, None)
+
+    @asynccontextmanager
+    async def mac_locks(self, macs: List[str]):
+        """
+        Hold the per-MAC locks for several MAC addresses.
+
+        Locks are taken in sorted order so overlapping batches cannot deadlock.
+
+        Args:
+            macs: Normalized MAC addresses
+        """
+        async with AsyncExitStack() as stack:
+            for mac in sorted(set(macs)):
+                await stack.enter_async_context(self.mac_lock(mac))
+            yield
+
+    @asynccontextmanager
+    async def allocate_many(self, macs: List[str]):
+        """
+        Reserve one free port per MAC in a single allocator pass.
+
+        All candidates are reserved under the lock at once and reconciled
+        against NetBox with one multi-value query; ports found assigned
+        elsewhere are replaced until the set is clean. Same contract as
+        allocate(): record the ports before leaving the block.
+
+        Args:
+            macs: Normalized MAC addresses
+
+        Yields:
+            Dict of MAC -> reserved port
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        ports: Dict[str, int] = {}
+        try:
+            with stage_timer("allocate_ports"):
+                pending = list(macs)
+                while pending:
+                    async with self._lock:
+                        port = DEFAULT_START_PORT
+                        for mac in pending:
+                            port = self.index.lowest_free(port)
+                            while port in self._reserved:
+                                port = self.index.lowest_free(port + 1)
+                            self._reserved[port] = mac
+                            ports[mac] = port
+                    claimed = await netbox.list_in(
+                        "dcim/devices/", f"cf_{CUSTOM_FIELD_NAME}", [ports[mac] for mac in pending]
+                    )
+                    taken = set()
+                    for device in claimed:
+                        logger.warning(f"Port {device_port(device)} already assigned in NetBox, skipping")
+                        self.index.apply(device)
+                        taken.add(device_port(device))
+                    pending = [mac for mac in pending if ports[mac] in taken]
+                    for mac in pending:
+                        self._reserved.pop(ports.pop(mac), None)
+
+            yield ports
+        finally:
+            for port in ports.values():
+                self._reserved.pop(port, None)
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._reserved)
+
+
+class MacCache:
+    """
+    TTL/LRU cache of MAC address lookups.
+
+    Stores both hits (device records) and misses, so repeated requests
+    from a new probe do not walk every fallback tier again. Misses expire
+    sooner than hits; gatekeeper writes invalidate the affected MAC.
+    """
+
+    _MISSING = object()
+
+    def __init__(self, maxsize: int, ttl: float, negative_ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, mac: str):
+        """
+        Look up a cached result.
+
+        Args:
+            mac: Normalized MAC address
+
+        Returns:
+            Cached device (or None for a cached miss), or MacCache._MISSING
+        """
+        entry = self._entries.get(mac)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[mac]
+            self.misses += 1
+            metrics.inc("gatekeeper_mac_cache_requests_total", result="miss")
+            return self._MISSING
+        self._entries.move_to_end(mac)
+        self.hits += 1
+        metrics.inc("gatekeeper_mac_cache_requests_total", result="hit")
+        return entry[1]
+
+    def put(self, mac: str, device: Optional[Dict[str, Any]]) -> None:
+        """
+        Cache a lookup result (None caches a miss).
+
+        Args:
+            mac: Normalized MAC address
+            device: Device record or None
+        """
+        ttl = self.ttl if device is not None else self.negative_ttl
+        self._entries[mac] = (time.monotonic() + ttl, device)
+        self._entries.move_to_end(mac)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, mac: str) -> None:
+        """
+        Drop the cached result for a MAC.
+        """
+        self._entries.pop(mac, None)
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class DeviceNameIndex:
+    """
+    Precomputed index of probe device names (``probe-<mac>``) to device IDs.
+
+    Replaces the linear scan over every device name in the last-resort
+    MAC lookup tier with a dict lookup.
+    """
+
+    def __init__(self):
+        self.by_mac: Dict[str, int] = {}
+        self._device_macs: Dict[int, str] = {}
+        self.loaded_at: Optional[datetime] = None
+
+    @property
+    def loaded(self) -> bool:
+        return self.loaded_at is not None
+
+    def add(self, mac: str, device_id: int) -> None:
+        """
+        Record a probe device name.
+
+        Args:
+            mac: Normalized MAC address
+            device_id: NetBox device ID
+        """
+        self.remove(device_id)
+        self.by_mac[mac] = device_id
+        self._device_macs[device_id] = mac
+
+    def remove(self, device_id: int) -> None:
+        """
+        Forget a device.
+        """
+        mac = self._device_macs.pop(device_id, None)
+        if mac and self.by_mac.get(mac) == device_id:
+            del self.by_mac[mac]
+
+    def apply(self, device: Dict[str, Any]) -> None:
+        """
+        Apply a NetBox device record (renames included).
+
+        Args:
+            device: NetBox device record
+        """
+        mac = mac_from_device_name(device.get('name'))
+        if mac:
+            self.add(mac, device['id'])
+        else:
+            self.remove(device['id'])
+
+    async def fetch_all(self, client: NetBoxClient) -> List[Dict[str, Any]]:
+        """
+        Fetch every probe device.
+
+        Args:
+            client: NetBox client
+
+        Returns:
+            List of device records
+        """
+        return await client.list("dcim/devices/", name__isw="probe-")
+
+    def reconcile(self, devices: List[Dict[str, Any]]) -> None:
+        """
+        Rebuild the index from a full probe device listing.
+
+        Args:
+            devices: Device records from fetch_all()
+        """
+        by_mac: Dict[str, int] = {}
+        device_macs: Dict[int, str] = {}
+        for device in devices:
+            mac = mac_from_device_name(device.get('name'))
+            if mac:
+                by_mac[mac] = device['id']
+                device_macs[device['id']] = mac
+        self.by_mac, self._device_macs = by_mac, device_macs
+        self.loaded_at = datetime.utcnow()
+        logger.info(f"Device name index loaded: {len(by_mac)} probe names")
+
+    def __len__(self) -> int:
+        return len(self.by_mac)
+
+
+PUBLIC_KEY_RE = re.compile(r'^(ssh-[a-z0-9-]+|ecdsa-sha2-[a-z0-9-]+|sk-[a-z0-9@.-]+) [A-Za-z0-9+/]+={0,3}( \S.*)?$')
+
+
+def load_proxy_host_keys(path: str) -> List[str]:
+    """
+    Read the proxy's SSH host public keys as "type key" strings.
+
+    Accepts ssh_host_*.pub lines ("type key comment") and ssh-keyscan /
+    known_hosts lines ("host type key").
+    """
+    keys = []
+    try:
+        with open(path) as f:
+            for line in f:
+                parts = line.split()
+                if not parts or parts[0].startswith('#'):
+                    continue
+                if not PUBLIC_KEY_RE.match(' '.join(parts[:2])) and len(parts) >= 3:
+                    parts = parts[1:]
+                if PUBLIC_KEY_RE.match(' '.join(parts[:2])):
+                    keys.append(' '.join(parts[:2]))
+    except FileNotFoundError:
+        logger.warning(f"Proxy host keys file {path} not found; probes cannot pin the host key")
+    return keys
+
+
+class RegistrationStore:
+    """
+    SQLite record of every registration and where it stands.
+
+    Pending registrations survive a restart (the queue replays them on
+    start); launched, successful and failed ones remain queryable, so
+    a probe can confirm its job before it stops falling back to the AWX
+    callback.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS registrations (
+        mac TEXT PRIMARY KEY,
+        extra_vars TEXT NOT NULL,
+        status TEXT NOT NULL,
+        job INTEGER,
+        error TEXT,
+        updated_at TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS registrations_status ON registrations (status);
+    """
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory and path != ":memory:":
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(self.SCHEMA)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def save(self, mac: str, extra_vars: Dict[str, Any]) -> None:
+        """
+        Record a (re)queued registration as pending.
+        """
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO registrations (mac, extra_vars, status, updated_at) "
+                "VALUES (?, ?, 'pending', ?)",
+                (mac, json.dumps(extra_vars), datetime.utcnow().isoformat()))
+
+    def update(self, mac: str, status: str, job: Optional[int] = None,
+               error: Optional[str] = None) -> None:
+        with self.conn:
+            self.conn.execute(
+                "UPDATE registrations SET status = ?, job = COALESCE(?, job), error = ?, "
+                "updated_at = ? WHERE mac = ?",
+                (status, job, error, datetime.utcnow().isoformat(), mac))
+
+    def get(self, mac: str) -> Optional[Dict[str, Any]]:
+        row = self.conn.execute("SELECT * FROM registrations WHERE mac = ?", (mac,)).fetchone()
+        return dict(row) if row else None
+
+    def pending(self) -> List[Dict[str, Any]]:
+        """
+        Registrations not launched yet, oldest first.
+        """
+        return [dict(row, extra_vars=json.loads(row["extra_vars"])) for row in self.conn.execute(
+            "SELECT * FROM registrations WHERE status = 'pending' ORDER BY updated_at")]
+
+
+# AWX job states that end a job; everything else is still running
+AWX_JOB_FAILED = ("failed", "error", "canceled")
+
+
+def copy_result(source: asyncio.Future, target: asyncio.Future) -> None:
+    """
+    Settle target like the finished source future.
+    """
+    if target.done():
+        return
+    if source.cancelled():
+        target.cancel()
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+class RegistrationQueue:
+    """
+    Coalescing queue of probe registrations, launched as AWX jobs.
+
+    Registration requests return as soon as the registration is queued;
+    background workers launch the register_probe job template. A MAC
+    queued again before its job launched only replaces the pending
+    payload (one job per MAC). Failed launches are retried with
+    exponential backoff.
+
+    Each pending registration carries a future that resolves to the AWX
+    job id, or fails with the error once the launch is given up. A
+    worker survives any error in a launch and moves on to the next MAC.
+
+    Every state change is written to the store: pending registrations
+    are replayed on start, and status() reports where a MAC's
+    registration stands (following a launched job in AWX until it ends).
+    """
+
+    def __init__(self, launch_url: str, token: Optional[str], workers: int = REGISTRATION_WORKERS,
+                 attempts: int = REGISTRATION_ATTEMPTS, verify: bool = AWX_VERIFY_SSL,
+                 transport: Optional[httpx.AsyncBaseTransport] = None,
+                 store: Optional[RegistrationStore] = None, jobs_url: Optional[str] = None):
+        self.launch_url = launch_url
+        self.jobs_url = jobs_url
+        self.store = store or RegistrationStore(":memory:")
+        self.token = token
+        self.workers = workers
+        self.attempts = attempts
+        self.verify = verify
+        self.transport = transport
+        self.pending: Dict[str, Dict[str, Any]] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self._tasks: List[asyncio.Task] = []
+        self._retries: set = set()
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    async def start(self) -> None:
+        """
+        Open the AWX client and start the workers (inside the event loop).
+        """
+        headers = {"Content-Type": "application/json"}
+        if self.token:
+            headers["Authorization"] = f"Bearer {self.token}"
+        self._client = httpx.AsyncClient(headers=headers, timeout=httpx.Timeout(30),
+                                         verify=self.verify, transport=self.transport)
+        self._queue = asyncio.Queue()
+        for row in self.store.pending():
+            self.pending[row["mac"]] = self._entry(row["extra_vars"])
+            self._queue.put_nowait(row["mac"])
+        if self.pending:
+            logger.info(f"Replaying {len(self.pending)} pending registrations")
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    @staticmethod
+    def _entry(extra_vars: Dict[str, Any], future: Optional[asyncio.Future] = None) -> Dict[str, Any]:
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            # Nobody has to wait for the result; keep failures quiet
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        return {"extra_vars": extra_vars, "attempt": 0, "future": future, "launching": False}
+
+    async def close(self) -> None:
+        for task in self._tasks + list(self._retries):
+            task.cancel()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def submit(self, mac: str, extra_vars: Dict[str, Any]) -> Tuple[str, asyncio.Future]:
+        """
+        Queue a registration.
+
+        Returns:
+            Tuple of ("queued", or "updated" if the MAC was already
+            waiting) and a future for the AWX job id
+        """
+        previous = self.pending.get(mac)
+        updated = previous is not None
+        # Not launched yet: the new payload goes out in the same job
+        shared = previous["future"] if updated and not previous["launching"] else None
+        entry = self._entry(extra_vars, shared)
+        self.store.save(mac, extra_vars)
+        self.pending[mac] = entry
+        if not updated:
+            self._queue.put_nowait(mac)
+        metrics.inc("gatekeeper_registrations_total", result="updated" if updated else "queued")
+        return ("updated" if updated else "queued"), entry["future"]
+
+    async def status(self, mac: str) -> Optional[Dict[str, Any]]:
+        """
+        Where a MAC's registration stands, or None if it was never queued.
+
+        A launched job is looked up in AWX; once it ended, the outcome
+        (successful or failed) is stored.
+        """
+        row = self.store.get(mac)
+        if row is None:
+            return None
+        if row["status"] == "launched" and row["job"] and self.jobs_url:
+            try:
+                response = await self._client.get(f"{self.jobs_url}{row['job']}/")
+                response.raise_for_status()
+                job_status = response.json().get("status")
+            except (httpx.HTTPError, ValueError, AttributeError) as e:
+                logger.warning(f"Could not fetch AWX job {row['job']} for {mac}: {e}")
+                job_status = None
+            if job_status == "successful":
+                self.store.update(mac, "successful")
+            elif job_status in AWX_JOB_FAILED:
+                self.store.update(mac, "failed", error=f"AWX job {row['job']} {job_status}")
+            row = self.store.get(mac)
+        row.pop("extra_vars", None)
+        return row
+
+    def _finish(self, mac: str, entry: Dict[str, Any], job: Any = None,
+                error: Optional[BaseException] = None) -> None:
+        """
+        Resolve a registration's future and drop it from pending; a newer
+        payload queued during the launch stays pending and is re-queued.
+        """
+        if self.pending.get(mac) is entry:
+            del self.pending[mac]
+            if error is not None:
+                self.store.update(mac, "failed", error=str(error) or type(error).__name__)
+            else:
+                self.store.update(mac, "launched", job=job if isinstance(job, int) else None)
+        elif mac in self.pending:
+            self._queue.put_nowait(mac)
+        future = entry["future"]
+        if not future.done():
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(job)
 
+    async def _retry_later(self, mac: str, delay: float) -> None:
+        await asyncio.sleep(delay)
+        self._queue.put_nowait(mac)
+
+    async def _worker(self) -> None:
+        while True:
+            mac = await self._queue.get()
+            entry = self.pending.get(mac)
+            if entry is None:
+                continue
+            try:
+                await self._launch(mac, entry)
+            except Exception as e:
+                # Never let one bad launch end the worker
+                logger.exception(f"Registration of {mac} failed: {e}")
+                metrics.inc("gatekeeper_registrations_total", result="failed")
+                self._finish(mac, entry, error=e)
+
+    async def _launch(self, mac: str, entry: Dict[str, Any]) -> None:
+        """
+        Launch the job for one registration, scheduling a retry on failure.
+        """
+        entry["launching"] = True
+        try:
+            with stage_timer("awx.launch"):
+                response = await self._client.post(self.launch_url,
+                                                   json={"extra_vars": entry["extra_vars"]})
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            entry["attempt"] += 1
+            if entry["attempt"] >= self.attempts:
+                logger.error(f"Registration of {mac} failed after {entry['attempt']} attempts: {e}")
+                metrics.inc("gatekeeper_registrations_total", result="failed")
+                self._finish(mac, entry, error=e)
+                return
+            newer = self.pending.get(mac)
+            if newer is not entry:
+                # Superseded during the launch: the newer payload goes
+                # out right away and settles this one's future too
+                newer["future"].add_done_callback(lambda f: copy_result(f, entry["future"]))
+                self._queue.put_nowait(mac)
+                return
+            entry["launching"] = False
+            delay = min(60, 2 ** entry["attempt"])
+            logger.warning(f"Registration launch for {mac} failed ({e}), retrying in {delay}s")
+            retry = asyncio.create_task(self._retry_later(mac, delay))
+            self._retries.add(retry)
+            retry.add_done_callback(self._retries.discard)
+            return
+
+        job = None
+        try:
+            body = response.json() if response.content else None
+            if isinstance(body, dict):
+                job = body.get("job")
+        except ValueError:
+            logger.warning(f"AWX returned a non-JSON launch response for {mac}")
+        self._finish(mac, entry, job=job)
+        logger.info(f"Registration job {job} launched for {mac}")
+        metrics.inc("gatekeeper_registrations_total", result="launched")
+
+
+port_index = PortIndex()
+allocator = PortAllocator(port_index)
+mac_cache = MacCache(MAC_CACHE_SIZE, MAC_CACHE_TTL_SECONDS, MAC_CACHE_NEGATIVE_TTL_SECONDS)
+name_index = DeviceNameIndex()
+proxy_host_keys = load_proxy_host_keys(PROXY_HOST_KEYS_FILE)
+if AWX_API_URL and AWX_REGISTER_TEMPLATE_ID and REGISTRATION_KEY:
+    # Accept AWX_API_URL with or without the /api/v2 suffix
+    awx_base = re.sub(r'/api/v2/?$', '', AWX_API_URL.rstrip('/'))
+    registrations: Optional[RegistrationQueue] = RegistrationQueue(
+        f"{awx_base}/api/v2/job_templates/{AWX_REGISTER_TEMPLATE_ID}/launch/",
+        AWX_OAUTH_TOKEN,
+        store=RegistrationStore(REGISTRATION_DB),
+        jobs_url=f"{awx_base}/api/v2/jobs/",
+    )
+else:
+    if AWX_API_URL and AWX_REGISTER_TEMPLATE_ID:
+        logger.warning("REGISTRATION_KEY (or AWX_HOST_CONFIG_KEY) not set; queued registration disabled")
+    registrations = None
+
+
+def check_registration_key(key: Optional[str]) -> None:
+    """
+    Reject requests without the shared registration key.
+
+    Raises:
+        HTTPException: 403 if the key is missing or wrong
+    """
+    if not key or not REGISTRATION_KEY or not hmac.compare_digest(key.encode(), REGISTRATION_KEY.encode()):
+        metrics.inc("gatekeeper_registrations_total", result="forbidden")
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Invalid or missing host config key"
+        )
+
+
+async def get_max_assigned_port() -> int:
+    """
+    Find the maximum assigned automation_proxy_port.
+
+    Served from the in-memory port index; NetBox is only queried if the
+    index has not been loaded yet.
+
+    Returns:
+        Maximum port number currently assigned
+    """
+    if not netbox:
+        raise RuntimeError("NetBox connection not available")
+
+    try:
+        with stage_timer("get_max_assigned_port"):
+            if not port_index.loaded:
+                await port_index.load(netbox)
+            max_port = port_index.max_port()
         logger.info(f"Current max assigned port: {max_port}")
         return max_port
     except Exception as e:
@@ -115,10 +1463,73 @@ def get_max_assigned_port() -> int:
         raise
 
 
-def find_device_by_mac(mac: str) -> Optional[Dict[str, Any]]:
+async def refresh_indexes(full: bool = False) -> None:
+    """
+    Refresh the port and device name indexes.
+
+    Args:
+        full: Reload every port-holding and probe device instead of the
+              changes since the last sync
+    """
+    full = full or not port_index.loaded or port_index.watermark is None
+    stage = "index_reload" if full else "index_refresh"
+    with stage_timer(stage):
+        if full:
+            started = time.monotonic()
+            devices, probes = await asyncio.gather(
+                port_index.fetch_all(netbox), name_index.fetch_all(netbox)
+            )
+            port_index.reconcile(devices, started)
+            name_index.reconcile(probes)
+        else:
+            devices = await port_index.fetch_changed(netbox)
+            port_index.update(devices)
+            for device in devices:
+                name_index.apply(device)
+
+
+async def port_index_refresher() -> None:
+    """
+    Keep the port and name indexes current in the background.
+
+    Runs an incremental refresh every PORT_INDEX_REFRESH_SECONDS and a full
+    reload every PORT_INDEX_RELOAD_SECONDS (to drop deleted devices).
+    """
+    while True:
+        await asyncio.sleep(PORT_INDEX_REFRESH_SECONDS)
+        try:
+            age = (datetime.utcnow() - port_index.loaded_at).total_seconds() \
+                if port_index.loaded else None
+            await refresh_indexes(full=age is None or age >= PORT_INDEX_RELOAD_SECONDS)
+        except Exception as e:
+            logger.warning(f"Port index refresh failed: {e}")
+
+
+async def find_device_by_mac(mac: str) -> Optional[Dict[str, Any]]:
     """
     Find a NetBox device by MAC address.
 
+    Results (including misses) are cached per MAC; see MacCache.
+
+    Args:
+        mac: Normalized MAC address
+
+    Returns:
+        Device object or None if not found
+    """
+    cached = mac_cache.get(mac)
+    if cached is not MacCache._MISSING:
+        return cached
+
+    device = await lookup_device_by_mac(mac)
+    mac_cache.put(mac, device)
+    return device
+
+
+async def lookup_device_by_mac(mac: str) -> Optional[Dict[str, Any]]:
+    """
+    Look up a NetBox device by MAC address, bypassing the cache.
+
     Supports NetBox 4.0+ where MAC addresses are separate objects,
     as well as older versions where MAC is a field on interfaces.
 
@@ -128,55 +1539,366 @@ def find_device_by_mac(mac: str) -> Optional[Dict[str, Any]]:
     Returns:
         Device object or None if not found
     """
-    if not nb:
+    if not netbox:
         raise RuntimeError("NetBox connection not available")
 
     try:
         # NetBox 4.0+: MAC addresses are separate objects in dcim.mac-addresses
         # Query the MAC address object directly
         try:
-            mac_addresses = nb.dcim.mac_addresses.filter(mac_address=mac)
-            for mac_obj in mac_addresses:
-                # MAC address objects link to interfaces via assigned_object
-                if hasattr(mac_obj, 'assigned_object') and mac_obj.assigned_object:
-                    interface = mac_obj.assigned_object
-                    if hasattr(interface, 'device') and interface.device:
-                        logger.info(f"Found device via MAC address object: {interface.device.name}")
-                        return nb.dcim.devices.get(interface.device.id)
-        except AttributeError:
-            # nb.dcim.mac_addresses doesn't exist - older NetBox version
+            with stage_timer("find_device_by_mac.mac_object"):
+                mac_addresses = await netbox.list("dcim/mac-addresses/", mac_address=mac)
+                for mac_obj in mac_addresses:
+                    # MAC address objects link to interfaces via assigned_object
+                    interface = mac_obj.get('assigned_object')
+                    if interface and interface.get('device'):
+                        logger.info(f"Found device via MAC address object: {interface['device']['name']}")
+                        metrics.inc("gatekeeper_mac_lookups_total", tier="mac_object")
+                        return await netbox.get("dcim/devices/", interface['device']['id'])
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != 404:
+                raise
+            # /dcim/mac-addresses/ doesn't exist - older NetBox version
             logger.debug("MAC address objects not available, trying legacy lookup")
 
         # Legacy/fallback: Search interfaces by mac_address field (pre-4.0)
         try:
-            interfaces = nb.dcim.interfaces.filter(mac_address=mac)
-            for interface in interfaces:
-                if interface.device:
-                    logger.info(f"Found device via interface MAC field: {interface.device.name}")
-                    return nb.dcim.devices.get(interface.device.id)
+            with stage_timer("find_device_by_mac.interface"):
+                interfaces = await netbox.list("dcim/interfaces/", mac_address=mac)
+                for interface in interfaces:
+                    if interface.get('device'):
+                        logger.info(f"Found device via interface MAC field: {interface['device']['name']}")
+                        metrics.inc("gatekeeper_mac_lookups_total", tier="interface")
+                        return await netbox.get("dcim/devices/", interface['device']['id'])
         except Exception as e:
             logger.debug(f"Interface MAC lookup failed: {e}")
 
         # Fallback: Check custom field mac_address on devices
-        devices = nb.dcim.devices.filter(cf_mac_address=mac)
+        with stage_timer("find_device_by_mac.custom_field"):
+            devices = await netbox.list("dcim/devices/", **{f"cf_{MAC_CUSTOM_FIELD_NAME}": mac})
         for device in devices:
-            logger.info(f"Found device via custom field: {device.name}")
+            logger.info(f"Found device via custom field: {device['name']}")
+            metrics.inc("gatekeeper_mac_lookups_total", tier="custom_field")
             return device
 
-        # Last resort: Check if device name contains MAC (naming convention)
+        # Last resort: probe-<mac> naming convention
         mac_clean = mac.replace(':', '')
-        devices = nb.dcim.devices.all()
-        for device in devices:
-            if mac_clean in device.name.lower().replace(':', '').replace('-', ''):
-                logger.info(f"Found device via name matching: {device.name}")
-                return device
+        with stage_timer("find_device_by_mac.name"):
+            if name_index.loaded:
+                device_id = name_index.by_mac.get(mac)
+                device = await netbox.get("dcim/devices/", device_id) if device_id is not None else None
+            else:
+                devices = await netbox.list(
+                    "dcim/devices/", name=[f"probe-{mac_clean}", f"probe-{mac}"]
+                )
+                device = devices[0] if devices else None
+        if device:
+            logger.info(f"Found device via name matching: {device['name']}")
+            metrics.inc("gatekeeper_mac_lookups_total", tier="name")
+            return device
 
+        metrics.inc("gatekeeper_mac_lookups_total", tier="none")
         return None
     except Exception as e:
         logger.error(f"Error searching for device by MAC {mac}: {e}")
         raise
 
 
+async def find_devices_by_macs(macs: List[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    Find NetBox devices for several MAC addresses at once.
+
+    Walks the same tiers as lookup_device_by_mac, but each tier is one
+    multi-value query for all still-unresolved MACs, and the matched
+    devices are fetched with a single ID-filtered query.
+
+    Args:
+        macs: Normalized MAC addresses
+
+    Returns:
+        Dict of MAC -> device for the MACs that were found
+    """
+    found: Dict[str, Dict[str, Any]] = {}
+    device_ids: Dict[str, int] = {}
+    pending = []
+    for mac in macs:
+        cached = mac_cache.get(mac)
+        if cached is MacCache._MISSING:
+            pending.append(mac)
+        elif cached is not None:
+            found[mac] = cached
+    looked_up = list(pending)
+
+    def resolved(mac: str) -> bool:
+        return mac in found or mac in device_ids
+
+    # NetBox 4.0+: MAC address objects
+    try:
+        for mac_obj in await netbox.list_in("dcim/mac-addresses/", "mac_address", pending):
+            interface = mac_obj.get('assigned_object')
+            if interface and interface.get('device'):
+                device_ids.setdefault(normalize_mac(mac_obj['mac_address']), interface['device']['id'])
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code != 404:
+            raise
+        logger.debug("MAC address objects not available, trying legacy lookup")
+
+    # Legacy: interface mac_address field
+    pending = [mac for mac in pending if not resolved(mac)]
+    try:
+        for interface in await netbox.list_in("dcim/interfaces/", "mac_address", pending):
+            if interface.get('device') and interface.get('mac_address'):
+                device_ids.setdefault(normalize_mac(interface['mac_address']), interface['device']['id'])
+    except Exception as e:
+        logger.debug(f"Interface MAC lookup failed: {e}")
+
+    # Custom field mac_address on devices
+    pending = [mac for mac in pending if not resolved(mac)]
+    for device in await netbox.list_in("dcim/devices/", f"cf_{MAC_CUSTOM_FIELD_NAME}", pending):
+        mac = device_mac(device)
+        if mac:
+            found.setdefault(mac, device)
+
+    # probe-<mac> naming convention
+    pending = [mac for mac in pending if not resolved(mac)]
+    if name_index.loaded:
+        for mac in pending:
+            if mac in name_index.by_mac:
+                device_ids[mac] = name_index.by_mac[mac]
+    else:
+        names = [f"probe-{mac.replace(':', '')}" for mac in pending] + [f"probe-{mac}" for mac in pending]
+        for device in await netbox.list_in("dcim/devices/", "name", names):
+            mac = mac_from_device_name(device['name'])
+            if mac:
+                found.setdefault(mac, device)
+
+    # Fetch every device matched by ID in one query
+    ids = {device_id for mac, device_id in device_ids.items() if mac not in found}
+    devices = {d['id']: d for d in await netbox.list_in("dcim/devices/", "id", sorted(ids))}
+    for mac, device_id in device_ids.items():
+        if mac not in found and device_id in devices:
+            found[mac] = devices[device_id]
+
+    for mac in looked_up:
+        mac_cache.put(mac, found.get(mac))
+    return found
+
+
+async def provision_port(mac_normalized: str) -> PortResponse:
+    """
+    Return the existing port for a MAC or allocate and reserve a new one.
+
+    Requests for the same MAC are serialized; new ports come from the
+    allocator, so concurrent probes never share a port.
+
+    Args:
+        mac_normalized: Normalized MAC address
+
+    Returns:
+        Port assignment details
+    """
+    async with allocator.mac_lock(mac_normalized):
+        # Fast path: MAC already holds a port in the index
+        indexed_port = port_index.by_mac.get(mac_normalized)
+        metrics.inc("gatekeeper_port_index_requests_total",
+                    result="miss" if indexed_port is None else "hit")
+        if indexed_port is not None:
+            logger.info(f"Found indexed port {indexed_port} for MAC {mac_normalized}")
+            return PortResponse(
+                mac=mac_normalized,
+                port=indexed_port,
+                existing=True,
+                device_name=port_index.by_port.get(indexed_port),
+                timestamp=datetime.utcnow().isoformat()
+            )
+
+        # Try to find existing device by MAC
+        device = await find_device_by_mac(mac_normalized)
+        existing_device = None
+
+        if device:
+            # Check for existing port assignment
+            existing_port = device_port(device)
+            if existing_port:
+                logger.info(f"Found existing port {existing_port} for MAC {mac_normalized}")
+                port_index.add(existing_port, device['name'], device['id'], mac_normalized)
+                return PortResponse(
+                    mac=mac_normalized,
+                    port=existing_port,
+                    existing=True,
+                    device_name=device['name'],
+                    timestamp=datetime.utcnow().isoformat()
+                )
+            existing_device = device
+
+        # Assign new port and create pending device in NetBox
+        async with allocator.allocate(mac_normalized) as new_port:
+            logger.info(f"Assigning new port {new_port} to MAC {mac_normalized}")
+
+            # Create a pending device in NetBox to reserve the port
+            # The register_probe playbook will update this device with full details
+            device_name = f"probe-{mac_normalized.replace(':', '')}"
+
+            if existing_device:
+                # Device exists but has no port - update it
+                with stage_timer("devices.save"):
+                    await netbox.update("dcim/devices/", existing_device['id'], {
+                        "custom_fields": {CUSTOM_FIELD_NAME: new_port},
+                    })
+                logger.info(f"Updated existing device {existing_device['name']} with port {new_port}")
+                created_device_name = existing_device['name']
+                port_index.add(new_port, existing_device['name'], existing_device['id'], mac_normalized)
+                mac_cache.invalidate(mac_normalized)
+            else:
+                # Create new pending device with minimal info
+                # Note: MAC address object is created by register_probe playbook
+                with stage_timer("devices.create"):
+                    new_device = await netbox.create("dcim/devices/", {
+                        "name": device_name,
+                        "device_type": {"slug": "network-probe"},  # Must exist in NetBox
+                        "role": {"slug": "network-probe"},         # Must exist in NetBox
+                        "site": {"slug": "pending"},               # Placeholder site for pending probes
+                        "status": "planned",                       # Indicates pending registration
+                        "custom_fields": {
+                            CUSTOM_FIELD_NAME: new_port,
+                        },
+                    })
+                logger.info(f"Created pending device {device_name} with port {new_port}")
+                created_device_name = device_name
+                port_index.add(new_port, device_name, new_device['id'], mac_normalized)
+                name_index.add(mac_normalized, new_device['id'])
+                mac_cache.invalidate(mac_normalized)
+
+        return PortResponse(
+            mac=mac_normalized,
+            port=new_port,
+            existing=False,
+            device_name=created_device_name,
+            timestamp=datetime.utcnow().isoformat()
+        )
+
+
+async def provision_ports(macs: List[str]) -> List[PortResponse]:
+    """
+    Return or allocate ports for several MAC addresses in one pass.
+
+    Existing devices are resolved with bulk queries, new ports come from a
+    single allocator pass, and pending devices are written with NetBox
+    bulk create/update requests.
+
+    Args:
+        macs: Distinct normalized MAC addresses
+
+    Returns:
+        Port assignment details, in the order of macs
+    """
+    async with allocator.mac_locks(macs):
+        timestamp = datetime.utcnow().isoformat()
+        results: Dict[str, PortResponse] = {}
+
+        # Fast path: MACs already holding a port in the index
+        for mac in macs:
+            indexed_port = port_index.by_mac.get(mac)
+            if indexed_port is not None:
+                results[mac] = PortResponse(
+                    mac=mac, port=indexed_port, existing=True,
+                    device_name=port_index.by_port.get(indexed_port), timestamp=timestamp
+                )
+
+        # Existing devices, resolved in bulk
+        unresolved = [mac for mac in macs if mac not in results]
+        with stage_timer("find_devices_by_macs"):
+            devices = await find_devices_by_macs(unresolved)
+        for mac, device in devices.items():
+            existing_port = device_port(device)
+            if existing_port:
+                port_index.add(existing_port, device['name'], device['id'], mac)
+                results[mac] = PortResponse(
+                    mac=mac, port=existing_port, existing=True,
+                    device_name=device['name'], timestamp=timestamp
+                )
+
+        # Allocate the rest in one allocator pass and write them in bulk
+        needed = [mac for mac in macs if mac not in results]
+        if needed:
+            async with allocator.allocate_many(needed) as ports:
+                logger.info(f"Assigning {len(ports)} new ports in batch")
+                updates = [mac for mac in needed if mac in devices]
+                creates = [mac for mac in needed if mac not in devices]
+
+                if updates:
+                    with stage_timer("devices.bulk_save"):
+                        await netbox.bulk_update("dcim/devices/", [
+                            {"id": devices[mac]['id'], "custom_fields": {CUSTOM_FIELD_NAME: ports[mac]}}
+                            for mac in updates
+                        ])
+                    for mac in updates:
+                        port_index.add(ports[mac], devices[mac]['name'], devices[mac]['id'], mac)
+                        mac_cache.invalidate(mac)
+
+                if creates:
+                    with stage_timer("devices.bulk_create"):
+                        created = await netbox.create("dcim/devices/", [
+                            {
+                                "name": f"probe-{mac.replace(':', '')}",
+                                "device_type": {"slug": "network-probe"},
+                                "role": {"slug": "network-probe"},
+                                "site": {"slug": "pending"},
+                                "status": "planned",
+                                "custom_fields": {CUSTOM_FIELD_NAME: ports[mac]},
+                            }
+                            for mac in creates
+                        ])
+                    for mac, new_device in zip(creates, created):
+                        port_index.add(ports[mac], new_device['name'], new_device['id'], mac)
+                        name_index.add(mac, new_device['id'])
+                        mac_cache.invalidate(mac)
+
+                for mac in needed:
+                    device_name = devices[mac]['name'] if mac in devices \
+                        else f"probe-{mac.replace(':', '')}"
+                    results[mac] = PortResponse(
+                        mac=mac, port=ports[mac], existing=False,
+                        device_name=device_name, timestamp=timestamp
+                    )
+                logger.info(f"Batch: {len(updates)} devices updated, {len(creates)} created")
+
+        return [results[mac] for mac in macs]
+
+
+@app.on_event("startup")
+async def load_port_index():
+    """
+    Open the NetBox connection pool, load the port and name indexes and
+    start the background refresher.
+    """
+    if registrations is not None:
+        await registrations.start()
+    if not netbox:
+        return
+    await netbox.start()
+    try:
+        await refresh_indexes(full=True)
+    except Exception as e:
+        logger.error(f"Initial index load failed: {e}")
+    app.state.refresher = asyncio.create_task(port_index_refresher())
+
+
+@app.on_event("shutdown")
+async def close_netbox():
+    """
+    Stop the background refresher and registration workers and close the
+    NetBox connection pool.
+    """
+    refresher = getattr(app.state, 'refresher', None)
+    if refresher:
+        refresher.cancel()
+    if registrations is not None:
+        await registrations.close()
+    if netbox:
+        await netbox.close()
+
+
 @app.get("/health", tags=["Health"])
 async def health_check():
     """
@@ -184,11 +1906,37 @@ async def health_check():
     """
     return {
         "status": "healthy",
-        "netbox_connected": nb is not None,
+        "netbox_connected": netbox is not None,
+        "port_index_size": len(port_index),
+        "ports_in_flight": allocator.in_flight,
+        "mac_cache_size": len(mac_cache),
+        "registrations_pending": len(registrations) if registrations is not None else 0,
         "timestamp": datetime.utcnow().isoformat()
     }
 
 
+@app.get("/metrics", response_class=PlainTextResponse, tags=["Health"])
+async def metrics_endpoint():
+    """
+    Prometheus metrics endpoint.
+
+    Request counts and latency per handler, per-stage latency (MAC lookup
+    tiers, port allocation, device create/save), NetBox call counts and
+    latency, and MAC cache hit ratio.
+    """
+    return PlainTextResponse(
+        metrics.render({
+            "gatekeeper_port_index_size": ("Ports held in the port index", len(port_index)),
+            "gatekeeper_ports_in_flight": ("Ports reserved by in-flight allocations", allocator.in_flight),
+            "gatekeeper_mac_cache_entries": ("Entries in the MAC lookup cache", len(mac_cache)),
+            "gatekeeper_mac_cache_hit_ratio": ("MAC lookup cache hit ratio", mac_cache.hit_ratio),
+            "gatekeeper_registrations_pending": ("Registrations waiting for an AWX job launch",
+                                                 len(registrations) if registrations is not None else 0),
+        }),
+        media_type="text/plain; version=0.0.4"
+    )
+
+
 @app.get(
     "/provision/request-port",
     response_model=PortResponse,
@@ -204,7 +1952,8 @@ async def request_port(
     Request a proxy port assignment for a probe.
 
     If the MAC address exists in NetBox, return the existing port.
-    Otherwise, assign the next available port (max + 1, starting at 10001).
+    Otherwise, assign the lowest free port (starting at 10001), reusing
+    ports released by removed probes.
 
     Args:
         mac: Probe MAC address
@@ -228,72 +1977,153 @@ async def request_port(
     logger.info(f"Port request for MAC: {mac_normalized}")
 
     # Check NetBox connection
-    if not nb:
+    if not netbox:
         logger.error("NetBox connection not available")
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
             detail="NetBox connection not available"
         )
 
-    # Try to find existing device by MAC
-    device = find_device_by_mac(mac_normalized)
-    existing_device = None
+    try:
+        return await provision_port(mac_normalized)
 
-    if device:
-        # Check for existing port assignment
-        existing_port = device.custom_fields.get(CUSTOM_FIELD_NAME)
-        if existing_port and isinstance(existing_port, int):
-            logger.info(f"Found existing port {existing_port} for MAC {mac_normalized}")
-            return PortResponse(
-                mac=mac_normalized,
-                port=existing_port,
-                existing=True,
-                device_name=device.name,
-                timestamp=datetime.utcnow().isoformat()
-            )
-        existing_device = device
+    except Exception as e:
+        logger.error(f"Error assigning port: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to assign port: {e}"
+        )
+
+
+@app.post(
+    "/provision/request-ports",
+    response_model=PortBatchResponse,
+    responses={
+        500: {"model": ErrorResponse, "description": "NetBox connection error"}
+    },
+    tags=["Provisioning"]
+)
+async def request_ports(batch: PortBatchRequest):
+    """
+    Request proxy port assignments for a batch of probes.
+
+    Used to pre-stage a shipment: existing MACs keep their ports, the rest
+    are allocated together and created as pending devices in one bulk
+    NetBox request.
+
+    Args:
+        batch: MAC addresses to provision
+
+    Returns:
+        Per-MAC port assignments and rejected MACs
+
+    Raises:
+        HTTPException: On oversized batches or NetBox errors
+    """
+    if len(batch.macs) > MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Batch too large: {len(batch.macs)} MACs (max {MAX_BATCH_SIZE})"
+        )
+
+    macs: List[str] = []
+    errors: Dict[str, str] = {}
+    for mac in batch.macs:
+        try:
+            mac_normalized = normalize_mac(mac)
+        except ValueError as e:
+            errors[mac] = f"Invalid MAC address: {e}"
+            continue
+        if mac_normalized not in macs:
+            macs.append(mac_normalized)
+
+    logger.info(f"Batch port request for {len(macs)} MACs ({len(errors)} rejected)")
+
+    if not netbox:
+        logger.error("NetBox connection not available")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="NetBox connection not available"
+        )
 
-    # Assign new port and create pending device in NetBox
     try:
-        max_port = get_max_assigned_port()
-        new_port = max_port + 1
-
-        logger.info(f"Assigning new port {new_port} to MAC {mac_normalized}")
-
-        # Create a pending device in NetBox to reserve the port atomically
-        # The register_probe playbook will update this device with full details
-        device_name = f"probe-{mac_normalized.replace(':', '')}"
-        
-        if existing_device:
-            # Device exists but has no port - update it
-            existing_device.custom_fields[CUSTOM_FIELD_NAME] = new_port
-            existing_device.save()
-            logger.info(f"Updated existing device {existing_device.name} with port {new_port}")
-            created_device_name = existing_device.name
-        else:
-            # Create new pending device with minimal info
-            # Note: MAC address object is created by register_probe playbook
-            new_device = nb.dcim.devices.create(
-                name=device_name,
-                device_type="network-probe",  # Must exist in NetBox
-                role="network-probe",      # Must exist in NetBox
-                site="pending",            # Placeholder site for pending probes
-                status="planned",          # Indicates pending registration
-                custom_fields={
-                    CUSTOM_FIELD_NAME: new_port,
-                },
-            )
-            logger.info(f"Created pending device {device_name} with port {new_port}")
-            created_device_name = device_name
+        results = await provision_ports(macs)
+    except Exception as e:
+        logger.error(f"Error assigning batch ports: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to assign ports: {e}"
+        )
 
-        return PortResponse(
-            mac=mac_normalized,
-            port=new_port,
-            existing=False,
-            device_name=created_device_name,
-            timestamp=datetime.utcnow().isoformat()
+    return PortBatchResponse(
+        results=results,
+        errors=errors,
+        timestamp=datetime.utcnow().isoformat()
+    )
+
+
+@app.post(
+    "/provision/register",
+    response_model=RegisterResponse,
+    responses={
+        403: {"model": ErrorResponse, "description": "Invalid or missing host config key"},
+        500: {"model": ErrorResponse, "description": "NetBox connection error"}
+    },
+    tags=["Provisioning"]
+)
+async def register(request: RegisterRequest,
+                   x_host_config_key: Optional[str] = Header(None)):
+    """
+    Register a probe in one round trip.
+
+    Assigns (or returns) the probe's port like /provision/request-port,
+    queues the registration (key install on the proxy, NetBox device
+    details) as an AWX job, and returns the port with the proxy host keys
+    and tunnel parameters the probe needs to bring its tunnel up.
+
+    The job installs the submitted key on the proxy, so the request must
+    carry the shared key (the AWX host config key) in X-Host-Config-Key.
+
+    Args:
+        request: Probe MAC, tenant/site and public key
+        x_host_config_key: Shared registration key
+
+    Returns:
+        Port, proxy host keys, tunnel parameters and registration state
+
+    Raises:
+        HTTPException: On authentication, validation or NetBox errors
+    """
+    if REGISTRATION_KEY:
+        check_registration_key(x_host_config_key)
+
+    try:
+        mac_normalized = normalize_mac(request.mac)
+    except ValueError as e:
+        logger.error(f"Invalid MAC address: {request.mac}")
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid MAC address: {e}"
+        )
+
+    public_key = request.public_key.strip()
+    if not PUBLIC_KEY_RE.match(public_key):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid public key: expected OpenSSH format"
         )
 
+    logger.info(f"Registration request for MAC: {mac_normalized} ({request.tenant_slug}/{request.site_slug})")
+
+    if not netbox:
+        logger.error("NetBox connection not available")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="NetBox connection not available"
+        )
+
+    try:
+        assignment = await provision_port(mac_normalized)
     except Exception as e:
         logger.error(f"Error assigning port: {e}")
         raise HTTPException(
@@ -301,6 +2131,84 @@ async def request_port(
             detail=f"Failed to assign port: {e}"
         )
 
+    # Same extra vars as the bootstrap AWX callback
+    if registrations is not None:
+        registration, _ = registrations.submit(mac_normalized, {
+            "mac": mac_normalized,
+            "proxy_port": assignment.port,
+            "tenant_name": request.tenant_name,
+            "tenant_slug": request.tenant_slug,
+            "site_name": request.site_name,
+            "site_slug": request.site_slug,
+            "public_key": public_key,
+            "hostname": request.hostname,
+        })
+    else:
+        registration = "disabled"
+
+    return RegisterResponse(
+        mac=mac_normalized,
+        port=assignment.port,
+        existing=assignment.existing,
+        device_name=assignment.device_name,
+        proxy_host_keys=proxy_host_keys,
+        tunnel=TunnelParameters(
+            proxy_host=PROXY_HOST,
+            proxy_user=PROXY_USER,
+            proxy_ssh_port=PROXY_SSH_PORT,
+            remote_port=assignment.port,
+            server_alive_interval=TUNNEL_SERVER_ALIVE_INTERVAL,
+            server_alive_count_max=TUNNEL_SERVER_ALIVE_COUNT_MAX,
+        ),
+        registration=registration,
+        timestamp=datetime.utcnow().isoformat()
+    )
+
+
+@app.get(
+    "/provision/register/{mac}",
+    response_model=RegistrationStatus,
+    responses={
+        403: {"model": ErrorResponse, "description": "Invalid or missing host config key"},
+        404: {"model": ErrorResponse, "description": "No queued registration for this MAC"}
+    },
+    tags=["Provisioning"]
+)
+async def registration_status(mac: str, x_host_config_key: Optional[str] = Header(None)):
+    """
+    Report the state of a probe's queued registration.
+
+    Probes poll this until their register_probe job is successful and
+    fall back to the AWX callback if it failed.
+
+    Args:
+        mac: Probe MAC address
+        x_host_config_key: Shared registration key
+
+    Returns:
+        Registration status, AWX job id and error
+
+    Raises:
+        HTTPException: On authentication errors or unknown MAC
+    """
+    check_registration_key(x_host_config_key)
+
+    try:
+        mac_normalized = normalize_mac(mac)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid MAC address: {e}"
+        )
+
+    row = await registrations.status(mac_normalized) if registrations is not None else None
+    if row is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"No queued registration for {mac_normalized}"
+        )
+    return RegistrationStatus(**row)
+
 
 @app.exception_handler(Exception)
 async def global_exception_handler(request, exc):
@@ -5,10 +5,27 @@ Probe Bootstrap Script - First-Boot Registration
 This script runs on first boot of a probe to register it with the system:
 1. Read tenant configuration
 2. Get MAC address
-3. Request proxy port from Gatekeeper
+3. Register with Gatekeeper (port, proxy host keys, tunnel parameters)
 4. Generate SSH key pair
 5. Create autossh systemd service
-6. Call AWX provisioning callback
+6. Confirm the registration job queued by Gatekeeper, or call the AWX
+   provisioning callback (if the job failed, was never confirmed, or
+   Gatekeeper predates /provision/register)
+
+With /provision/register, one request returns the port, the proxy's
+host keys (pinned in the tunnel's known_hosts) and the tunnel parameters,
+and Gatekeeper queues the registration job itself; the probe polls the
+job's status before it skips the callback. Otherwise independent
+work runs concurrently: the port request starts as soon as the MAC is
+known, while the config is read and the SSH key generated; the systemd
+unit and the AWX callback then run side by side. Network
+calls retry with exponential backoff and full jitter, so a site-wide
+power outage does not turn into synchronized retries against gatekeeper.
+
+Progress is checkpointed per step in a state file (MAC, port, key
+fingerprint, queued registration, installed unit, acknowledged callback). A re-run resumes at
+the first incomplete step instead of asking gatekeeper again, rewriting
+the unit and restarting the tunnel; a completed probe exits at once.
 
 Author: Probe Discovery System
 License: MIT
@@ -17,9 +34,15 @@ License: MIT
 import os
 import sys
 import json
+import time
+import base64
+import hashlib
+import random
 import logging
+import threading
 import subprocess
 import socket
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
 
@@ -47,6 +70,7 @@ NETWORK_INTERFACE = "eth0"
 SSH_DIR = Path.home() / ".ssh"
 SSH_KEY = SSH_DIR / "id_ed25519"
 SSH_PUB_KEY = SSH_DIR / "id_ed25519.pub"
+PROXY_KNOWN_HOSTS = SSH_DIR / "known_hosts_proxy"
 SYSTEMD_DIR = Path("/etc/systemd/system")
 
 # Environment variables or defaults
@@ -56,6 +80,85 @@ AWX_CALLBACK_URL = os.getenv("AWX_CALLBACK_URL", "https://awx.atgfw.com/api/v2/j
 AWX_HOST_CONFIG_KEY = os.getenv("AWX_HOST_CONFIG_KEY", "probe-bootstrap-atg-2026")
 PROXY_HOST = os.getenv("PROXY_HOST", "167.99.59.231")
 PROXY_USER = os.getenv("PROXY_USER", "tunnelmgr")
+# Use Gatekeeper's single-request /provision/register (falls back to
+# request-port + AWX callback on older Gatekeepers)
+GATEKEEPER_REGISTER = os.getenv("GATEKEEPER_REGISTER", "1").lower() not in ("0", "false", "no")
+# How long to wait for a queued registration job before falling back to
+# the AWX callback, and how often to poll its status
+REGISTRATION_WAIT = float(os.getenv("BOOTSTRAP_REGISTRATION_WAIT", "600"))
+REGISTRATION_POLL = float(os.getenv("BOOTSTRAP_REGISTRATION_POLL", "10"))
+
+# Retries for gatekeeper and AWX: attempt n sleeps uniform(0, min(cap, base * 2^n))
+RETRY_ATTEMPTS = int(os.getenv("BOOTSTRAP_RETRY_ATTEMPTS", "8"))
+RETRY_BASE = float(os.getenv("BOOTSTRAP_RETRY_BASE", "2"))
+RETRY_CAP = float(os.getenv("BOOTSTRAP_RETRY_CAP", "120"))
+# 4xx responses other than these are not retried
+RETRY_STATUSES = {408, 425, 429}
+
+# Per-step checkpoints (see Checkpoint)
+STATE_PATH = Path(os.getenv("BOOTSTRAP_STATE", "/var/lib/probe_bootstrap/state.json"))
+
+# One pooled HTTP session for all bootstrap requests
+session = requests.Session()
+# Set when a step fails so other threads stop retrying
+abort = threading.Event()
+
+
+class Checkpoint:
+    """
+    Per-step bootstrap progress, persisted as JSON after every step.
+
+    Steps: mac, port, key, registration, unit, callback, completed. Each holds the data
+    the step produced plus a timestamp; the file is replaced atomically so
+    a power cut never leaves it half written.
+    """
+
+    def __init__(self, path: Path = STATE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            self.state = json.loads(path.read_text())
+        except FileNotFoundError:
+            self.state = {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable bootstrap state {path}: {e}")
+            self.state = {}
+
+    def get(self, step: str) -> dict:
+        """
+        Data recorded for a step, or an empty dict if not done.
+        """
+        return self.state.get(step) or {}
+
+    def mark(self, step: str, **data) -> None:
+        """
+        Record a step as done and save.
+        """
+        with self._lock:
+            self.state[step] = dict(data, at=datetime.utcnow().isoformat())
+            self._save()
+
+    def reset(self, *steps: str) -> None:
+        """
+        Forget steps (all of them if none given) and save.
+        """
+        with self._lock:
+            for step in steps or list(self.state):
+                self.state.pop(step, None)
+            self._save()
+
+    def _save(self) -> None:
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp, 'w') as f:
+                json.dump(self.state, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        except OSError as e:
+            # Losing the checkpoint only costs a longer re-run
+            logger.warning(f"Could not save bootstrap state {self.path}: {e}")
 
 
 def slugify(text: str) -> str:
@@ -181,6 +284,58 @@ def get_mac_address(interface: str = NETWORK_INTERFACE) -> str:
         raise RuntimeError(f"Interface {interface} not found")
 
 
+def backoff_delay(attempt: int) -> float:
+    """
+    Full-jitter exponential backoff delay for a retry attempt (0-based).
+    """
+    return random.uniform(0, min(RETRY_CAP, RETRY_BASE * (2 ** attempt)))
+
+
+def retryable(error: requests.RequestException) -> bool:
+    """
+    Connection errors, timeouts, 5xx and throttling responses are retried.
+    """
+    response = getattr(error, 'response', None)
+    if response is None:
+        return True
+    return response.status_code >= 500 or response.status_code in RETRY_STATUSES
+
+
+def http_request(method: str, url: str, **kwargs) -> requests.Response:
+    """
+    Send an HTTP request, retrying transient failures with jittered backoff.
+
+    Args:
+        method: HTTP method
+        url: Request URL
+        **kwargs: Passed to requests
+
+    Returns:
+        Successful response
+
+    Raises:
+        requests.RequestException: If the request fails permanently or
+            retries are exhausted
+    """
+    for attempt in range(RETRY_ATTEMPTS):
+        try:
+            response = session.request(method, url, **kwargs)
+            response.raise_for_status()
+            return response
+        except requests.RequestException as e:
+            if not retryable(e) or attempt == RETRY_ATTEMPTS - 1 or abort.is_set():
+                raise
+            delay = backoff_delay(attempt)
+            # Honour Retry-After from a throttling gatekeeper
+            retry_after = getattr(e.response, 'headers', {}).get('Retry-After', '')
+            if retry_after.isdigit():
+                delay = max(delay, float(retry_after))
+            logger.warning(f"{method} {url} failed ({e}), retry {attempt + 1}/{RETRY_ATTEMPTS - 1} "
+                           f"in {delay:.1f}s")
+            if abort.wait(delay):
+                raise
+
+
 def request_proxy_port(mac: str) -> int:
     """
     Request a proxy port from the Gatekeeper API.
@@ -199,8 +354,7 @@ def request_proxy_port(mac: str) -> int:
 
     try:
         logger.info(f"Requesting proxy port from {url}")
-        response = requests.get(url, params=params, timeout=30)
-        response.raise_for_status()
+        response = http_request('GET', url, params=params, timeout=30)
 
         data = response.json()
         port = data.get('port')
@@ -216,6 +370,103 @@ def request_proxy_port(mac: str) -> int:
         raise RuntimeError(f"Failed to request proxy port: {e}")
 
 
+def register_with_gatekeeper(mac: str, t_name: str, t_slug: str, s_name: str, s_slug: str,
+                             public_key: str) -> dict:
+    """
+    Register the probe with Gatekeeper in one request.
+
+    Args:
+        mac: Probe MAC address
+        t_name: Tenant Display Name
+        t_slug: Tenant URL-safe slug
+        s_name: Site Display Name
+        s_slug: Site URL-safe slug
+        public_key: SSH public key
+
+    Returns:
+        Registration response (port, proxy_host_keys, tunnel, registration),
+        or an empty dict if Gatekeeper has no /provision/register
+
+    Raises:
+        RuntimeError: If the request fails
+    """
+    url = f"{GATEKEEPER_URL}/provision/register"
+    payload = {
+        "mac": mac,
+        "tenant_name": t_name,
+        "tenant_slug": t_slug,
+        "site_name": s_name,
+        "site_slug": s_slug,
+        "public_key": public_key,
+        "hostname": socket.gethostname(),
+    }
+
+    try:
+        logger.info(f"Registering with {url}")
+        data = http_request('POST', url, json=payload, timeout=30,
+                            headers={'X-Host-Config-Key': AWX_HOST_CONFIG_KEY}).json()
+    except requests.HTTPError as e:
+        if e.response is not None and e.response.status_code in (404, 405):
+            logger.info("Gatekeeper has no /provision/register, using request-port and AWX callback")
+            return {}
+        logger.error(f"Error registering with Gatekeeper: {e}")
+        raise RuntimeError(f"Failed to register with Gatekeeper: {e}")
+    except requests.RequestException as e:
+        logger.error(f"Error registering with Gatekeeper: {e}")
+        raise RuntimeError(f"Failed to register with Gatekeeper: {e}")
+
+    if not isinstance(data.get('port'), int):
+        raise RuntimeError(f"Invalid port in response: {data}")
+    logger.info(f"Assigned proxy port: {data['port']} (registration {data.get('registration')})")
+    return data
+
+
+def wait_for_registration(mac: str) -> str:
+    """
+    Poll Gatekeeper until the queued registration job has ended.
+
+    Args:
+        mac: Probe MAC address
+
+    Returns:
+        "successful" or "failed"; "unknown" if Gatekeeper has no record
+        of the registration or it did not end within REGISTRATION_WAIT
+    """
+    url = f"{GATEKEEPER_URL}/provision/register/{mac}"
+    deadline = time.monotonic() + REGISTRATION_WAIT
+    while True:
+        try:
+            response = session.get(url, timeout=30, headers={'X-Host-Config-Key': AWX_HOST_CONFIG_KEY})
+            if response.status_code == 404:
+                logger.warning("Gatekeeper has no record of the registration")
+                return "unknown"
+            response.raise_for_status()
+            data = response.json()
+            state = data.get('status')
+            if state in ('successful', 'failed'):
+                logger.info(f"Registration job {data.get('job')} {state}")
+                return state
+            logger.info(f"Registration {state}, waiting for the job")
+        except (requests.RequestException, ValueError) as e:
+            logger.warning(f"Error checking registration status: {e}")
+        if time.monotonic() + REGISTRATION_POLL > deadline:
+            logger.warning(f"Registration not confirmed within {REGISTRATION_WAIT:.0f}s")
+            return "unknown"
+        if abort.wait(REGISTRATION_POLL):
+            return "unknown"
+
+
+def write_proxy_known_hosts(host: str, ssh_port: int, host_keys: list) -> None:
+    """
+    Pin the proxy's host keys for the tunnel.
+    """
+    name = host if ssh_port == 22 else f"[{host}]:{ssh_port}"
+    SSH_DIR.mkdir(mode=0o700, exist_ok=True)
+    PROXY_KNOWN_HOSTS.write_text(''.join(f"{name} {key}\n" for key in host_keys))
+    PROXY_KNOWN_HOSTS.chmod(0o644)
+    logger.info(f"Pinned {len(host_keys)} proxy host keys in {PROXY_KNOWN_HOSTS}")
+
+
 def generate_ssh_key_pair() -> str:
     """
     Generate Ed25519 SSH key pair if it doesn't exist.
@@ -267,27 +518,45 @@ def generate_ssh_key_pair() -> str:
         raise RuntimeError(f"Failed to generate SSH keys: {e}")
 
 
-def create_autossh_service(port: int) -> None:
+def key_fingerprint(public_key: str) -> str:
     """
-    Create systemd service file for autossh reverse tunnel.
+    OpenSSH SHA256 fingerprint of a public key line.
+    """
+    digest = hashlib.sha256(base64.b64decode(public_key.split()[1])).digest()
+    return "SHA256:" + base64.b64encode(digest).decode().rstrip("=")
 
-    Args:
-        port: Assigned proxy port
 
-    Raises:
-        RuntimeError: If service file creation or enablement fails
+def autossh_service_content(port: int, tunnel: dict = None) -> str:
     """
-    service_name = f"autossh-probe-{port}.service"
-    service_path = SYSTEMD_DIR / service_name
+    systemd unit for the autossh reverse tunnel on the given port.
 
-    service_content = f"""[Unit]
+    Args:
+        port: Assigned proxy port
+        tunnel: Tunnel parameters from Gatekeeper (defaults: PROXY_HOST,
+            PROXY_USER, no host key pinning)
+    """
+    tunnel = tunnel or {}
+    host = tunnel.get('proxy_host') or PROXY_HOST
+    user = tunnel.get('proxy_user') or PROXY_USER
+    ssh_port = tunnel.get('proxy_ssh_port') or 22
+    ssh_options = (f"-o ServerAliveInterval={tunnel.get('server_alive_interval', 30)} "
+                   f"-o ServerAliveCountMax={tunnel.get('server_alive_count_max', 3)} "
+                   f"-o ExitOnForwardFailure=yes ")
+    if tunnel.get('known_hosts'):
+        ssh_options += f"-o StrictHostKeyChecking=yes -o UserKnownHostsFile={tunnel['known_hosts']}"
+    else:
+        ssh_options += "-o StrictHostKeyChecking=no"
+    if ssh_port != 22:
+        ssh_options += f" -p {ssh_port}"
+    forward = f"{port}:localhost:{tunnel.get('local_port', 22)}"
+    return f"""[Unit]
 Description=Autossh reverse tunnel to proxy
 After=network.target
 
 [Service]
 Environment="AUTOSSH_GATETIME=0"
 User=root
-ExecStart=/usr/bin/autossh -M 0 -o ServerAliveInterval=30 -o ServerAliveCountMax=3 -o ExitOnForwardFailure=yes -o StrictHostKeyChecking=no -N -R {port}:localhost:22 {PROXY_USER}@{PROXY_HOST}
+ExecStart=/usr/bin/autossh -M 0 {ssh_options} -N -R {forward} {user}@{host}
 Restart=always
 RestartSec=10
 
@@ -295,6 +564,22 @@ RestartSec=10
 WantedBy=multi-user.target
 """
 
+
+def create_autossh_service(port: int, tunnel: dict = None) -> None:
+    """
+    Create systemd service file for autossh reverse tunnel.
+
+    Args:
+        port: Assigned proxy port
+        tunnel: Tunnel parameters from Gatekeeper
+
+    Raises:
+        RuntimeError: If service file creation or enablement fails
+    """
+    service_name = f"autossh-probe-{port}.service"
+    service_path = SYSTEMD_DIR / service_name
+    service_content = autossh_service_content(port, tunnel)
+
     try:
         logger.info(f"Creating systemd service: {service_path}")
 
@@ -349,13 +634,13 @@ def call_awx_callback(mac: str, proxy_port: int, t_name: str, t_slug: str, s_nam
 
     try:
         logger.info(f"Calling AWX callback: {AWX_CALLBACK_URL}")
-        response = requests.post(
+        http_request(
+            'POST',
             AWX_CALLBACK_URL,
             json=payload,
             timeout=30,
             headers={'Content-Type': 'application/json'}
         )
-        response.raise_for_status()
 
         logger.info("AWX callback successful")
 
@@ -384,6 +669,109 @@ proxy_port={port}
         logger.warning(f"Could not write bootstrap marker: {e}")
 
 
+def ensure_proxy_port(checkpoint: Checkpoint, mac: str) -> int:
+    """
+    Proxy port from the checkpoint, or requested from gatekeeper.
+    """
+    saved = checkpoint.get('port').get('port')
+    if saved:
+        logger.info(f"Resuming with checkpointed proxy port {saved}")
+        return saved
+    port = request_proxy_port(mac)
+    checkpoint.mark('port', port=port)
+    return port
+
+
+def ensure_registration(checkpoint: Checkpoint, mac: str, t_name: str, t_slug: str,
+                        s_name: str, s_slug: str, public_key: str) -> dict:
+    """
+    Tunnel parameters from the checkpoint, or from registering with Gatekeeper.
+
+    When Gatekeeper queued the registration it is checkpointed, so the
+    callback step waits for the job instead of calling AWX.
+
+    Returns:
+        Tunnel parameters (remote_port is the proxy port), or an empty
+        dict if Gatekeeper has no /provision/register
+    """
+    saved = checkpoint.get('tunnel')
+    if saved:
+        logger.info(f"Resuming with checkpointed proxy port {saved['remote_port']}")
+        return saved
+    data = register_with_gatekeeper(mac, t_name, t_slug, s_name, s_slug, public_key)
+    if not data:
+        return {}
+
+    tunnel = dict(data.get('tunnel') or {}, remote_port=data['port'])
+    if data.get('proxy_host_keys'):
+        write_proxy_known_hosts(tunnel.get('proxy_host') or PROXY_HOST,
+                                tunnel.get('proxy_ssh_port') or 22, data['proxy_host_keys'])
+        tunnel['known_hosts'] = str(PROXY_KNOWN_HOSTS)
+    checkpoint.mark('port', port=data['port'])
+    if data.get('registration') in ('queued', 'updated'):
+        checkpoint.mark('registration', port=data['port'], key_fingerprint=key_fingerprint(public_key),
+                        status=data['registration'])
+    checkpoint.mark('tunnel', **tunnel)
+    return tunnel
+
+
+def ensure_ssh_key(checkpoint: Checkpoint) -> str:
+    """
+    SSH public key (generated if missing), with its fingerprint checkpointed.
+
+    A key different from the checkpointed one (e.g. the key files were
+    deleted) invalidates the registration and callback, which registered
+    the old key.
+    """
+    public_key = generate_ssh_key_pair()
+    fingerprint = key_fingerprint(public_key)
+    if checkpoint.get('key').get('fingerprint') != fingerprint:
+        checkpoint.reset('registration', 'callback')
+        checkpoint.mark('key', fingerprint=fingerprint)
+    return public_key
+
+
+def ensure_autossh_service(checkpoint: Checkpoint, port: int, tunnel: dict = None) -> None:
+    """
+    Install the autossh unit unless the checkpointed one is in place.
+    """
+    name = f"autossh-probe-{port}.service"
+    digest = hashlib.sha256(autossh_service_content(port, tunnel).encode()).hexdigest()
+    saved = checkpoint.get('unit')
+    if saved.get('name') == name and saved.get('sha256') == digest and (SYSTEMD_DIR / name).exists():
+        logger.info(f"Service {name} already installed")
+        return
+    create_autossh_service(port, tunnel)
+    checkpoint.mark('unit', name=name, sha256=digest)
+
+
+def ensure_callback(checkpoint: Checkpoint, mac: str, port: int, t_name: str, t_slug: str,
+                    s_name: str, s_slug: str, public_key: str) -> None:
+    """
+    Call the AWX callback unless it was acknowledged for this port and key.
+
+    A registration Gatekeeper queued for this port and key counts once
+    its job succeeded; if it failed or is not confirmed in time, the AWX
+    callback runs instead (and a failing callback fails the bootstrap,
+    which is retried on the next boot).
+    """
+    fingerprint = key_fingerprint(public_key)
+    saved = checkpoint.get('callback')
+    if saved.get('port') == port and saved.get('key_fingerprint') == fingerprint:
+        logger.info("AWX callback already acknowledged")
+        return
+    queued = checkpoint.get('registration')
+    if queued.get('port') == port and queued.get('key_fingerprint') == fingerprint:
+        state = wait_for_registration(mac)
+        if state == 'successful':
+            checkpoint.mark('callback', port=port, key_fingerprint=fingerprint, via='gatekeeper')
+            return
+        logger.warning(f"Queued registration {state}, falling back to the AWX callback")
+        checkpoint.reset('registration')
+    call_awx_callback(mac, port, t_name, t_slug, s_name, s_slug, public_key)
+    checkpoint.mark('callback', port=port, key_fingerprint=fingerprint)
+
+
 def main():
     """
     Main bootstrap execution flow.
@@ -392,33 +780,58 @@ def main():
     logger.info("Starting probe bootstrap process")
     logger.info("=" * 60)
 
+    started = time.monotonic()
+    checkpoint = Checkpoint()
+    pool = ThreadPoolExecutor(max_workers=3)
     try:
-        # Step 1: Read configuration
-        logger.info("Step 1: Reading configuration")
-        t_name, t_slug, s_name, s_slug = read_config()
-
-        # Step 2: Get MAC address
+        # Step 2 first: the port request only needs the MAC
         logger.info("Step 2: Getting MAC address")
         mac = get_mac_address()
-
-        # Step 3: Request proxy port
-        logger.info("Step 3: Requesting proxy port from Gatekeeper")
-        proxy_port = request_proxy_port(mac)
-
-        # Step 4: Generate SSH key pair
+        if checkpoint.get('mac').get('mac') not in (None, mac):
+            # State from another device (e.g. a moved SD card)
+            logger.warning("Bootstrap state belongs to a different MAC, starting over")
+            checkpoint.reset()
+        completed = checkpoint.get('completed')
+        if completed:
+            logger.info(f"Bootstrap already completed at {completed['at']} (port {completed['port']})")
+            write_bootstrap_complete(completed['port'])
+            return 0
+        if not checkpoint.get('mac'):
+            checkpoint.mark('mac', mac=mac)
+
+        # Without /provision/register, step 3 runs while steps 1 and 4 run
+        port_future = None
+        if not GATEKEEPER_REGISTER:
+            logger.info("Step 3: Requesting proxy port from Gatekeeper")
+            port_future = pool.submit(ensure_proxy_port, checkpoint, mac)
         logger.info("Step 4: Generating SSH key pair")
-        public_key = generate_ssh_key_pair()
+        key_future = pool.submit(ensure_ssh_key, checkpoint)
 
-        # Step 5: Create autossh service
+        logger.info("Step 1: Reading configuration")
+        t_name, t_slug, s_name, s_slug = read_config()
+        public_key = key_future.result()
+
+        tunnel = {}
+        if port_future is None:
+            logger.info("Step 3: Registering with Gatekeeper")
+            tunnel = ensure_registration(checkpoint, mac, t_name, t_slug, s_name, s_slug, public_key)
+            if not tunnel:
+                port_future = pool.submit(ensure_proxy_port, checkpoint, mac)
+        proxy_port = tunnel['remote_port'] if tunnel else port_future.result()
+
+        # Steps 5 and 6 only depend on the port and key; autossh keeps
+        # retrying until the key is installed on the proxy
         logger.info("Step 5: Creating autossh systemd service")
-        create_autossh_service(proxy_port)
-
-        # Step 6: Call AWX callback
-        logger.info("Step 6: Calling AWX provisioning callback")
-        call_awx_callback(mac, proxy_port, t_name, t_slug, s_name, s_slug, public_key)
+        service_future = pool.submit(ensure_autossh_service, checkpoint, proxy_port, tunnel or None)
+        logger.info("Step 6: Confirming registration / calling AWX provisioning callback")
+        callback_future = pool.submit(ensure_callback, checkpoint, mac, proxy_port, t_name,
+                                      t_slug, s_name, s_slug, public_key)
+        service_future.result()
+        callback_future.result()
 
         # Step 7: Mark bootstrap complete
         logger.info("Step 7: Writing bootstrap completion marker")
+        checkpoint.mark('completed', port=proxy_port)
         write_bootstrap_complete(proxy_port)
 
         logger.info("=" * 60)
@@ -428,16 +841,22 @@ def main():
         logger.info(f"  MAC: {mac}")
         logger.info(f"  Proxy Port: {proxy_port}")
         logger.info(f"  Service: autossh-probe-{proxy_port}.service")
+        logger.info(f"  Duration: {time.monotonic() - started:.1f}s")
         logger.info("=" * 60)
 
         return 0
 
     except Exception as e:
+        # Stop retries still running in other steps
+        abort.set()
         logger.error("=" * 60)
         logger.error(f"Bootstrap failed: {e}")
         logger.error("=" * 60)
         return 1
 
+    finally:
+        pool.shutdown(wait=True)
+
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+"""
+Gatekeeper Load Test and Benchmark
+
+Runs gatekeeper.app in-process against a fake in-process NetBox API
+seeded with N devices, fires concurrent port requests for new and
+existing MACs, and reports latency percentiles, throughput, NetBox call
+counts and duplicate port allocations.
+
+Usage:
+    python3 scripts/bench_gatekeeper.py [--devices 1000,10000,50000]
+        [--requests 1000] [--concurrency 200] [--existing-ratio 0.3]
+        [--netbox-latency-ms 5] [--batch-size 0] [--json]
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import importlib
+import logging
+from pathlib import Path
+from typing import Dict, List, Optional, Any
+from urllib.parse import parse_qs
+
+import httpx
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("NETBOX_URL", "http://netbox.bench")
+os.environ.setdefault("NETBOX_TOKEN", "bench")
+
+CUSTOM_FIELD_NAME = "automation_proxy_port"
+DEFAULT_START_PORT = 10001
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """
+    Return the pct-th percentile (nearest rank) of a sorted list.
+    """
+    if not values:
+        return 0.0
+    rank = max(0, min(len(values) - 1, int(round(pct / 100 * len(values))) - 1))
+    return values[rank]
+
+
+class FakeNetBox:
+    """
+    In-process stand-in for the NetBox REST API endpoints gatekeeper uses.
+
+    Devices are indexed by ID, name and port so filtered queries stay
+    cheap at 50k devices; every request sleeps for the configured latency
+    to model the network round trip.
+    """
+
+    def __init__(self, device_count: int, latency: float = 0.0, seed: int = 1):
+        self.latency = latency
+        self.rng = random.Random(seed)
+        self.devices: Dict[int, Dict[str, Any]] = {}
+        self.by_name: Dict[str, int] = {}
+        self.by_port: Dict[int, set] = {}
+        self.mac_objects: Dict[str, int] = {}
+        self.calls = 0
+        self.next_id = 1
+        self.probe_macs: List[str] = []
+        self._seed(device_count)
+
+    def _seed(self, count: int) -> None:
+        """
+        Seed probes (with ports, some with gaps and MAC objects) and
+        port-less Discovered-* devices.
+        """
+        port = DEFAULT_START_PORT
+        for i in range(count):
+            if i % 10 < 7:
+                mac = f"02:00:{(i >> 24) & 0xff:02x}:{(i >> 16) & 0xff:02x}:{(i >> 8) & 0xff:02x}:{i & 0xff:02x}"
+                device = self._create(f"probe-{mac.replace(':', '')}", port)
+                self.probe_macs.append(mac)
+                if i % 4 == 0:
+                    self.mac_objects[mac] = device["id"]
+                # Leave a gap every 50 ports (decommissioned probes)
+                port += 2 if i % 50 == 0 else 1
+            else:
+                self._create(f"Discovered-{i:012x}", None)
+
+    def _create(self, name: str, port: Optional[int]) -> Dict[str, Any]:
+        device = {
+            "id": self.next_id,
+            "name": name,
+            "status": {"value": "planned"},
+            "custom_fields": {CUSTOM_FIELD_NAME: port},
+            "last_updated": f"2026-01-01T00:00:00.{self.next_id:06d}Z",
+        }
+        self.next_id += 1
+        self.devices[device["id"]] = device
+        self.by_name[name] = device["id"]
+        if port:
+            self.by_port.setdefault(port, set()).add(device["id"])
+        return device
+
+    def _set_port(self, device: Dict[str, Any], port: Optional[int]) -> None:
+        old = device["custom_fields"].get(CUSTOM_FIELD_NAME)
+        if old:
+            self.by_port.get(old, set()).discard(device["id"])
+        device["custom_fields"][CUSTOM_FIELD_NAME] = port
+        if port:
+            self.by_port.setdefault(port, set()).add(device["id"])
+
+    def duplicate_ports(self) -> int:
+        """
+        Return the number of ports held by more than one device.
+        """
+        return sum(1 for ids in self.by_port.values() if len(ids) > 1)
+
+    def _filter_devices(self, query: Dict[str, List[str]]) -> List[Dict[str, Any]]:
+        if "id" in query:
+            candidates = [self.devices[int(i)] for i in query["id"] if int(i) in self.devices]
+        elif "name" in query:
+            candidates = [self.devices[self.by_name[n]] for n in query["name"] if n in self.by_name]
+        elif f"cf_{CUSTOM_FIELD_NAME}" in query:
+            candidates = [self.devices[i] for p in query[f"cf_{CUSTOM_FIELD_NAME}"]
+                          for i in self.by_port.get(int(p), ())]
+        else:
+            candidates = list(self.devices.values())
+
+        for key, values in query.items():
+            if key == f"cf_{CUSTOM_FIELD_NAME}__gte":
+                floor = int(values[0])
+                candidates = [d for d in candidates
+                              if (d["custom_fields"].get(CUSTOM_FIELD_NAME) or 0) >= floor]
+            elif key == "name__isw":
+                candidates = [d for d in candidates if d["name"].lower().startswith(values[0].lower())]
+            elif key == "last_updated__gte":
+                candidates = [d for d in candidates if d["last_updated"] >= values[0]]
+            elif key == "cf_mac_address":
+                candidates = []
+        return candidates
+
+    @staticmethod
+    def _page(results: List[Any], query: Dict[str, List[str]]) -> httpx.Response:
+        offset = int(query.get("offset", ["0"])[0])
+        limit = int(query.get("limit", ["50"])[0])
+        return httpx.Response(200, json={
+            "count": len(results), "results": results[offset:offset + limit]
+        })
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        """
+        httpx transport handler emulating the NetBox REST API.
+        """
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        path = request.url.path.split("/api/", 1)[-1]
+        query = parse_qs(request.url.query.decode())
+        parts = path.strip("/").split("/")
+
+        if path.startswith("dcim/mac-addresses/"):
+            results = []
+            for mac in query.get("mac_address", []):
+                device_id = self.mac_objects.get(mac.lower())
+                if device_id:
+                    device = self.devices[device_id]
+                    results.append({
+                        "mac_address": mac.upper(),
+                        "assigned_object": {"name": "eth0", "device": {
+                            "id": device_id, "name": device["name"]}},
+                    })
+            return self._page(results, query)
+
+        if path.startswith("dcim/interfaces/"):
+            return self._page([], query)
+
+        if not path.startswith("dcim/devices/"):
+            return httpx.Response(404, json={"detail": "Not found."})
+
+        if len(parts) == 3 and parts[2].isdigit():
+            device = self.devices.get(int(parts[2]))
+            if device is None:
+                return httpx.Response(404, json={"detail": "Not found."})
+            if request.method == "PATCH":
+                body = json.loads(request.content)
+                self._set_port(device, body.get("custom_fields", {}).get(CUSTOM_FIELD_NAME))
+            return httpx.Response(200, json=device)
+
+        if request.method == "POST":
+            body = json.loads(request.content)
+            items = body if isinstance(body, list) else [body]
+            created = [self._create(item["name"], item["custom_fields"].get(CUSTOM_FIELD_NAME))
+                       for item in items]
+            return httpx.Response(201, json=created if isinstance(body, list) else created[0])
+
+        if request.method == "PATCH":
+            updated = []
+            for item in json.loads(request.content):
+                device = self.devices[item["id"]]
+                self._set_port(device, item.get("custom_fields", {}).get(CUSTOM_FIELD_NAME))
+                updated.append(device)
+            return httpx.Response(200, json=updated)
+
+        return self._page(self._filter_devices(query), query)
+
+
+async def run_scenario(device_count: int, args) -> Dict[str, Any]:
+    """
+    Run one benchmark scenario against a freshly loaded gatekeeper.
+
+    Args:
+        device_count: Devices seeded into the fake NetBox
+        args: Parsed command line arguments
+
+    Returns:
+        Scenario results
+    """
+    import gatekeeper
+    gatekeeper = importlib.reload(gatekeeper)
+    logging.getLogger("gatekeeper").setLevel(logging.WARNING)
+
+    fake = FakeNetBox(device_count, latency=args.netbox_latency_ms / 1000, seed=args.seed)
+    gatekeeper.netbox = gatekeeper.NetBoxClient(
+        "http://netbox.bench", "bench",
+        max_connections=args.netbox_connections,
+        transport=httpx.MockTransport(fake.handle),
+    )
+
+    load_start = time.perf_counter()
+    await gatekeeper.load_port_index()
+    load_seconds = time.perf_counter() - load_start
+    startup_calls = fake.calls
+
+    rng = random.Random(args.seed)
+    new_macs = [f"06:00:00:{(i >> 16) & 0xff:02x}:{(i >> 8) & 0xff:02x}:{i & 0xff:02x}"
+                for i in range(args.requests)]
+    macs = []
+    for i in range(args.requests):
+        if fake.probe_macs and rng.random() < args.existing_ratio:
+            macs.append(rng.choice(fake.probe_macs))
+        else:
+            macs.append(new_macs[i])
+    existing = set(fake.probe_macs)
+
+    latencies: List[float] = []
+    assigned: Dict[int, set] = {}
+    failures = 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=gatekeeper.app),
+                                 base_url="http://gatekeeper.bench", timeout=60) as client:
+
+        async def single(mac: str) -> None:
+            nonlocal failures
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.get("/provision/request-port", params={"mac": mac})
+                latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                failures += 1
+                return
+            assigned.setdefault(response.json()["port"], set()).add(mac)
+
+        async def batch(chunk: List[str]) -> None:
+            nonlocal failures
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.post("/provision/request-ports", json={"macs": chunk})
+                latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                failures += len(chunk)
+                return
+            for result in response.json()["results"]:
+                assigned.setdefault(result["port"], set()).add(result["mac"])
+
+        run_start = time.perf_counter()
+        if args.batch_size:
+            await asyncio.gather(*[batch(macs[i:i + args.batch_size])
+                                   for i in range(0, len(macs), args.batch_size)])
+        else:
+            await asyncio.gather(*[single(mac) for mac in macs])
+        elapsed = time.perf_counter() - run_start
+
+    await gatekeeper.close_netbox()
+
+    latencies.sort()
+    return {
+        "devices": device_count,
+        "requests": len(macs),
+        "existing_requests": sum(1 for mac in macs if mac in existing),
+        "mode": f"batch/{args.batch_size}" if args.batch_size else "single",
+        "concurrency": args.concurrency,
+        "index_load_seconds": round(load_seconds, 3),
+        "startup_netbox_calls": startup_calls,
+        "netbox_calls": fake.calls - startup_calls,
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_rps": round(len(macs) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "max_ms": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+        "failures": failures,
+        "duplicate_allocations": sum(1 for holders in assigned.values() if len(holders) > 1),
+        "netbox_duplicate_ports": fake.duplicate_ports(),
+    }
+
+
+def print_table(results: List[Dict[str, Any]]) -> None:
+    """
+    Print scenario results as a text table.
+    """
+    columns = [
+        ("devices", "Devices"), ("requests", "Reqs"), ("mode", "Mode"),
+        ("index_load_seconds", "Load s"), ("netbox_calls", "NB calls"),
+        ("throughput_rps", "Req/s"), ("p50_ms", "p50 ms"), ("p95_ms", "p95 ms"),
+        ("p99_ms", "p99 ms"), ("failures", "Fail"), ("duplicate_allocations", "Dup"),
+        ("netbox_duplicate_ports", "NB dup"),
+    ]
+    widths = [max(len(title), *(len(str(r[key])) for r in results)) for key, title in columns]
+    print("  ".join(title.rjust(w) for (_, title), w in zip(columns, widths)))
+    for result in results:
+        print("  ".join(str(result[key]).rjust(w) for (key, _), w in zip(columns, widths)))
+
+
+def main():
+    """
+    Main execution flow.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark gatekeeper against a fake NetBox")
+    parser.add_argument("--devices", default="1000,10000,50000",
+                        help="Comma-separated NetBox device counts to seed")
+    parser.add_argument("--requests", type=int, default=1000, help="Port requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=200, help="Concurrent requests in flight")
+    parser.add_argument("--existing-ratio", type=float, default=0.3,
+                        help="Fraction of requests for MACs already in NetBox")
+    parser.add_argument("--batch-size", type=int, default=0,
+                        help="Use POST /provision/request-ports with this many MACs per call")
+    parser.add_argument("--netbox-latency-ms", type=float, default=5.0,
+                        help="Simulated NetBox round-trip latency")
+    parser.add_argument("--netbox-connections", type=int, default=20,
+                        help="Gatekeeper NetBox connection pool size")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+
+    results = [asyncio.run(run_scenario(int(count), args)) for count in args.devices.split(",")]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_table(results)
+
+    # Non-zero exit on duplicates so the benchmark can gate regressions
+    if any(r["duplicate_allocations"] or r["netbox_duplicate_ports"] for r in results):
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+Fleet Status Report
+
+Summarizes the probe fleet in NetBox: device counts by status, tenant and
+site, how long ago devices were last updated, and proxy port usage
+(assigned, missing, duplicated).
+
+All pages of dcim/devices are fetched concurrently over the pooled
+netbox_sync client with only the fields the summary needs (`fields=`,
+NetBox 4.0+), and each page is folded into the summary as it arrives, so
+no device list is held in memory.
+
+Usage:
+    python3 fleet_report.py [--all] [--tenant SLUG] [--site SLUG] [--status active]
+    python3 fleet_report.py --oldest 20 --json
+
+Output:
+    Text tables (default) or JSON
+"""
+
+import os
+import sys
+import json
+import time
+import heapq
+import asyncio
+import logging
+import argparse
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import netbox_sync  # noqa: E402
+from netbox_sync import NetBox, choice_value  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+CUSTOM_FIELD_NAME = "automation_proxy_port"
+PROBE_DEVICE_TYPE = "network-probe"
+FIELDS = "id,name,status,tenant,site,last_updated,custom_fields"
+# Last-updated age buckets: (label, upper bound in hours)
+AGE_BUCKETS = (("<1h", 1), ("<24h", 24), ("<7d", 24 * 7), ("<30d", 24 * 30), (">=30d", None))
+
+
+def parse_time(value: Optional[str]) -> Optional[datetime]:
+    """
+    Parse a NetBox timestamp ("...Z" or with offset) as aware UTC.
+    """
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def ref_name(ref: Any) -> str:
+    """
+    Slug (or name) of a nested tenant/site reference, '-' if unset.
+    """
+    if isinstance(ref, dict):
+        return ref.get("slug") or ref.get("name") or str(ref.get("id"))
+    return "-" if ref is None else str(ref)
+
+
+class FleetSummary:
+    """
+    Streaming aggregate of device records.
+    """
+
+    def __init__(self, now: Optional[datetime] = None, oldest: int = 5):
+        self.now = now or datetime.now(timezone.utc)
+        self.total = 0
+        self.status: Counter = Counter()
+        self.tenant: Counter = Counter()
+        self.site: Counter = Counter()
+        self.age: Counter = Counter()
+        self.ports: Dict[int, List[str]] = {}
+        self.without_port = 0
+        self.oldest_count = oldest
+        # Max-heap on age via negated timestamps: keeps the N least recently updated
+        self._oldest: List = []
+
+    def add(self, device: Dict[str, Any]) -> None:
+        self.total += 1
+        self.status[choice_value(device.get("status")) or "-"] += 1
+        self.tenant[ref_name(device.get("tenant"))] += 1
+        self.site[ref_name(device.get("site"))] += 1
+
+        updated = parse_time(device.get("last_updated"))
+        if updated is None:
+            self.age["unknown"] += 1
+        else:
+            hours = (self.now - updated).total_seconds() / 3600
+            for label, bound in AGE_BUCKETS:
+                if bound is None or hours < bound:
+                    self.age[label] += 1
+                    break
+            if self.oldest_count:
+                entry = (-updated.timestamp(), device.get("name") or str(device.get("id")),
+                         updated.isoformat())
+                if len(self._oldest) < self.oldest_count:
+                    heapq.heappush(self._oldest, entry)
+                elif entry > self._oldest[0]:
+                    heapq.heapreplace(self._oldest, entry)
+
+        port = (device.get("custom_fields") or {}).get(CUSTOM_FIELD_NAME)
+        if port:
+            self.ports.setdefault(int(port), []).append(device.get("name"))
+        else:
+            self.without_port += 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        ports = sorted(self.ports)
+        return {
+            "total": self.total,
+            "by_status": dict(self.status.most_common()),
+            "by_tenant": dict(self.tenant.most_common()),
+            "by_site": dict(self.site.most_common()),
+            "last_updated_age": {label: self.age[label]
+                                 for label in [b[0] for b in AGE_BUCKETS] + ["unknown"]
+                                 if self.age[label]},
+            "oldest": [{"name": name, "last_updated": updated}
+                       for _, name, updated in sorted(self._oldest, reverse=True)],
+            "ports": {
+                "assigned": sum(len(names) for names in self.ports.values()),
+                "missing": self.without_port,
+                "lowest": ports[0] if ports else None,
+                "highest": ports[-1] if ports else None,
+                "duplicates": {port: names for port, names in sorted(self.ports.items())
+                               if len(names) > 1},
+            },
+        }
+
+
+async def run(args, transport: Optional[httpx.AsyncBaseTransport] = None) -> Dict[str, Any]:
+    """
+    Fetch every matching device page concurrently and summarize.
+
+    Returns:
+        Fleet summary with fetch timing
+    """
+    filters: Dict[str, Any] = {"fields": FIELDS, "ordering": "id"}
+    if not args.all:
+        filters["device_type"] = PROBE_DEVICE_TYPE
+    for key in ("tenant", "site", "status"):
+        if getattr(args, key):
+            filters[key] = getattr(args, key)
+
+    summary = FleetSummary(oldest=args.oldest)
+    nb = NetBox(netbox_sync.NETBOX_URL, netbox_sync.NETBOX_TOKEN,
+                connections=args.connections, transport=transport)
+    started = time.monotonic()
+    pages = 0
+    try:
+        async for page in nb.pages("dcim/devices/", **filters):
+            pages += 1
+            for device in page:
+                summary.add(device)
+    finally:
+        await nb.close()
+
+    report = summary.to_dict()
+    report["pages"] = pages
+    report["fetch_seconds"] = round(time.monotonic() - started, 3)
+    logger.info(f"Summarized {report['total']} devices from {pages} pages "
+                f"in {report['fetch_seconds']}s")
+    return report
+
+
+def print_counts(title: str, counts: Dict[str, int], limit: int) -> None:
+    """
+    Print one count table (largest first, remainder folded into "other").
+    """
+    if not counts:
+        return
+    items = list(counts.items())
+    if limit and len(items) > limit:
+        items = items[:limit] + [("(other)", sum(count for _, count in items[limit:]))]
+    width = max(len(title), *(len(str(key)) for key, _ in items))
+    print(f"{title.ljust(width)}  {'Devices':>7}")
+    for key, count in items:
+        print(f"{str(key).ljust(width)}  {count:>7}")
+    print()
+
+
+def print_report(report: Dict[str, Any], limit: int) -> None:
+    """
+    Print the fleet summary as text tables.
+    """
+    print(f"Devices: {report['total']} ({report['pages']} pages, {report['fetch_seconds']}s)\n")
+    print_counts("Status", report["by_status"], limit)
+    print_counts("Tenant", report["by_tenant"], limit)
+    print_counts("Site", report["by_site"], limit)
+    print_counts("Last updated", report["last_updated_age"], limit)
+
+    ports = report["ports"]
+    print(f"Ports: {ports['assigned']} assigned, {ports['missing']} missing, "
+          f"range {ports['lowest']}-{ports['highest']}, {len(ports['duplicates'])} duplicated")
+    for port, names in ports["duplicates"].items():
+        print(f"  {port}: {', '.join(names)}")
+
+    if report["oldest"]:
+        print("\nLeast recently updated:")
+        for device in report["oldest"]:
+            print(f"  {device['name']}  {device['last_updated']}")
+
+
+def main():
+    """
+    Main execution flow.
+    """
+    logging.basicConfig(
+        level=logging.WARNING,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+
+    parser = argparse.ArgumentParser(description="Probe fleet status summary from NetBox")
+    parser.add_argument('--all', action='store_true',
+                        help=f"All devices, not only device type {PROBE_DEVICE_TYPE}")
+    parser.add_argument('--tenant', help="Tenant slug")
+    parser.add_argument('--site', help="Site slug")
+    parser.add_argument('--status', help="Device status")
+    parser.add_argument('--oldest', type=int, default=5,
+                        help="List the N least recently updated devices")
+    parser.add_argument('--limit', type=int, default=20, help="Rows per table (0 = all)")
+    parser.add_argument('--connections', type=int, default=8, help="Concurrent NetBox requests")
+    parser.add_argument('--json', action='store_true', help="Print the summary as JSON")
+    args = parser.parse_args()
+
+    if not netbox_sync.NETBOX_URL:
+        logger.error("NETBOX_URL not configured")
+        sys.exit(1)
+
+    try:
+        report = asyncio.run(run(args))
+    except httpx.HTTPError as e:
+        logger.error(f"NetBox request failed: {e}")
+        sys.exit(1)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report, args.limit)
+
+
+if __name__ == '__main__':
+    main()
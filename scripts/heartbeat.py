@@ -0,0 +1,633 @@
+#!/usr/bin/env python3
+"""
+Probe Fleet Heartbeat
+
+Checks every probe's reverse tunnel port (automation_proxy_port) on the
+proxy concurrently with a short TCP connect timeout, then updates NetBox
+status only for probes whose state changed, in one bulk PATCH. A full
+sweep of 200+ probes takes about one connect timeout.
+
+Consecutive failures, last-seen time and connect RTT per probe persist in
+a small SQLite state file between runs. Thresholds are evaluated locally:
+
+    up                                  -> active
+    --offline-after failures (1)        -> offline
+    --decommission-after failures (3)   -> decommissioning
+
+Each sweep also records the TCP connect RTT and the SSH banner time
+(connect to the "SSH-" banner of the probe's sshd, end to end through the
+tunnel) into a fixed-size ring buffer per probe. The buffers back
+percentiles and degradation alerts: the recent median against the probe's
+own baseline, and tunnels that accept connections but return no banner.
+
+Only probes currently "active" or "offline" are moved; planned,
+decommissioning and decommissioned probes are left alone. The exception
+is a "decommissioning" the heartbeat set itself (recorded in the state):
+such a probe goes back to "active" once its tunnel answers again, while
+an operator-set status is never touched. The stale cleanup is a local
+query on the same state.
+
+Runs on the proxy, where the reverse tunnels listen; the tunnel host
+must be given (--host or HEARTBEAT_HOST, normally 127.0.0.1).
+
+Usage:
+    python3 heartbeat.py [sweep] --host 127.0.0.1 [--timeout 3] [--concurrency 256] [--dry-run]
+    python3 heartbeat.py stale --days 90 [--apply]
+    python3 heartbeat.py latency [--probe NAME]
+
+Output:
+    JSON report: counts, status changes and unreachable probes
+    (stale: probes not seen for --days, decommissioned with --apply;
+     latency: RTT and banner percentiles per probe)
+"""
+
+import os
+import sys
+import json
+import time
+import math
+import sqlite3
+import asyncio
+import logging
+import argparse
+from array import array
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import netbox_sync  # noqa: E402
+from netbox_sync import NetBox, choice_value  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+CUSTOM_FIELD_NAME = "automation_proxy_port"
+# Status changes per bulk PATCH; a sweep normally needs a single request
+PATCH_CHUNK_SIZE = 1000
+# Host the reverse tunnels listen on (127.0.0.1 when run on the proxy);
+# no default, a sweep from anywhere else would report every probe down
+HEARTBEAT_HOST = os.getenv("HEARTBEAT_HOST")
+HEARTBEAT_STATE = os.getenv("HEARTBEAT_STATE", "/var/lib/probe-heartbeat/heartbeat.db")
+MANAGED_STATUSES = ("active", "offline")
+# Statuses the stale cleanup may decommission
+STALE_STATUSES = ("offline", "decommissioning")
+# Samples kept per probe (one week of 15-minute sweeps)
+SERIES_SIZE = int(os.getenv("HEARTBEAT_SERIES_SIZE", "672"))
+# Degradation alert: median of the last RECENT_SAMPLES above
+# DEGRADED_FACTOR x the baseline median and at least DEGRADED_MIN_MS more
+RECENT_SAMPLES = 4
+DEGRADED_FACTOR = 2.0
+DEGRADED_MIN_MS = 50.0
+PERCENTILES = (50, 95, 99)
+
+
+class LatencySeries:
+    """
+    Fixed-size ring buffer of heartbeat samples for one probe.
+
+    Timestamps, connect RTTs and banner times live in preallocated
+    arrays (NaN marks a missing value), so memory and storage stay
+    constant however long the probe runs.
+    """
+
+    def __init__(self, size: int = SERIES_SIZE):
+        self.size = size
+        self.head = 0
+        self.count = 0
+        self.ts = array('d', [0.0]) * size
+        self.rtt = array('f', [math.nan]) * size
+        self.banner = array('f', [math.nan]) * size
+
+    def add(self, ts: float, rtt_ms: Optional[float], banner_ms: Optional[float]) -> None:
+        i = self.head
+        self.ts[i] = ts
+        self.rtt[i] = math.nan if rtt_ms is None else rtt_ms
+        self.banner[i] = math.nan if banner_ms is None else banner_ms
+        self.head = (i + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def values(self, column: str) -> List[float]:
+        """
+        Samples of one column ("rtt" or "banner"), oldest first.
+        """
+        data = getattr(self, column)
+        start = (self.head - self.count) % self.size
+        return [data[(start + i) % self.size] for i in range(self.count)]
+
+    def percentiles(self, column: str, points: Iterable[int] = PERCENTILES) -> Dict[str, Optional[float]]:
+        """
+        Nearest-rank percentiles of the valid samples of one column.
+        """
+        valid = sorted(v for v in self.values(column) if not math.isnan(v))
+        result = {}
+        for point in points:
+            if valid:
+                rank = max(0, math.ceil(point / 100 * len(valid)) - 1)
+                result[f"p{point}"] = round(valid[rank], 2)
+            else:
+                result[f"p{point}"] = None
+        return result
+
+    def degraded(self, column: str) -> Optional[Dict[str, float]]:
+        """
+        Compare the recent median with the baseline median of one column.
+
+        Returns:
+            Alert details, or None if not degraded (or too few samples)
+        """
+        values = [v for v in self.values(column) if not math.isnan(v)]
+        if len(values) < RECENT_SAMPLES * 2:
+            return None
+        baseline = sorted(values[:-RECENT_SAMPLES])[(len(values) - RECENT_SAMPLES) // 2]
+        recent = sorted(values[-RECENT_SAMPLES:])[RECENT_SAMPLES // 2]
+        if recent > baseline * DEGRADED_FACTOR and recent - baseline >= DEGRADED_MIN_MS:
+            return {"baseline_ms": round(baseline, 2), "recent_ms": round(recent, 2)}
+        return None
+
+    def to_row(self, name: str) -> Tuple:
+        return (name, self.size, self.head, self.count,
+                self.ts.tobytes(), self.rtt.tobytes(), self.banner.tobytes())
+
+    @classmethod
+    def from_row(cls, row) -> "LatencySeries":
+        series = cls(row["size"])
+        series.head, series.count = row["head"], row["count"]
+        series.ts = array('d', row["ts"])
+        series.rtt = array('f', row["rtt"])
+        series.banner = array('f', row["banner"])
+        return series
+
+
+class HeartbeatState:
+    """
+    Per-probe heartbeat memory between runs, in SQLite.
+
+    Keeps consecutive failures, first/last check, last seen (up) time,
+    last connect RTT, the NetBox status last written or observed, and
+    the status the heartbeat itself last wrote (set_status) while NetBox
+    still has it.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS probes (
+        name TEXT PRIMARY KEY,
+        device_id INTEGER,
+        port INTEGER,
+        failures INTEGER NOT NULL DEFAULT 0,
+        first_checked TEXT,
+        last_checked TEXT,
+        last_seen TEXT,
+        last_rtt_ms REAL,
+        status TEXT,
+        set_status TEXT
+    );
+    CREATE INDEX IF NOT EXISTS probes_last_seen ON probes (last_seen);
+    CREATE TABLE IF NOT EXISTS series (
+        name TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        head INTEGER NOT NULL,
+        count INTEGER NOT NULL,
+        ts BLOB NOT NULL,
+        rtt BLOB NOT NULL,
+        banner BLOB NOT NULL
+    );
+    """
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(self.SCHEMA)
+        columns = {row["name"] for row in self.conn.execute("PRAGMA table_info(probes)")}
+        if "set_status" not in columns:
+            # State files from before set_status was tracked
+            self.conn.execute("ALTER TABLE probes ADD COLUMN set_status TEXT")
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def load(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Return state rows by probe name.
+        """
+        return {row["name"]: dict(row) for row in self.conn.execute("SELECT * FROM probes")}
+
+    def save(self, probes: List[Dict[str, Any]]) -> None:
+        """
+        Replace the state with the probes of this sweep.
+
+        Probes that no longer exist in NetBox are dropped.
+        """
+        with self.conn:
+            self.conn.execute("DELETE FROM probes")
+            self.conn.executemany(
+                "INSERT INTO probes (name, device_id, port, failures, first_checked, "
+                "last_checked, last_seen, last_rtt_ms, status, set_status) "
+                "VALUES (:name, :id, :port, :failures, :first_checked, :last_checked, "
+                ":last_seen, :rtt_ms, :status, :set_status)",
+                probes,
+            )
+
+    def load_series(self, size: int = SERIES_SIZE) -> Dict[str, LatencySeries]:
+        """
+        Return latency series by probe name (resized buffers start over).
+        """
+        series = {}
+        for row in self.conn.execute("SELECT * FROM series"):
+            if row["size"] == size:
+                series[row["name"]] = LatencySeries.from_row(row)
+        return series
+
+    def save_series(self, series: Dict[str, LatencySeries]) -> None:
+        with self.conn:
+            self.conn.execute("DELETE FROM series")
+            self.conn.executemany(
+                "INSERT INTO series (name, size, head, count, ts, rtt, banner) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [buffer.to_row(name) for name, buffer in series.items()],
+            )
+
+    def stale(self, days: float, now: Optional[datetime] = None) -> List[Dict[str, Any]]:
+        """
+        Probes not seen up for more than days (never-seen probes count
+        from their first check).
+        """
+        cutoff = ((now or datetime.utcnow()) - timedelta(days=days)).isoformat()
+        return [dict(row) for row in self.conn.execute(
+            "SELECT * FROM probes WHERE COALESCE(last_seen, first_checked) < ? "
+            "ORDER BY COALESCE(last_seen, first_checked)", (cutoff,))]
+
+
+async def check_port(host: str, port: int, timeout: float) -> Tuple[bool, Optional[float], Optional[float]]:
+    """
+    Connect to one tunnel port and wait for the SSH banner.
+
+    Args:
+        host: Tunnel host
+        port: Tunnel port
+        timeout: Timeout (seconds) for the connect and, separately, the banner
+
+    Returns:
+        Tuple of (reachable, connect RTT in ms, banner time in ms); the
+        banner time is None when no "SSH-" line arrived in time
+    """
+    started = time.monotonic()
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False, None, None
+    rtt = (time.monotonic() - started) * 1000
+
+    banner = None
+    try:
+        line = await asyncio.wait_for(reader.readline(), timeout)
+        if line.startswith(b"SSH-"):
+            banner = (time.monotonic() - started) * 1000
+    except (OSError, asyncio.TimeoutError):
+        pass
+
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return True, rtt, banner
+
+
+async def fetch_probes(nb: NetBox) -> List[Dict[str, Any]]:
+    """
+    List probe devices that have a tunnel port assigned.
+    """
+    devices = await nb.list("dcim/devices/", **{f"cf_{CUSTOM_FIELD_NAME}__gte": 1})
+    probes = []
+    for device in devices:
+        port = (device.get("custom_fields") or {}).get(CUSTOM_FIELD_NAME)
+        if isinstance(port, int):
+            probes.append({
+                "id": device["id"],
+                "name": device["name"],
+                "port": port,
+                "status": choice_value(device.get("status")),
+            })
+    return probes
+
+
+async def sweep(probes: List[Dict[str, Any]], host: str, timeout: float,
+                concurrency: int) -> None:
+    """
+    Check every probe's tunnel port concurrently; sets "up", "rtt_ms"
+    and "banner_ms".
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def check(probe: Dict[str, Any]) -> None:
+        async with semaphore:
+            probe["up"], probe["rtt_ms"], probe["banner_ms"] = \
+                await check_port(host, probe["port"], timeout)
+
+    await asyncio.gather(*[check(probe) for probe in probes])
+
+
+def apply_results(probes: List[Dict[str, Any]], state: Dict[str, Dict[str, Any]],
+                  checked_at: str) -> None:
+    """
+    Fold this sweep's results into each probe's persisted counters.
+    """
+    for probe in probes:
+        previous = state.get(probe["name"], {})
+        probe["first_checked"] = previous.get("first_checked") or checked_at
+        probe["last_checked"] = checked_at
+        # Forget the heartbeat's own status once someone else changed it
+        set_status = previous.get("set_status")
+        probe["set_status"] = set_status if set_status == probe["status"] else None
+        if probe["up"]:
+            probe["failures"] = 0
+            probe["last_seen"] = checked_at
+        else:
+            probe["failures"] = (previous.get("failures") or 0) + 1
+            probe["last_seen"] = previous.get("last_seen")
+            probe["rtt_ms"] = previous.get("last_rtt_ms")
+
+
+def record_latency(probes: List[Dict[str, Any]], series: Dict[str, LatencySeries],
+                   ts: float) -> List[Dict[str, Any]]:
+    """
+    Append this sweep's samples to each probe's ring buffer.
+
+    Returns:
+        Alerts: "banner_missing" for tunnels that accept connections but
+        return no SSH banner, "rtt_degraded"/"banner_degraded" when the
+        recent median is well above the probe's baseline
+    """
+    alerts = []
+    current = {}
+    for probe in probes:
+        buffer = series.get(probe["name"]) or LatencySeries()
+        current[probe["name"]] = buffer
+        if not probe["up"]:
+            continue
+        buffer.add(ts, probe["rtt_ms"], probe["banner_ms"])
+        if probe["banner_ms"] is None:
+            alerts.append({"name": probe["name"], "alert": "banner_missing"})
+        for column in ("rtt", "banner"):
+            details = buffer.degraded(column)
+            if details:
+                alerts.append(dict(details, name=probe["name"], alert=f"{column}_degraded"))
+    # Drop buffers of probes that no longer exist
+    series.clear()
+    series.update(current)
+    for alert in alerts:
+        logger.warning(f"{alert['name']}: {alert['alert']}")
+    return alerts
+
+
+def latency_report(series: Dict[str, LatencySeries], name: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Percentiles per probe from the ring buffers.
+    """
+    report = []
+    for probe, buffer in sorted(series.items()):
+        if name and probe != name:
+            continue
+        report.append({
+            "name": probe,
+            "samples": buffer.count,
+            "rtt_ms": buffer.percentiles("rtt"),
+            "banner_ms": buffer.percentiles("banner"),
+        })
+    return report
+
+
+def wanted_status(probe: Dict[str, Any], offline_after: int, decommission_after: int) -> str:
+    """
+    Evaluate the thresholds for one probe.
+    """
+    if probe["up"]:
+        return "active"
+    if probe["failures"] >= decommission_after:
+        return "decommissioning"
+    if probe["failures"] >= offline_after:
+        return "offline"
+    return probe["status"]
+
+
+def is_managed(probe: Dict[str, Any]) -> bool:
+    """
+    Whether the heartbeat may change this probe's status.
+
+    Active and offline probes are always managed; a "decommissioning"
+    the heartbeat set itself is undone once the probe answers again.
+    """
+    if probe["status"] in MANAGED_STATUSES:
+        return True
+    return bool(probe["up"]) and probe["status"] == "decommissioning" \
+        and probe.get("set_status") == "decommissioning"
+
+
+def status_changes(probes: List[Dict[str, Any]], offline_after: int = 1,
+                   decommission_after: int = 3) -> List[Dict[str, Any]]:
+    """
+    Return {"id", "status"} updates for managed probes whose state changed.
+    """
+    changes = []
+    for probe in probes:
+        if not is_managed(probe):
+            continue
+        wanted = wanted_status(probe, offline_after, decommission_after)
+        if wanted != probe["status"]:
+            changes.append({"id": probe["id"], "status": wanted})
+    return changes
+
+
+async def push_statuses(nb: NetBox, probes: List[Dict[str, Any]],
+                        changes: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Bulk PATCH status changes; applied statuses are set on the probes
+    and recorded as set by the heartbeat.
+
+    Returns:
+        Failures
+    """
+    by_id = {probe["id"]: probe for probe in probes}
+    items = [(by_id[change["id"]]["name"], change) for change in changes]
+    written, failures = await nb.write("PATCH", "dcim/devices/", items)
+    by_name = {probe["name"]: probe for probe in probes}
+    for name, device in written.items():
+        by_name[name]["status"] = choice_value(device.get("status")) or by_name[name]["status"]
+        by_name[name]["set_status"] = by_name[name]["status"]
+    for item in failures:
+        logger.warning(f"{item['key']}: status update failed ({item['status']}): {item['error']}")
+    return failures
+
+
+async def run(args, transport: Optional[httpx.AsyncBaseTransport] = None) -> Dict[str, Any]:
+    """
+    One heartbeat sweep.
+
+    Returns:
+        Sweep report
+    """
+    nb = NetBox(netbox_sync.NETBOX_URL, netbox_sync.NETBOX_TOKEN,
+                chunk_size=PATCH_CHUNK_SIZE, transport=transport)
+    state = HeartbeatState(args.state)
+    try:
+        started = time.monotonic()
+        checked_at = datetime.utcnow().isoformat()
+        probes = await fetch_probes(nb)
+        await sweep(probes, args.host, args.timeout, args.concurrency)
+        swept = time.monotonic()
+
+        apply_results(probes, state.load(), checked_at)
+        series = state.load_series()
+        alerts = record_latency(probes, series, time.time())
+        changes = status_changes(probes, args.offline_after, args.decommission_after)
+        failures = []
+        if changes and not args.dry_run:
+            failures = await push_statuses(nb, probes, changes)
+        if not args.dry_run:
+            state.save(probes)
+            state.save_series(series)
+
+        names = {probe["id"]: probe["name"] for probe in probes}
+        up = [probe for probe in probes if probe["up"]]
+        report = {
+            "checked_at": checked_at,
+            "probes": len(probes),
+            "up": len(up),
+            "down": len(probes) - len(up),
+            "sweep_seconds": round(swept - started, 3),
+            "changes": [
+                {"name": names[change["id"]], "status": change["status"]} for change in changes
+            ],
+            "unreachable": sorted(
+                ({"name": probe["name"], "failures": probe["failures"], "last_seen": probe["last_seen"]}
+                 for probe in probes if not probe["up"]),
+                key=lambda probe: -probe["failures"],
+            ),
+            "alerts": alerts,
+            "failures": failures,
+        }
+        logger.info(f"{report['up']}/{report['probes']} probes up, "
+                    f"{len(changes)} status changes, sweep {report['sweep_seconds']}s")
+        return report
+    finally:
+        state.close()
+        await nb.close()
+
+
+async def run_stale(args, transport: Optional[httpx.AsyncBaseTransport] = None) -> Dict[str, Any]:
+    """
+    List (and with --apply, decommission) probes not seen for args.days.
+
+    Returns:
+        Stale report
+    """
+    state = HeartbeatState(args.state)
+    try:
+        stale = [row for row in state.stale(args.days) if row["status"] in STALE_STATUSES]
+    finally:
+        state.close()
+
+    report = {"days": args.days, "stale": stale, "decommissioned": 0, "failures": []}
+    if stale and args.apply:
+        nb = NetBox(netbox_sync.NETBOX_URL, netbox_sync.NETBOX_TOKEN,
+                    chunk_size=PATCH_CHUNK_SIZE, transport=transport)
+        try:
+            items = [(row["name"], {"id": row["device_id"], "status": "decommissioned"})
+                     for row in stale]
+            written, report["failures"] = await nb.write("PATCH", "dcim/devices/", items)
+            report["decommissioned"] = len(written)
+        finally:
+            await nb.close()
+    logger.info(f"{len(stale)} probes not seen for {args.days} days, "
+                f"{report['decommissioned']} decommissioned")
+    return report
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """
+    Parse the command line; without a subcommand, sweep.
+    """
+    parser = argparse.ArgumentParser(description="Concurrent heartbeat for the probe fleet")
+    parser.add_argument('--state', default=HEARTBEAT_STATE, help="Heartbeat state database")
+    commands = parser.add_subparsers(dest='command')
+
+    # Sweep options live only on the sweep subcommand (also used when no
+    # subcommand is given), so no default can override a given value
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--host', default=HEARTBEAT_HOST,
+                        help="Host the tunnel ports listen on (127.0.0.1 on the proxy)")
+    common.add_argument('--timeout', type=float, default=3.0, help="Connect timeout (seconds)")
+    common.add_argument('--concurrency', type=int, default=256, help="Concurrent connection checks")
+    common.add_argument('--offline-after', type=int, default=1,
+                        help="Consecutive failures before a probe is marked offline")
+    common.add_argument('--decommission-after', type=int, default=3,
+                        help="Consecutive failures before a probe is marked decommissioning")
+    common.add_argument('--dry-run', action='store_true',
+                        help="Check only, do not update NetBox or the state")
+
+    commands.add_parser('sweep', parents=[common], help="Check all tunnels (default)")
+    stale_parser = commands.add_parser('stale', help="Probes not seen for N days")
+    stale_parser.add_argument('--days', type=float, default=90)
+    stale_parser.add_argument('--apply', action='store_true',
+                              help="Mark stale probes decommissioned in NetBox")
+    latency_parser = commands.add_parser('latency', help="RTT and banner percentiles per probe")
+    latency_parser.add_argument('--probe', help="Only this probe")
+
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if not any(arg in commands.choices or arg in ('-h', '--help') for arg in argv):
+        # No subcommand: sweep, keeping --state on the top-level parser
+        state = argparse.ArgumentParser(add_help=False)
+        state.add_argument('--state')
+        known, rest = state.parse_known_args(argv)
+        argv = (['--state', known.state] if known.state else []) + ['sweep'] + rest
+    args = parser.parse_args(argv)
+    if args.command == 'sweep' and not args.host:
+        parser.error("sweep needs the tunnel host: --host or HEARTBEAT_HOST (127.0.0.1 on the proxy)")
+    return args
+
+
+def main():
+    """
+    Main execution flow.
+    """
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+
+    args = parse_args()
+
+    if args.command == 'latency':
+        state = HeartbeatState(args.state)
+        try:
+            json.dump(latency_report(state.load_series(), args.probe), sys.stdout, indent=2)
+        finally:
+            state.close()
+        sys.stdout.write('\n')
+        return
+
+    if not netbox_sync.NETBOX_URL and (args.command != 'stale' or args.apply):
+        logger.error("NETBOX_URL not configured")
+        sys.exit(1)
+
+    try:
+        if args.command == 'stale':
+            report = asyncio.run(run_stale(args))
+        else:
+            report = asyncio.run(run(args))
+    except httpx.HTTPError as e:
+        logger.error(f"NetBox error: {e}")
+        sys.exit(1)
+
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    if report["failures"]:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,562 @@
+#!/usr/bin/env python3
+"""
+Bulk NetBox Sync for Discovered Hosts
+
+Pushes parse_nmap.py output (--format hosts) to NetBox. Existing devices,
+interfaces and IP addresses are resolved with a few filtered list queries,
+then written with bulk POST/PATCH requests in chunks over a bounded async
+connection pool. Each object is synced as:
+
+    device      Discovered-<mac> (hosts with a MAC only)
+    interface   eth0 on that device
+    IP address  every IPv4/IPv6 address of the host, with its scanned
+                prefix length, in the source's VRF, on eth0
+
+IPs listed under "removed" (delta mode) are marked deprecated.
+
+NetBox bulk writes are atomic, so a failing chunk is retried object by
+object to report exactly which objects failed.
+
+Usage:
+    python3 parse_nmap.py --manifest manifest.json | python3 netbox_sync.py
+    python3 netbox_sync.py [--dry-run] [--chunk-size N] [--connections N] discovered.json
+
+Output:
+    JSON report with per-type counts and per-object failures
+    (exit code 1 if any object failed)
+"""
+
+import os
+import sys
+import json
+import asyncio
+import logging
+import argparse
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+import httpx
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+NETBOX_URL = os.getenv("NETBOX_URL")
+NETBOX_TOKEN = os.getenv("NETBOX_TOKEN")
+NETBOX_VERIFY_SSL = os.getenv("NETBOX_VERIFY_SSL", "true").lower() not in ("0", "false", "no")
+NETBOX_PAGE_SIZE = 1000
+NETBOX_FILTER_CHUNK = 100
+
+# Ensure URL has https://
+if NETBOX_URL and not NETBOX_URL.startswith("http"):
+    NETBOX_URL = f"https://{NETBOX_URL}"
+
+DEVICE_PREFIX = "Discovered-"
+INTERFACE_NAME = "eth0"
+
+
+class NetBox:
+    """
+    Minimal async NetBox REST client with bulk writes.
+    """
+
+    def __init__(self, url: str, token: Optional[str], connections: int = 8,
+                 chunk_size: int = 100, timeout: float = 30,
+                 transport: Optional[httpx.AsyncBaseTransport] = None):
+        headers = {"Accept": "application/json"}
+        if token:
+            headers["Authorization"] = f"Token {token}"
+        self.chunk_size = chunk_size
+        self._client = httpx.AsyncClient(
+            base_url=f"{url.rstrip('/')}/api/",
+            headers=headers,
+            timeout=httpx.Timeout(timeout),
+            limits=httpx.Limits(max_connections=connections,
+                                max_keepalive_connections=connections),
+            verify=NETBOX_VERIFY_SSL,
+            transport=transport,
+        )
+        self._semaphore = asyncio.Semaphore(connections)
+
+    async def close(self) -> None:
+        await self._client.aclose()
+
+    async def request(self, method: str, path: str, params: Optional[Dict[str, Any]] = None,
+                      json: Any = None) -> Any:
+        """
+        Send one API request.
+
+        Raises:
+            httpx.HTTPStatusError: On non-2xx responses
+            httpx.TransportError: On connection errors and timeouts
+        """
+        async with self._semaphore:
+            response = await self._client.request(method, path, params=params, json=json)
+        response.raise_for_status()
+        if not response.content:
+            return None
+        return response.json()
+
+    async def list(self, path: str, **filters) -> List[Dict[str, Any]]:
+        """
+        Fetch every object matching the filters (remaining pages concurrently).
+        """
+        params = dict(filters, limit=NETBOX_PAGE_SIZE, offset=0)
+        first = await self.request("GET", path, params=params)
+        results = list(first.get("results", []))
+        count = first.get("count", len(results))
+        if count > len(results):
+            pages = await asyncio.gather(*[
+                self.request("GET", path, params=dict(params, offset=offset))
+                for offset in range(NETBOX_PAGE_SIZE, count, NETBOX_PAGE_SIZE)
+            ])
+            for page in pages:
+                results.extend(page.get("results", []))
+        return results
+
+    async def pages(self, path: str, **filters) -> AsyncIterator[List[Dict[str, Any]]]:
+        """
+        Yield result pages as they arrive (remaining pages concurrently,
+        in completion order), so callers can aggregate without holding
+        every object.
+        """
+        params = dict(filters, limit=NETBOX_PAGE_SIZE, offset=0)
+        first = await self.request("GET", path, params=params)
+        yield first.get("results", [])
+        count = first.get("count", 0)
+        tasks = [
+            asyncio.ensure_future(self.request("GET", path, params=dict(params, offset=offset)))
+            for offset in range(NETBOX_PAGE_SIZE, count, NETBOX_PAGE_SIZE)
+        ]
+        try:
+            for task in asyncio.as_completed(tasks):
+                page = await task
+                yield page.get("results", [])
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def list_in(self, path: str, field: str, values, **filters) -> List[Dict[str, Any]]:
+        """
+        Fetch every object whose field matches any of the values, using
+        chunked multi-value filters.
+        """
+        values = sorted(set(values))
+        if not values:
+            return []
+        chunks = await asyncio.gather(*[
+            self.list(path, **dict(filters, **{field: values[i:i + NETBOX_FILTER_CHUNK]}))
+            for i in range(0, len(values), NETBOX_FILTER_CHUNK)
+        ])
+        return [obj for chunk in chunks for obj in chunk]
+
+    async def write(self, method: str, path: str,
+                    items: List[Tuple[str, Dict[str, Any]]]) -> Tuple[Dict[str, Dict], List[Dict]]:
+        """
+        Bulk create (POST) or update (PATCH) objects in chunks.
+
+        Args:
+            method: "POST" or "PATCH"
+            path: API list path
+            items: (key, payload) pairs; key identifies the object in reports
+
+        Returns:
+            Tuple of (written objects by key, failures)
+        """
+        chunks = await asyncio.gather(*[
+            self._write_chunk(method, path, items[i:i + self.chunk_size])
+            for i in range(0, len(items), self.chunk_size)
+        ])
+        written, failures = {}, []
+        for chunk_written, chunk_failures in chunks:
+            written.update(chunk_written)
+            failures.extend(chunk_failures)
+        return written, failures
+
+    async def _write_chunk(self, method: str, path: str,
+                           items: List[Tuple[str, Dict[str, Any]]]) -> Tuple[Dict[str, Dict], List[Dict]]:
+        try:
+            results = await self.request(method, path, json=[payload for _, payload in items])
+            return {key: obj for (key, _), obj in zip(items, results)}, []
+        except httpx.HTTPStatusError as e:
+            if len(items) == 1:
+                return {}, [failure(items[0][0], method, e.response.status_code, e.response.text)]
+        except httpx.TransportError as e:
+            return {}, [failure(key, method, None, str(e)) for key, _ in items]
+
+        # The chunk was rejected as a whole; retry one by one to find the culprits
+        singles = await asyncio.gather(*[
+            self._write_chunk(method, path, [item]) for item in items
+        ])
+        written, failures = {}, []
+        for single_written, single_failures in singles:
+            written.update(single_written)
+            failures.extend(single_failures)
+        return written, failures
+
+
+def failure(key: str, action: str, status: Optional[int], error: str) -> Dict[str, Any]:
+    """
+    Build a per-object failure record.
+    """
+    return {"key": key, "action": action, "status": status, "error": error[:500]}
+
+
+def ref_id(value: Any) -> Optional[int]:
+    """
+    Return the ID of a nested NetBox reference (or None).
+    """
+    if isinstance(value, dict):
+        return value.get("id")
+    return value
+
+
+def choice_value(value: Any) -> Any:
+    """
+    Return the value of a NetBox choice field ({"value": ..., "label": ...}).
+    """
+    if isinstance(value, dict):
+        return value.get("value")
+    return value
+
+
+def device_name(host: Dict[str, Any]) -> str:
+    """
+    Return the NetBox device name for a discovered host.
+    """
+    return f"{DEVICE_PREFIX}{host['mac'] or host['ip']}"
+
+
+def host_address(host: Dict[str, Any]) -> str:
+    """
+    Return the IPAM address (with mask) for a discovered host.
+
+    Uses the prefix length parse_nmap.py assigned from the scanned subnets,
+    falling back to a host mask.
+    """
+    prefixlen = host.get('prefixlen')
+    if prefixlen is None:
+        prefixlen = 128 if ':' in host['ip'] else 32
+    return f"{host['ip']}/{prefixlen}"
+
+
+def address_host(address: str) -> str:
+    """
+    Strip the mask from an IPAM address.
+    """
+    return address.split('/', 1)[0]
+
+
+def expand(host: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    """
+    Yield one entry per IPv4/IPv6 address of a host record.
+    """
+    addresses = host.get("addresses") or [host["ip"]]
+    prefixlens = host.get("prefixlens") or [host.get("prefixlen")] * len(addresses)
+    for address, prefixlen in zip(addresses, prefixlens):
+        yield dict(host, ip=address, prefixlen=prefixlen)
+
+
+def collect(discovery: Dict[str, Any]) -> Tuple[List[Dict], List[Dict]]:
+    """
+    Flatten parse_nmap output into per-address host and removed entries.
+
+    Only hosts with both an IP and a MAC are synced, matching the device
+    naming scheme. Every address of a host is assigned to its eth0.
+
+    Returns:
+        Tuple of (hosts, removed), each entry carrying "tenant" and "vrf"
+    """
+    hosts, removed = [], []
+    seen = set()
+    for source in discovery.get("sources", []):
+        context = {"tenant": source.get("tenant"), "vrf": source.get("vrf")}
+        for host in source.get("hosts", []):
+            if not host.get("ip") or not host.get("mac"):
+                continue
+            for entry in expand(host):
+                key = (context["vrf"], entry["ip"])
+                if key in seen:
+                    continue
+                seen.add(key)
+                hosts.append(dict(entry, **context))
+        for host in source.get("removed", []):
+            if host.get("ip") and host.get("mac"):
+                removed.extend(dict(entry, **context) for entry in expand(host))
+    return hosts, removed
+
+
+class Sync:
+    """
+    One sync run: resolve what exists, then write the difference.
+    """
+
+    def __init__(self, nb: NetBox, site: str, role: str, device_type: str,
+                 dry_run: bool = False):
+        self.nb = nb
+        self.site = site
+        self.role = role
+        self.device_type = device_type
+        self.dry_run = dry_run
+        self.report: Dict[str, Any] = {
+            "devices": {"created": 0, "updated": 0, "unchanged": 0},
+            "interfaces": {"created": 0, "unchanged": 0},
+            "ip_addresses": {"created": 0, "updated": 0, "deprecated": 0, "unchanged": 0},
+            "failures": [],
+        }
+
+    async def write(self, kind: str, counter: str, method: str, path: str,
+                    items: List[Tuple[str, Dict[str, Any]]]) -> Dict[str, Dict]:
+        """
+        Write items and record counts and failures under report[kind].
+        """
+        if not items:
+            return {}
+        if self.dry_run:
+            self.report[kind][counter] += len(items)
+            return {}
+        written, failures = await self.nb.write(method, path, items)
+        self.report[kind][counter] += len(written)
+        for item in failures:
+            item["object"] = kind
+            logger.warning(f"{kind} {item['key']}: {item['action']} failed ({item['status']}): {item['error']}")
+        self.report["failures"].extend(failures)
+        return written
+
+    def fail(self, kind: str, key: str, error: str) -> None:
+        self.report["failures"].append(dict(failure(key, "resolve", None, error), object=kind))
+
+    async def run(self, discovery: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Sync one parse_nmap result.
+
+        Returns:
+            Report with counts per object type and failures
+        """
+        hosts, removed = collect(discovery)
+        everything = hosts + removed
+
+        # Tenants and VRFs, one query each
+        tenant_rows, vrf_rows = await asyncio.gather(
+            self.nb.list_in("tenancy/tenants/", "slug", {h["tenant"] for h in everything if h["tenant"]}),
+            self.nb.list_in("ipam/vrfs/", "name", {h["vrf"] for h in everything if h["vrf"]}),
+        )
+        tenants = {row["slug"]: row["id"] for row in tenant_rows}
+        vrfs = {row["name"]: row["id"] for row in vrf_rows}
+
+        def resolve(host: Dict[str, Any]) -> bool:
+            if host["tenant"] and host["tenant"] not in tenants:
+                self.fail("ip_address", host["ip"], f"unknown tenant {host['tenant']}")
+                return False
+            if host["vrf"] and host["vrf"] not in vrfs:
+                self.fail("ip_address", host["ip"], f"unknown VRF {host['vrf']}")
+                return False
+            host["tenant_id"] = tenants.get(host["tenant"])
+            host["vrf_id"] = vrfs.get(host["vrf"])
+            return True
+
+        hosts = [host for host in hosts if resolve(host)]
+        removed = [host for host in removed if resolve(host)]
+
+        interfaces = await self.sync_devices(hosts)
+        await self.sync_ip_addresses(hosts, removed, interfaces)
+        return self.report
+
+    async def sync_devices(self, hosts: List[Dict[str, Any]]) -> Dict[str, int]:
+        """
+        Create or update devices and their eth0 interfaces.
+
+        Returns:
+            Interface IDs by device name
+        """
+        wanted = {}
+        for host in hosts:
+            wanted.setdefault(device_name(host), host)
+
+        existing = {
+            device["name"]: device
+            for device in await self.nb.list_in("dcim/devices/", "name", wanted)
+        }
+
+        creates, updates = [], []
+        for name, host in wanted.items():
+            device = existing.get(name)
+            if device is None:
+                data = {
+                    "name": name,
+                    "role": {"slug": self.role},
+                    "device_type": {"slug": self.device_type},
+                    "site": {"slug": self.site},
+                    "status": "active",
+                }
+                if host["tenant_id"]:
+                    data["tenant"] = host["tenant_id"]
+                creates.append((name, data))
+            elif (ref_id(device.get("tenant")) != host["tenant_id"]
+                  or choice_value(device.get("status")) != "active"):
+                updates.append((name, {"id": device["id"], "tenant": host["tenant_id"],
+                                       "status": "active"}))
+            else:
+                self.report["devices"]["unchanged"] += 1
+
+        created, _ = await asyncio.gather(
+            self.write("devices", "created", "POST", "dcim/devices/", creates),
+            self.write("devices", "updated", "PATCH", "dcim/devices/", updates),
+        )
+        device_ids = {name: device["id"] for name, device in existing.items()}
+        device_ids.update({name: device["id"] for name, device in created.items()})
+
+        # eth0 on every synced device
+        names_by_id = {device_id: name for name, device_id in device_ids.items()}
+        interfaces = {}
+        if existing:
+            for iface in await self.nb.list_in("dcim/interfaces/", "device_id",
+                                               [device_ids[name] for name in existing],
+                                               name=INTERFACE_NAME):
+                name = names_by_id.get(ref_id(iface.get("device")))
+                if name:
+                    interfaces[name] = iface["id"]
+        self.report["interfaces"]["unchanged"] += len(interfaces)
+
+        iface_creates = [
+            (name, {"device": device_id, "name": INTERFACE_NAME, "type": "other"})
+            for name, device_id in device_ids.items()
+            if name not in interfaces
+        ]
+        created_ifaces = await self.write("interfaces", "created", "POST", "dcim/interfaces/", iface_creates)
+        interfaces.update({name: iface["id"] for name, iface in created_ifaces.items()})
+        return interfaces
+
+    async def sync_ip_addresses(self, hosts: List[Dict[str, Any]], removed: List[Dict[str, Any]],
+                                interfaces: Dict[str, int]) -> None:
+        """
+        Create, update or deprecate IP addresses, per VRF.
+        """
+        by_vrf: Dict[Optional[int], List[str]] = {}
+        for host in hosts + removed:
+            by_vrf.setdefault(host["vrf_id"], []).append(host["ip"])
+
+        lookups = await asyncio.gather(*[
+            self.nb.list_in("ipam/ip-addresses/", "address", ips,
+                            vrf_id=vrf_id if vrf_id is not None else "null")
+            for vrf_id, ips in by_vrf.items()
+        ])
+        existing = {}
+        for vrf_id, rows in zip(by_vrf, lookups):
+            for row in rows:
+                existing[(vrf_id, address_host(row["address"]))] = row
+
+        creates, updates, deprecations = [], [], []
+        for host in hosts:
+            name = device_name(host)
+            iface_id = interfaces.get(name)
+            if iface_id is None and not self.dry_run:
+                self.fail("ip_address", host["ip"], f"device {name} was not synced")
+                continue
+
+            data = {
+                "address": host_address(host),
+                "status": "active",
+                "vrf": host["vrf_id"],
+                "tenant": host["tenant_id"],
+                "dns_name": host.get("hostname") or "",
+                "assigned_object_type": "dcim.interface",
+                "assigned_object_id": iface_id,
+            }
+            row = existing.get((host["vrf_id"], host["ip"]))
+            if row is None:
+                creates.append((host["ip"], data))
+                continue
+
+            current = {
+                "address": row.get("address"),
+                "status": choice_value(row.get("status")),
+                "vrf": ref_id(row.get("vrf")),
+                "tenant": ref_id(row.get("tenant")),
+                "dns_name": row.get("dns_name") or "",
+                "assigned_object_type": row.get("assigned_object_type"),
+                "assigned_object_id": row.get("assigned_object_id"),
+            }
+            changes = {key: value for key, value in data.items() if current[key] != value}
+            if changes:
+                updates.append((host["ip"], dict(changes, id=row["id"])))
+            else:
+                self.report["ip_addresses"]["unchanged"] += 1
+
+        for host in removed:
+            row = existing.get((host["vrf_id"], host["ip"]))
+            if row is not None and choice_value(row.get("status")) != "deprecated":
+                deprecations.append((host["ip"], {"id": row["id"], "status": "deprecated"}))
+
+        await asyncio.gather(
+            self.write("ip_addresses", "created", "POST", "ipam/ip-addresses/", creates),
+            self.write("ip_addresses", "updated", "PATCH", "ipam/ip-addresses/", updates),
+            self.write("ip_addresses", "deprecated", "PATCH", "ipam/ip-addresses/", deprecations),
+        )
+
+
+async def run(discovery: Dict[str, Any], args, transport: Optional[httpx.AsyncBaseTransport] = None) -> Dict[str, Any]:
+    """
+    Sync parse_nmap output to NetBox.
+
+    Returns:
+        Sync report
+    """
+    nb = NetBox(NETBOX_URL, NETBOX_TOKEN, connections=args.connections,
+                chunk_size=args.chunk_size, transport=transport)
+    try:
+        sync = Sync(nb, site=args.site, role=args.role, device_type=args.device_type,
+                    dry_run=args.dry_run)
+        return await sync.run(discovery)
+    finally:
+        await nb.close()
+
+
+def main():
+    """
+    Main execution flow.
+    """
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+
+    parser = argparse.ArgumentParser(description="Bulk sync parse_nmap output to NetBox")
+    parser.add_argument('input', nargs='?', default='-',
+                        help="parse_nmap.py JSON (--format hosts); '-' for stdin")
+    parser.add_argument('--site', default='remote-site', help="Site slug for new devices")
+    parser.add_argument('--role', default='discovered', help="Device role slug")
+    parser.add_argument('--device-type', default='generic-host', help="Device type slug")
+    parser.add_argument('--chunk-size', type=int, default=100,
+                        help="Objects per bulk request")
+    parser.add_argument('--connections', type=int, default=8,
+                        help="Concurrent NetBox connections")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="Resolve and count changes without writing")
+    args = parser.parse_args()
+
+    if not NETBOX_URL:
+        logger.error("NETBOX_URL not configured")
+        sys.exit(1)
+
+    if args.input == '-':
+        discovery = json.load(sys.stdin)
+    else:
+        with open(args.input) as f:
+            discovery = json.load(f)
+
+    try:
+        report = asyncio.run(run(discovery, args))
+    except httpx.HTTPError as e:
+        logger.error(f"NetBox error: {e}")
+        sys.exit(1)
+
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    if report["failures"]:
+        logger.error(f"{len(report['failures'])} objects failed to sync")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,85 +3,244 @@
 Parse Nmap XML Output for NetBox IPAM Sync
 
 This script parses nmap XML output and outputs JSON formatted data
-for importing discovered IP addresses into NetBox.
+for importing discovered IP addresses into NetBox. Hosts are streamed
+with iterparse, so memory stays flat even for /16-sized scans.
+
+It is also importable (parse_nmap_xml, format_for_netbox, parse_source)
+and can parse many scan files in one run, spread over a process pool.
+Workers spool each file's entries to a temporary NDJSON file and hand
+back only a summary, so the multi-file path streams as well.
 
 Usage:
     python3 parse_nmap.py <scan.xml> <tenant_slug>
+    python3 parse_nmap.py [--format hosts|netbox] [--jobs N] [--tenant SLUG]
+                          [--manifest manifest.json] [scan.xml[=tenant] ...]
 
 Output:
     JSON array of discovered hosts with IP addresses, MACs, and hostnames
+    (multi-file mode: one entry per scan file under "sources")
+
+Manifest:
+    JSON list of {"file": ..., "source": ..., "tenant": ..., "vrf": ...,
+    "subnets": [...]}; source defaults to the file name without "_scan.xml".
+
+Compact scan files:
+    Besides nmap XML, any input may be a compact scan file (*.ndjson,
+    *.ndjson.gz, or *.ndjson.zst with the zstandard module) as written
+    on the probe by probe_scan.py: a header line with the nmap args and
+    field names, then one JSON array per host.
+
+History:
+    With --history DB, every parsed host is also appended to a SQLite
+    scan history (see scan_history.py) before any delta is computed.
+
+Prefixes:
+    Each host gets the mask of the most specific scanned subnet containing
+    it. Subnets come from the nmap command line recorded in the XML plus
+    any passed in (--subnet or the manifest); hosts outside all of them
+    get a host mask (/32 or /128).
+
+Delta sync:
+    With --state-dir, each tenant/VRF keeps a snapshot of the last synced
+    hosts and only added or changed hosts are emitted (plus "removed").
+    The new snapshot is staged as *.pending and only replaces the old one
+    after the sync succeeded:
+        python3 parse_nmap.py --state-dir DIR --manifest manifest.json
+        ... push the delta to NetBox ...
+        python3 parse_nmap.py --state-dir DIR --commit-state
 """
 
+import os
+import re
 import sys
+import glob
 import json
 import logging
+import argparse
+import gzip
+import bisect
+import tempfile
+import ipaddress
 import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from typing import Dict, List, Optional
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, TextIO
+
+try:
+    import zstandard
+except ImportError:  # optional, gzip is always available
+    zstandard = None
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
 logger = logging.getLogger(__name__)
 
 
-def parse_nmap_xml(xml_file: str) -> List[Dict]:
+class Host:
     """
-    Parse nmap XML output and extract discovered hosts.
+    Compact record for one discovered host.
+
+    Uses __slots__ so large scans do not pay for a dict per host, while
+    still supporting the mapping access (host['ip'], host.get(...),
+    dict(host)) the rest of the pipeline uses.
+
+    Attributes:
+        ip: Primary address (first IPv4, else first IPv6)
+        mac: MAC address
+        hostname: First hostname
+        status: nmap host state
+        vendor: MAC vendor
+        prefixlen: Mask length of the primary address
+        addresses: Every IPv4/IPv6 address, primary first
+        prefixlens: Mask length per entry of addresses
+        hostnames: (name, type) pairs, e.g. ("gw.lan", "PTR")
+        ports: (protocol, port, state, service, product, version) per open port
+    """
+
+    FIELDS = ('ip', 'mac', 'hostname', 'status', 'vendor', 'prefixlen',
+              'addresses', 'prefixlens', 'hostnames', 'ports')
+    __slots__ = FIELDS
+
+    def __init__(self, **values):
+        for field in self.FIELDS:
+            setattr(self, field, values.get(field))
+
+    def keys(self):
+        return self.FIELDS
+
+    def __getitem__(self, key: str):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __setitem__(self, key: str, value) -> None:
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def get(self, key: str, default=None):
+        return getattr(self, key, default) if key in self.FIELDS else default
+
+    def to_dict(self) -> Dict:
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def __repr__(self) -> str:
+        return f"Host({self.ip!r}, mac={self.mac!r})"
+
+
+def to_json(obj):
+    """
+    json.dumps default hook for Host records.
+    """
+    if isinstance(obj, Host):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def parse_host(host) -> Optional[Host]:
+    """
+    Extract one discovered host from an nmap <host> element.
 
     Args:
-        xml_file: Path to nmap XML file
+        host: <host> element
 
     Returns:
-        List of discovered hosts with IP, MAC, and hostname
+        Host record with every address, hostname and open port, or None
+        if the host is not up or has no address
     """
-    try:
-        tree = ET.parse(xml_file)
-        root = tree.getroot()
-
-        hosts = []
-
-        for host in root.findall('.//host'):
-            host_info = {
-                'ip': None,
-                'mac': None,
-                'hostname': None,
-                'status': None,
-                'vendor': None
-            }
-
-            # Get host status
-            status_elem = host.find('status')
-            if status_elem is not None:
-                host_info['status'] = status_elem.get('state')
+    status = None
+    mac = None
+    vendor = None
+    ipv4 = []
+    ipv6 = []
+    hostnames = []
+    ports = []
+
+    # Single pass over the children instead of one path search per field
+    for child in host:
+        tag = child.tag
+        if tag == 'status':
+            status = child.get('state')
+        elif tag == 'address':
+            addrtype = child.get('addrtype')
+            if addrtype == 'ipv4':
+                ipv4.append(child.get('addr'))
+            elif addrtype == 'ipv6':
+                ipv6.append(child.get('addr'))
+            elif addrtype == 'mac' and mac is None:
+                mac = child.get('addr')
+                vendor = child.get('vendor')
+        elif tag == 'hostnames':
+            for hostname in child:
+                if hostname.tag == 'hostname':
+                    hostnames.append((hostname.get('name'), hostname.get('type')))
+        elif tag == 'ports':
+            for port in child:
+                if port.tag != 'port':
+                    continue
+                state = port.find('state')
+                state = state.get('state') if state is not None else None
+                if not state or not state.startswith('open'):
+                    continue
+                service = port.find('service')
+                if service is None:
+                    service = {}
+                ports.append((port.get('protocol'), int(port.get('portid')), state,
+                              service.get('name'), service.get('product'),
+                              service.get('version')))
+
+    if status != 'up':
+        return None
+
+    addresses = ipv4 + ipv6
+    # Only keep if we have at least an IP or MAC
+    if not addresses and not mac:
+        return None
+
+    return Host(
+        ip=addresses[0] if addresses else None,
+        mac=mac,
+        hostname=hostnames[0][0] if hostnames else None,
+        status=status,
+        vendor=vendor,
+        addresses=addresses,
+        hostnames=hostnames,
+        ports=ports,
+    )
+
+
+def parse_nmap_xml(xml_file: str) -> Iterator[Dict]:
+    """
+    Stream discovered hosts from nmap XML output.
 
-            if host_info['status'] != 'up':
-                continue
+    Uses iterparse and clears each <host> element once it has been read,
+    so memory stays flat regardless of scan size.
 
-            # Get IP address
-            address = host.find('.//address[@addrtype="ipv4"]')
-            if address is not None:
-                host_info['ip'] = address.get('addr')
+    Args:
+        xml_file: Path to nmap XML file
 
-            # Get MAC address
-            mac = host.find('.//address[@addrtype="mac"]')
-            if mac is not None:
-                host_info['mac'] = mac.get('addr')
-                host_info['vendor'] = mac.get('vendor')
+    Yields:
+        Discovered Host records
+    """
+    count = 0
+    root = None
+    try:
+        for event, elem in ET.iterparse(xml_file, events=('start', 'end')):
+            if root is None:
+                root = elem
+            if event != 'end' or elem.tag != 'host':
+                continue
 
-            # Get hostname
-            hostname = host.find('.//hostname')
-            if hostname is not None:
-                host_info['hostname'] = hostname.get('name')
+            host_info = parse_host(elem)
+            # Drop the finished element and its siblings already read
+            elem.clear()
+            root.clear()
 
-            # Only add if we have at least an IP or MAC
-            if host_info['ip'] or host_info['mac']:
-                hosts.append(host_info)
+            if host_info:
+                count += 1
+                yield host_info
 
-        logger.info(f"Parsed {len(hosts)} hosts from {xml_file}")
-        return hosts
+        logger.info(f"Parsed {count} hosts from {xml_file}")
 
     except ET.ParseError as e:
         logger.error(f"Error parsing XML: {e}")
@@ -91,74 +250,760 @@ def parse_nmap_xml(xml_file: str) -> List[Dict]:
         raise
 
 
-def format_for_netbox(hosts: List[Dict], tenant_slug: str) -> List[Dict]:
+COMPACT_FORMAT = 'probe-scan/1'
+COMPACT_SUFFIXES = ('.ndjson', '.ndjson.gz', '.ndjson.zst')
+
+
+def is_compact(path: str) -> bool:
+    """
+    Return True for compact scan files (by extension).
+    """
+    return path.endswith(COMPACT_SUFFIXES)
+
+
+def open_text(path: str, mode: str = 'rt') -> TextIO:
+    """
+    Open a text file, compressed according to its extension (.gz, .zst).
+
+    Raises:
+        ValueError: For .zst files when zstandard is not installed
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, mode, compresslevel=6, encoding='utf-8')
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise ValueError(f"zstandard is not installed, cannot open {path}")
+        return zstandard.open(path, mode, encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+class CompactWriter:
+    """
+    Write hosts as a compact scan file.
+
+    The first line is a header with the nmap args and the field names;
+    each following line is one host as a JSON array in that field order.
+    """
+
+    def __init__(self, stream: TextIO, args: str = ''):
+        self.stream = stream
+        self.count = 0
+        header = {'format': COMPACT_FORMAT, 'args': args, 'fields': Host.FIELDS}
+        stream.write(json.dumps(header) + '\n')
+
+    def write(self, host: Host) -> None:
+        row = [host[field] for field in Host.FIELDS]
+        self.stream.write(json.dumps(row, separators=(',', ':')) + '\n')
+        self.count += 1
+
+
+def read_compact_header(path: str) -> Dict:
+    """
+    Read the header line of a compact scan file.
+
+    Raises:
+        ValueError: If the file is not a compact scan file
+    """
+    with open_text(path) as f:
+        header = json.loads(f.readline() or 'null')
+    if not isinstance(header, dict) or header.get('format') != COMPACT_FORMAT:
+        raise ValueError(f"Not a compact scan file: {path}")
+    return header
+
+
+def read_compact(path: str) -> Iterator[Host]:
+    """
+    Stream Host records from a compact scan file.
+
+    Args:
+        path: Path to a compact scan file
+
+    Yields:
+        Discovered Host records
+    """
+    count = 0
+    with open_text(path) as f:
+        header = json.loads(f.readline() or 'null')
+        if not isinstance(header, dict) or header.get('format') != COMPACT_FORMAT:
+            raise ValueError(f"Not a compact scan file: {path}")
+        fields = header['fields']
+        for line in f:
+            if not line.strip():
+                continue
+            count += 1
+            yield Host(**dict(zip(fields, json.loads(line))))
+
+    logger.info(f"Read {count} hosts from {path}")
+
+
+def read_hosts(path: str) -> Iterator[Host]:
+    """
+    Stream Host records from nmap XML or a compact scan file.
+    """
+    if is_compact(path):
+        return read_compact(path)
+    return parse_nmap_xml(path)
+
+
+class PrefixIndex:
+    """
+    Sorted interval index mapping addresses to their scanned prefix.
+
+    Nested prefixes are flattened into disjoint segments, each owned by the
+    most specific prefix covering it, so a lookup is one bisect per host.
+    """
+
+    def __init__(self, subnets: Iterable[str] = ()):
+        networks = set()
+        for subnet in subnets:
+            try:
+                networks.add(ipaddress.ip_network(subnet, strict=False))
+            except ValueError:
+                logger.warning(f"Ignoring invalid subnet: {subnet}")
+        self.networks = sorted(networks, key=lambda n: (n.version, n.network_address, n.prefixlen))
+        # Per IP version: segment starts, and (end, network) per segment
+        self._starts: Dict[int, List[int]] = {4: [], 6: []}
+        self._segments: Dict[int, List] = {4: [], 6: []}
+        for version in (4, 6):
+            self._build(version, [n for n in self.networks if n.version == version])
+
+    def _build(self, version: int, networks: List) -> None:
+        starts, segments = self._starts[version], self._segments[version]
+
+        def emit(start: int, end: int, network) -> None:
+            if start <= end:
+                starts.append(start)
+                segments.append((end, network))
+
+        # CIDR blocks either nest or are disjoint; sweep them in order with
+        # a stack of the enclosing prefixes
+        stack = []
+        cursor = 0
+        for network in networks:
+            start = int(network.network_address)
+            while stack and int(stack[-1].broadcast_address) < start:
+                top = stack.pop()
+                emit(cursor, int(top.broadcast_address), top)
+                cursor = int(top.broadcast_address) + 1
+            if stack:
+                emit(cursor, start - 1, stack[-1])
+            stack.append(network)
+            cursor = start
+        while stack:
+            top = stack.pop()
+            emit(cursor, int(top.broadcast_address), top)
+            cursor = int(top.broadcast_address) + 1
+
+    def __len__(self) -> int:
+        return len(self.networks)
+
+    def lookup(self, ip: str):
+        """
+        Return the most specific prefix containing ip, or None.
+        """
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        value = int(address)
+        starts = self._starts[address.version]
+        i = bisect.bisect_right(starts, value) - 1
+        if i < 0:
+            return None
+        end, network = self._segments[address.version][i]
+        return network if value <= end else None
+
+    def prefixlen(self, ip: str) -> int:
+        """
+        Return the mask length for ip (host mask if no prefix contains it).
+        """
+        network = self.lookup(ip)
+        if network is not None:
+            return network.prefixlen
+        return 128 if ':' in ip else 32
+
+
+def scan_subnets(xml_file: str) -> List[str]:
+    """
+    Read the CIDR targets from the nmap command line stored in the scan.
+
+    Only the <nmaprun> start tag (or the compact file header) is read.
+    Non-CIDR targets (single hosts, ranges, hostnames) are skipped.
+
+    Args:
+        xml_file: Path to nmap XML or compact scan file
+
+    Returns:
+        CIDR strings from the "args" attribute
+    """
+    if is_compact(xml_file):
+        args = read_compact_header(xml_file).get('args', '')
+    else:
+        for _, elem in ET.iterparse(xml_file, events=('start',)):
+            args = elem.get('args', '') if elem.tag == 'nmaprun' else ''
+            break
+        else:
+            return []
+
+    subnets = []
+    for token in args.split():
+        if '/' not in token or token.startswith(('-', '/')):
+            continue
+        try:
+            subnets.append(str(ipaddress.ip_network(token, strict=False)))
+        except ValueError:
+            continue
+    return subnets
+
+
+def assign_prefixes(hosts: Iterable[Dict], prefixes: PrefixIndex) -> Iterator[Dict]:
+    """
+    Set "prefixlens" (per address) and "prefixlen" (primary address) on
+    each host from the prefix index.
+    """
+    for host in hosts:
+        addresses = host.get('addresses') or ([host['ip']] if host['ip'] else [])
+        host['prefixlens'] = [prefixes.prefixlen(address) for address in addresses]
+        if host['prefixlens']:
+            host['prefixlen'] = host['prefixlens'][0]
+        yield host
+
+
+def format_for_netbox(hosts: Iterable[Dict], tenant_slug: str,
+                      prefixes: Optional[PrefixIndex] = None) -> Iterator[Dict]:
     """
     Format discovered hosts for NetBox IPAM import.
 
     Args:
-        hosts: List of discovered hosts
+        hosts: Discovered hosts (any iterable, consumed lazily)
         tenant_slug: Tenant identifier for NetBox
+        prefixes: Scanned prefixes, used for hosts without "prefixlens"
 
-    Returns:
-        Formatted list for NetBox API
+    Yields:
+        Formatted entries for NetBox API, one per IPv4/IPv6 address
     """
-    formatted = []
+    count = 0
+    prefixes = prefixes or PrefixIndex()
 
     for host in hosts:
         # Skip hosts with no IP address (can't create IPAM entry)
-        if not host['ip']:
+        addresses = host.get('addresses') or ([host['ip']] if host['ip'] else [])
+        if not addresses:
             continue
+        prefixlens = host.get('prefixlens') or [prefixes.prefixlen(address) for address in addresses]
 
-        entry = {
-            'address': f"{host['ip']}/24",  # Assume /24 for now
-            'tenant': tenant_slug,
-            'status': 'active',
-            'description': f"Discovered via probe scan"
-        }
+        description = "Discovered via probe scan"
+        if host['mac']:
+            description += f" (MAC: {host['mac']})"
+        if host['vendor']:
+            description += f" [{host['vendor']}]"
+
+        for address, prefixlen in zip(addresses, prefixlens):
+            entry = {
+                'address': f"{address}/{prefixlen}",
+                'tenant': tenant_slug,
+                'status': 'active',
+                'description': description
+            }
 
-        if host['hostname']:
-            entry['dns_name'] = host['hostname']
+            if host['hostname']:
+                entry['dns_name'] = host['hostname']
 
-        if host['mac']:
-            entry['description'] += f" (MAC: {host['mac']})"
+            count += 1
+            yield entry
 
-        if host['vendor']:
-            entry['description'] += f" [{host['vendor']}]"
+    logger.info(f"Formatted {count} addresses for NetBox")
 
-        formatted.append(entry)
 
-    logger.info(f"Formatted {len(formatted)} hosts for NetBox")
-    return formatted
+class Counter:
+    """
+    Pass-through iterator that counts the items it yields.
+    """
 
+    def __init__(self, items: Iterable):
+        self._items = iter(items)
+        self.count = 0
 
-def main():
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = next(self._items)
+        self.count += 1
+        return item
+
+
+def write_json(output: Dict, hosts: Iterable[Dict], stream: TextIO,
+               count_key: Optional[str] = None, counter: Optional[Counter] = None) -> None:
     """
-    Main execution flow.
+    Write a JSON document whose 'hosts' array is streamed from an iterable.
+
+    Args:
+        output: Top-level fields written before the hosts array
+        hosts: Host entries, written one at a time
+        stream: Output stream
+        count_key: Optional key written after the array with counter.count
+        counter: Counter whose final count is written under count_key
     """
-    if len(sys.argv) < 3:
-        print(f"Usage: {sys.argv[0]} <scan.xml> <tenant_slug>", file=sys.stderr)
-        sys.exit(1)
+    stream.write('{\n')
+    for key, value in output.items():
+        stream.write(f'  {json.dumps(key)}: {json.dumps(value)},\n')
+    stream.write('  "hosts": [')
+    first = True
+    for entry in hosts:
+        stream.write('\n    ' if first else ',\n    ')
+        stream.write(json.dumps(entry))
+        first = False
+    stream.write('\n  ]' if not first else ']')
+    if count_key and counter is not None:
+        stream.write(f',\n  {json.dumps(count_key)}: {counter.count}')
+    stream.write('\n}\n')
+
+
+def source_name(xml_file: str) -> str:
+    """
+    Derive a source (scanned host) name from a scan file name.
+
+    "/tmp/discovery/probe-01_scan.xml" -> "probe-01"
+    "/tmp/discovery/probe-01_scan.ndjson.gz" -> "probe-01"
+    """
+    name = Path(xml_file).name
+    for ext in ('.xml',) + COMPACT_SUFFIXES:
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+            return name[:-len('_scan')] if name.endswith('_scan') else name
+    return name
+
+
+class SpooledHosts:
+    """
+    A source's entries spooled to an NDJSON file by a parse worker.
+
+    Only the path and count cross the process boundary. Every iteration
+    streams the file again, so history, delta and output can each walk
+    the entries without holding them in memory.
+    """
+
+    def __init__(self, path: str, count: int):
+        self.path = path
+        self.count = count
 
-    xml_file = sys.argv[1]
-    tenant_slug = sys.argv[2]
+    def __len__(self) -> int:
+        return self.count
 
+    def __iter__(self) -> Iterator[Dict]:
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                yield json.loads(line)
+
+    def remove(self) -> None:
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def parse_source(source: Dict) -> Dict:
+    """
+    Parse one scan file into a per-source result.
+
+    Module-level so it can run in a worker process.
+
+    Args:
+        source: Dict with "file", "source", "tenant", optional "vrf",
+                "subnets", "format" ("hosts" for raw records, "netbox"
+                for IPAM entries) and "spool_dir" (spool entries to a
+                file there instead of returning them as a list)
+
+    Returns:
+        Source metadata with "discovered_count" and "hosts" (a list, or
+        SpooledHosts with spool_dir), or "error"
+    """
+    result = {key: source.get(key) for key in ('source', 'file', 'tenant', 'vrf')}
+    spool_dir = source.get('spool_dir')
+    path = None
     try:
-        # Parse nmap XML
-        hosts = parse_nmap_xml(xml_file)
+        prefixes = PrefixIndex((source.get('subnets') or []) + scan_subnets(source['file']))
+        hosts = Counter(assign_prefixes(read_hosts(source['file']), prefixes))
+        entries = hosts
+        if source.get('format') == 'netbox':
+            entries = format_for_netbox(hosts, source.get('tenant'))
+
+        if spool_dir is None:
+            entries = list(entries)
+        else:
+            fd, path = tempfile.mkstemp(dir=spool_dir, suffix='.ndjson',
+                                        prefix=re.sub(r'[^A-Za-z0-9_.-]', '_', result['source'] or 'scan') + '-')
+            count = 0
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                for entry in entries:
+                    f.write(json.dumps(entry, default=to_json, separators=(',', ':')) + '\n')
+                    count += 1
+            entries = SpooledHosts(path, count)
+    except (ET.ParseError, OSError, ValueError) as e:
+        if path:
+            SpooledHosts(path, 0).remove()
+        result['error'] = str(e)
+        return result
+
+    result['discovered_count'] = hosts.count
+    result['hosts'] = entries
+    return result
+
+
+def parse_sources(sources: List[Dict], jobs: Optional[int] = None,
+                  spool_dir: Optional[str] = None) -> Iterator[Dict]:
+    """
+    Parse many scan files, spread over a process pool.
+
+    Args:
+        sources: Source dicts (see parse_source)
+        jobs: Worker processes (default: one per CPU, capped at len(sources))
+        spool_dir: Directory for the per-source NDJSON spools; the caller
+                   removes it once the results are consumed. Without it,
+                   every source's entries are returned (and pickled) as lists
+
+    Yields:
+        Per-source results, in the order of sources
+    """
+    if spool_dir is not None:
+        sources = [dict(source, spool_dir=spool_dir) for source in sources]
+    jobs = min(jobs or os.cpu_count() or 1, len(sources))
+    if jobs <= 1:
+        for source in sources:
+            yield parse_source(source)
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        yield from pool.map(parse_source, sources)
+
+
+def load_sources(args) -> List[Dict]:
+    """
+    Build the source list from the manifest and FILE[=TENANT] arguments.
+    """
+    sources = []
+    if args.manifest:
+        with open(args.manifest) as f:
+            sources.extend(json.load(f))
+    for item in args.files:
+        xml_file, _, tenant = item.partition('=')
+        sources.append({'file': xml_file, 'tenant': tenant or None})
+
+    for source in sources:
+        source['subnets'] = list(source.get('subnets') or []) + (args.subnet or [])
+        if not source.get('source'):
+            source['source'] = source_name(source['file'])
+        if not source.get('tenant'):
+            source['tenant'] = args.tenant
+        source['format'] = args.format
+    return sources
+
+
+# Host fields compared between runs; a difference in any of them is a change
+SNAPSHOT_FIELDS = ('mac', 'hostname', 'vendor', 'prefixlen', 'addresses')
+PENDING_SUFFIX = '.pending'
+
+
+def snapshot_path(state_dir: str, tenant: Optional[str], vrf: Optional[str]) -> str:
+    """
+    Return the snapshot file for a tenant/VRF pair.
+    """
+    name = f"{tenant or '_'}__{vrf or '_'}"
+    name = re.sub(r'[^A-Za-z0-9_.-]', '_', name)
+    return os.path.join(state_dir, f"{name}.json")
+
+
+def load_snapshot(path: str) -> Dict[str, Dict]:
+    """
+    Load a sync snapshot ({ip: {mac, hostname, vendor, source}}).
+
+    Returns:
+        Snapshot, or an empty dict if there is none yet
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_atomic(path: str, data: Dict) -> None:
+    """
+    Write JSON to path via a temporary file and rename.
+    """
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(data, f, separators=(',', ':'))
+    os.replace(tmp, path)
 
-        # Format for NetBox
-        formatted = format_for_netbox(hosts, tenant_slug)
 
-        # Output JSON
-        output = {
-            'tenant': tenant_slug,
-            'scan_timestamp': datetime.utcnow().isoformat(),
-            'discovered_count': len(hosts),
-            'hosts': formatted
-        }
+def compute_delta(results: List[Dict], state_dir: str) -> Dict[str, Dict]:
+    """
+    Reduce per-source results to the changes since the last synced run.
+
+    Sources are grouped by tenant/VRF and compared against that group's
+    snapshot. Each result's "hosts" is replaced by the hosts that were
+    added or changed (tagged with "change"), and "removed" lists the
+    snapshot hosts that a source saw last time but not in this run.
+    Hosts last seen by a source that did not run are left alone.
 
-        print(json.dumps(output, indent=2))
+    Args:
+        results: Parsed per-source results (raw host records), updated in place
+        state_dir: Directory holding the snapshots
 
+    Returns:
+        New snapshots to stage, keyed by snapshot path
+    """
+    groups: Dict[str, List[Dict]] = {}
+    for result in results:
+        if 'error' not in result:
+            path = snapshot_path(state_dir, result['tenant'], result['vrf'])
+            groups.setdefault(path, []).append(result)
+
+    snapshots = {}
+    for path, group in groups.items():
+        previous = load_snapshot(path)
+        current = {}
+        for result in group:
+            delta = []
+            for host in result['hosts']:
+                ip = host['ip']
+                if not ip or ip in current:
+                    continue
+                record = {field: host.get(field) for field in SNAPSHOT_FIELDS}
+                record['source'] = result['source']
+                current[ip] = record
+
+                old = previous.get(ip)
+                if old is None:
+                    delta.append(dict(host, change='added'))
+                elif any(old.get(field) != record[field] for field in SNAPSHOT_FIELDS):
+                    delta.append(dict(host, change='changed'))
+            result['unchanged_count'] = result['discovered_count'] - len(delta)
+            result['hosts'] = delta
+            result['removed'] = []
+
+        by_source = {result['source']: result for result in group}
+        for ip, old in previous.items():
+            if ip in current:
+                continue
+            result = by_source.get(old.get('source'))
+            if result is None:
+                # Its source did not scan this run; keep it
+                current[ip] = old
+                continue
+            result['removed'].append(dict(ip=ip, **{field: old.get(field) for field in SNAPSHOT_FIELDS}))
+
+        snapshots[path] = current
+    return snapshots
+
+
+def stage_snapshots(snapshots: Dict[str, Dict]) -> None:
+    """
+    Write new snapshots next to the current ones as *.pending files.
+    """
+    for path, snapshot in snapshots.items():
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        write_atomic(f"{path}{PENDING_SUFFIX}", snapshot)
+
+
+def commit_snapshots(state_dir: str) -> int:
+    """
+    Promote staged snapshots after a successful sync.
+
+    Returns:
+        Number of snapshots committed
+    """
+    pending = glob.glob(os.path.join(state_dir, f"*.json{PENDING_SUFFIX}"))
+    for path in pending:
+        os.replace(path, path[:-len(PENDING_SUFFIX)])
+    logger.info(f"Committed {len(pending)} snapshots in {state_dir}")
+    return len(pending)
+
+
+OUTPUT_FORMATS = ('json', 'ndjson', 'columnar')
+
+
+def to_columns(hosts: Iterable) -> Dict[str, List]:
+    """
+    Turn host records into one list per field.
+    """
+    hosts = list(hosts)
+    keys = list(dict.fromkeys(key for host in hosts for key in host.keys()))
+    return {key: [host.get(key) for host in hosts] for key in keys}
+
+
+def write_source(result: Dict, stream: TextIO) -> None:
+    """
+    Write one per-source result as a JSON object, streaming its hosts.
+    """
+    meta = {key: value for key, value in result.items() if key != 'hosts'}
+    stream.write(json.dumps(meta)[:-1] + (', ' if meta else '') + '"hosts": [')
+    first = True
+    for host in result['hosts']:
+        if not first:
+            stream.write(', ')
+        stream.write(json.dumps(host, default=to_json))
+        first = False
+    stream.write(']}')
+
+
+def write_results(results: Iterable[Dict], stream: TextIO, output: str = 'json') -> None:
+    """
+    Write per-source results.
+
+    Args:
+        results: Per-source results (see parse_source), consumed lazily
+        stream: Output stream
+        output: "json" (one document with a "sources" array), "ndjson"
+                (a header line, then one line per host, removed host or
+                error, each tagged with its source) or "columnar" (like
+                json, with each source's hosts as "columns")
+    """
+    timestamp = datetime.utcnow().isoformat()
+    errors = {}
+
+    if output == 'ndjson':
+        stream.write(json.dumps({'scan_timestamp': timestamp}) + '\n')
+        for result in results:
+            meta = {key: result.get(key) for key in ('source', 'tenant', 'vrf')}
+            if 'error' in result:
+                logger.warning(f"Skipping {result['file']}: {result['error']}")
+                stream.write(json.dumps(dict(meta, error=result['error'])) + '\n')
+                continue
+            for host in result['hosts']:
+                stream.write(json.dumps(dict(meta, **host), default=to_json) + '\n')
+            for host in result.get('removed', []):
+                stream.write(json.dumps(dict(meta, change='removed', **host)) + '\n')
+        return
+
+    stream.write('{\n')
+    stream.write(f'  "scan_timestamp": {json.dumps(timestamp)},\n')
+    stream.write('  "sources": [')
+    first = True
+    for result in results:
+        if 'error' in result:
+            logger.warning(f"Skipping {result['file']}: {result['error']}")
+            errors[result['source']] = result['error']
+            continue
+        stream.write('\n    ' if first else ',\n    ')
+        if output == 'columnar':
+            result = dict(result)
+            result['columns'] = to_columns(result.pop('hosts'))
+            stream.write(json.dumps(result, default=to_json))
+        else:
+            write_source(result, stream)
+        first = False
+    stream.write('\n  ]' if not first else ']')
+    stream.write(f',\n  "errors": {json.dumps(errors)}\n}}\n')
+
+
+def run_legacy(xml_file: str, tenant_slug: str) -> None:
+    """
+    Single-file mode: python3 parse_nmap.py <scan.xml> <tenant_slug>
+    """
+    # Parse nmap XML (streamed)
+    hosts = Counter(read_hosts(xml_file))
+
+    # Format for NetBox (streamed), masks from the scanned subnets
+    formatted = format_for_netbox(hosts, tenant_slug, PrefixIndex(scan_subnets(xml_file)))
+
+    # Output JSON, one host at a time
+    output = {
+        'tenant': tenant_slug,
+        'scan_timestamp': datetime.utcnow().isoformat(),
+    }
+
+    write_json(output, formatted, sys.stdout, 'discovered_count', hosts)
+
+
+def run_sources(args, sources: List[Dict], spool_dir: str) -> None:
+    """
+    Multi-file mode: parse, optionally record history and reduce to a
+    delta, then write the results. Entries stay spooled in spool_dir.
+    """
+    # History and delta work on raw host records; format afterwards
+    post_format = args.format == 'netbox' and bool(args.state_dir or args.history)
+    if post_format:
+        for source in sources:
+            source['format'] = 'hosts'
+    results = parse_sources(sources, args.jobs, spool_dir)
+
+    if args.state_dir or args.history:
+        results = list(results)
+    if args.history:
+        from scan_history import connect, record_results
+        record_results(connect(args.history), results)
+    if args.state_dir:
+        stage_snapshots(compute_delta(results, args.state_dir))
+        for result in results:
+            if 'error' not in result:
+                logger.info(f"{result['source']}: {len(result['hosts'])} added/changed, "
+                            f"{len(result['removed'])} removed, "
+                            f"{result['unchanged_count']} unchanged")
+    if post_format:
+        results = [result if 'error' in result else
+                   dict(result, hosts=format_for_netbox(result['hosts'], result['tenant']))
+                   for result in results]
+    write_results(results, sys.stdout, args.output)
+
+
+def main():
+    """
+    Main execution flow.
+    """
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+
+    argv = sys.argv[1:]
+    # Legacy form: <scan.xml> <tenant_slug>
+    if len(argv) == 2 and not argv[0].startswith('-') and '=' not in argv[1] \
+            and not argv[1].endswith(('.xml',) + COMPACT_SUFFIXES) and not os.path.exists(argv[1]):
+        try:
+            run_legacy(argv[0], argv[1])
+        except Exception as e:
+            logger.error(f"Fatal error: {e}")
+            sys.exit(1)
+        return
+
+    parser = argparse.ArgumentParser(description="Parse nmap XML scans for NetBox sync")
+    parser.add_argument('files', nargs='*', metavar='scan.xml[=tenant]',
+                        help="Scan files, optionally with their tenant slug")
+    parser.add_argument('--manifest', help="JSON list of sources (file, source, tenant, vrf)")
+    parser.add_argument('--tenant', help="Tenant slug for sources without one")
+    parser.add_argument('--subnet', action='append', metavar='CIDR',
+                        help="Scanned subnet, in addition to those in the XML (repeatable)")
+    parser.add_argument('--format', choices=('hosts', 'netbox'), default='hosts',
+                        help="hosts: raw host records; netbox: IPAM entries")
+    parser.add_argument('--output', choices=OUTPUT_FORMATS, default='json',
+                        help="json: one document; ndjson: one line per host; "
+                             "columnar: one array per field per source")
+    parser.add_argument('--jobs', type=int, default=None,
+                        help="Worker processes (default: CPU count)")
+    parser.add_argument('--state-dir',
+                        help="Emit only changes since the last committed snapshot")
+    parser.add_argument('--history', metavar='DB',
+                        help="Also record every parsed host in this scan history database")
+    parser.add_argument('--commit-state', action='store_true',
+                        help="Promote the staged snapshots in --state-dir and exit")
+    args = parser.parse_args(argv)
+
+    if args.commit_state:
+        if not args.state_dir:
+            parser.error("--commit-state requires --state-dir")
+        commit_snapshots(args.state_dir)
+        return
+
+    sources = load_sources(args)
+    if not sources:
+        parser.error("no scan files given")
+
+    try:
+        with tempfile.TemporaryDirectory(prefix='parse_nmap-') as spool_dir:
+            run_sources(args, sources, spool_dir)
     except Exception as e:
         logger.error(f"Fatal error: {e}")
         sys.exit(1)
@@ -0,0 +1,581 @@
+#!/usr/bin/env python3
+"""
+Probe Key Manager - Indexed authorized_keys for the Proxy
+
+Runs on the proxy and owns the tunnel user's probe keys. Keys live in a
+small SQLite index (device, MAC, port, tenant -> key), so registering or
+revoking a probe is an indexed insert/delete instead of a regex edit and
+rescan of authorized_keys over SSH, and a tenant revoke only touches that
+tenant's keys.
+
+Keys reach sshd in one of two ways:
+
+- Rendered: after every change the managed section of authorized_keys is
+  rewritten from the index and atomically renamed into place. Lines
+  outside the section (admin keys) are kept.
+- AuthorizedKeysCommand: sshd asks `probe_keys.py lookup` for the
+  offered key, answered by an indexed lookup. Set PROBE_KEYS_RENDER=0
+  to stop rendering the file.
+
+    # /etc/ssh/sshd_config
+    Match User tunnelmgr
+        AuthorizedKeysCommand /usr/local/bin/probe-keys lookup %u %t %k
+        AuthorizedKeysCommandUser tunnelmgr
+
+Tunnel sessions are tracked too: `snapshot` records which sshd session
+process holds each reverse-forward listen port (one `ss` call; run it
+from a timer), and `revoke --kill` tears down the revoked probes'
+sessions with one indexed lookup and a batched kill.
+
+Usage:
+    python3 probe_keys.py add --device probe-aa:bb:cc:dd:ee:ff --mac aa:bb:cc:dd:ee:ff \\
+        --port 10001 --tenant acme --key "ssh-ed25519 AAAA... root@probe"
+    python3 probe_keys.py revoke [--device NAME] [--mac MAC] [--port PORT] [--tenant SLUG]
+    python3 probe_keys.py list [--tenant SLUG]
+    python3 probe_keys.py import    (adopt legacy "# BEGIN Probe ..." blocks)
+    python3 probe_keys.py render
+    python3 probe_keys.py snapshot
+    python3 probe_keys.py sessions [--tenant SLUG] [--orphans]
+    python3 probe_keys.py revoke --tenant SLUG --kill
+    python3 probe_keys.py lookup USER TYPE KEY
+
+Output:
+    JSON (lookup: authorized_keys lines for sshd)
+"""
+
+import os
+import re
+import sys
+import json
+import fcntl
+import base64
+import hashlib
+import signal
+import sqlite3
+import logging
+import argparse
+import binascii
+import tempfile
+import subprocess
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+PROBE_KEYS_DB = os.getenv("PROBE_KEYS_DB", "/var/lib/probe-keys/keys.db")
+PROBE_KEYS_USER = os.getenv("PROBE_KEYS_USER", "tunnelmgr")
+PROBE_KEYS_FILE = os.getenv("PROBE_KEYS_FILE", f"/home/{PROBE_KEYS_USER}/.ssh/authorized_keys")
+PROBE_KEYS_RENDER = os.getenv("PROBE_KEYS_RENDER", "1").lower() not in ("0", "false", "no")
+# Restrictions applied to every probe key (tunnels only, no shell)
+KEY_OPTIONS = os.getenv("PROBE_KEY_OPTIONS",
+                        'command="/bin/false",no-pty,no-X11-forwarding,no-agent-forwarding')
+# sshd's own listen ports; every other sshd listener is a reverse forward
+SSHD_PORTS = {int(p) for p in os.getenv("PROBE_SSHD_PORTS", "22").split(",") if p}
+
+BEGIN_MARKER = "# BEGIN probe-keys (managed by probe_keys.py, do not edit)"
+END_MARKER = "# END probe-keys"
+# Blocks written by the old blockinfile registration
+LEGACY_BLOCK = re.compile(r"^# BEGIN Probe (\S+) \(port (\d+)\)$")
+LEGACY_END = re.compile(r"^# END Probe ")
+
+# Rollback journal rather than WAL: the AuthorizedKeysCommand user only
+# needs read access to the database file
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS keys (
+    device TEXT PRIMARY KEY,
+    mac TEXT UNIQUE,
+    port INTEGER UNIQUE,
+    tenant TEXT,
+    key_type TEXT NOT NULL,
+    key TEXT NOT NULL UNIQUE,
+    comment TEXT,
+    added TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS keys_tenant ON keys (tenant);
+CREATE TABLE IF NOT EXISTS sessions (
+    port INTEGER PRIMARY KEY,
+    pid INTEGER NOT NULL,
+    address TEXT,
+    seen TEXT NOT NULL
+);
+"""
+
+FIELDS = ("device", "mac", "port", "tenant", "key_type", "key", "comment", "added")
+
+
+def connect(path: str, readonly: bool = False) -> sqlite3.Connection:
+    """
+    Open (and create if needed) the key index.
+    """
+    if readonly:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    else:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(path, timeout=30)
+        conn.executescript(SCHEMA)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+@contextmanager
+def locked(path: str) -> Iterator[None]:
+    """
+    Serialize change-and-render so a slower writer never renames an older
+    authorized_keys over a newer one.
+    """
+    with open(f"{path}.lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def normalize_mac(mac: Optional[str]) -> Optional[str]:
+    """
+    Lowercase colon-separated MAC, or None if none.
+    """
+    if not mac:
+        return None
+    clean = re.sub(r"[^0-9a-f]", "", mac.lower())
+    if len(clean) != 12:
+        raise ValueError(f"invalid MAC address: {mac}")
+    return ":".join(clean[i:i + 2] for i in range(0, 12, 2))
+
+
+def parse_public_key(text: str) -> Tuple[str, str, str]:
+    """
+    Split an OpenSSH public key line into (type, base64 key, comment).
+
+    Raises:
+        ValueError: If the line is not a single public key
+    """
+    parts = text.strip().split(None, 2)
+    if len(parts) < 2 or not re.match(r"^(ssh-|ecdsa-|sk-)", parts[0]):
+        raise ValueError("not an OpenSSH public key")
+    try:
+        base64.b64decode(parts[1], validate=True)
+    except binascii.Error:
+        raise ValueError("public key is not valid base64")
+    return parts[0], parts[1], parts[2] if len(parts) > 2 else ""
+
+
+def key_line(row: sqlite3.Row) -> str:
+    """
+    authorized_keys line for one probe, tagged with its index entry.
+    """
+    tags = f"{row['device']} port={row['port']}"
+    if row["tenant"]:
+        tags += f" tenant={row['tenant']}"
+    return f"{KEY_OPTIONS} {row['key_type']} {row['key']} {tags}"
+
+
+def fingerprint(key: str) -> str:
+    """
+    OpenSSH SHA256 fingerprint of a base64 public key, as sshd logs it.
+    """
+    digest = hashlib.sha256(base64.b64decode(key)).digest()
+    return "SHA256:" + base64.b64encode(digest).decode().rstrip("=")
+
+
+def add_key(conn: sqlite3.Connection, device: str, key: str, mac: Optional[str] = None,
+            port: Optional[int] = None, tenant: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Add or replace a probe's key.
+
+    An existing entry for the same device, MAC, port or key is replaced,
+    so a re-registered probe (new key or new port) never leaves a stale
+    key behind.
+
+    Returns:
+        The stored entry
+    """
+    key_type, key_data, comment = parse_public_key(key)
+    entry = {
+        "device": device, "mac": normalize_mac(mac), "port": port, "tenant": tenant,
+        "key_type": key_type, "key": key_data, "comment": comment,
+        "added": datetime.utcnow().isoformat(),
+    }
+    with conn:
+        conn.execute(
+            f"INSERT OR REPLACE INTO keys ({', '.join(FIELDS)}) "
+            f"VALUES ({', '.join(':' + field for field in FIELDS)})",
+            entry,
+        )
+    return entry
+
+
+def find_keys(conn: sqlite3.Connection, devices: Optional[List[str]] = None,
+              macs: Optional[List[str]] = None, ports: Optional[List[int]] = None,
+              tenant: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Entries matching any of the given devices, MACs, ports or the tenant.
+    """
+    clauses, params = [], []
+    for column, values in (("device", devices), ("mac", [normalize_mac(m) for m in macs or []]),
+                           ("port", ports)):
+        if values:
+            clauses.append(f"{column} IN ({', '.join('?' * len(values))})")
+            params.extend(values)
+    if tenant:
+        clauses.append("tenant = ?")
+        params.append(tenant)
+    if not clauses:
+        return [dict(row) for row in conn.execute("SELECT * FROM keys ORDER BY port")]
+    return [dict(row) for row in conn.execute(
+        f"SELECT * FROM keys WHERE {' OR '.join(clauses)} ORDER BY port", params)]
+
+
+def revoke_keys(conn: sqlite3.Connection, **filters) -> List[Dict[str, Any]]:
+    """
+    Delete the entries matching find_keys filters.
+
+    Returns:
+        Revoked entries (their ports identify the tunnels to kill)
+    """
+    revoked = find_keys(conn, **filters)
+    with conn:
+        conn.executemany("DELETE FROM keys WHERE device = ?", [(row["device"],) for row in revoked])
+    return revoked
+
+
+def import_legacy(conn: sqlite3.Connection, path: str) -> List[Dict[str, Any]]:
+    """
+    Adopt probe keys from blockinfile blocks ("# BEGIN Probe <device>
+    (port <port>)") into the index. The next render drops the blocks.
+
+    Returns:
+        Imported entries
+    """
+    imported = []
+    try:
+        with open(path) as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return imported
+
+    block = None
+    for line in lines:
+        match = LEGACY_BLOCK.match(line)
+        if match:
+            block = match.groups()
+        elif block and LEGACY_END.match(line):
+            block = None
+        elif block and line.strip():
+            device, port = block
+            # Key follows the options (which contain no spaces)
+            options, _, key = line.partition(" ")
+            mac = device[len("probe-"):] if device.startswith("probe-") else None
+            try:
+                imported.append(add_key(conn, device, key, mac, int(port)))
+            except ValueError as e:
+                logger.warning(f"Skipping legacy key for {device}: {e}")
+    return imported
+
+
+def render(conn: sqlite3.Connection, path: str) -> int:
+    """
+    Rewrite the managed section of authorized_keys from the index.
+
+    Lines outside the section are kept, except legacy probe blocks whose
+    key is now indexed. The file is written to a temp file in the same
+    directory and renamed into place, so sshd never reads a partial file.
+
+    Returns:
+        Number of probe keys rendered
+    """
+    rows = conn.execute("SELECT * FROM keys ORDER BY port").fetchall()
+    indexed = {row["key"] for row in rows}
+
+    try:
+        with open(path) as f:
+            lines = f.read().splitlines()
+        stat = os.stat(path)
+    except FileNotFoundError:
+        lines, stat = [], None
+
+    # Drop the managed section and legacy blocks whose key is indexed
+    keep: List[str] = []
+    block: List[str] = []
+    managed = False
+    for line in lines:
+        if line == BEGIN_MARKER:
+            managed = True
+        elif line == END_MARKER:
+            managed = False
+        elif managed:
+            continue
+        elif LEGACY_BLOCK.match(line):
+            block = [line]
+        elif block:
+            block.append(line)
+            if LEGACY_END.match(line):
+                if not any(part in indexed for entry in block for part in entry.split()):
+                    keep.extend(block)
+                block = []
+        else:
+            keep.append(line)
+    keep.extend(block)
+
+    content = keep + [BEGIN_MARKER] + [key_line(row) for row in rows] + [END_MARKER]
+    directory = os.path.dirname(path) or "."
+    fd, tmp = tempfile.mkstemp(prefix=".authorized_keys.", dir=directory)
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write("\n".join(content) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, stat.st_mode & 0o777 if stat else 0o600)
+        if stat and os.geteuid() == 0:
+            os.chown(tmp, stat.st_uid, stat.st_gid)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return len(rows)
+
+
+def lookup(db: str, user: str, key_type: str, key: str) -> List[str]:
+    """
+    AuthorizedKeysCommand: authorized_keys lines for the offered key.
+    """
+    if user != PROBE_KEYS_USER:
+        return []
+    conn = connect(db, readonly=True)
+    try:
+        row = conn.execute("SELECT * FROM keys WHERE key = ?", (key,)).fetchone()
+    finally:
+        conn.close()
+    if row is None or row["key_type"] != key_type:
+        return []
+    return [key_line(row)]
+
+
+LISTEN_PROCESS = re.compile(r'\("([^"]+)",pid=(\d+)')
+
+
+def listeners(ss: str = "ss") -> List[Dict[str, Any]]:
+    """
+    sshd processes listening on TCP ports, from one `ss -Htlnp` call.
+
+    Returns:
+        Listeners (port, pid, address), excluding sshd's own ports
+    """
+    output = subprocess.run([ss, "-Htlnp"], capture_output=True, text=True, check=True).stdout
+    found = []
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) < 6:
+            continue
+        address, _, port = fields[3].rpartition(":")
+        if not port.isdigit() or int(port) in SSHD_PORTS:
+            continue
+        for name, pid in LISTEN_PROCESS.findall(line):
+            if name == "sshd" or name.startswith("sshd-"):
+                found.append({"port": int(port), "pid": int(pid), "address": address})
+    return found
+
+
+def snapshot(conn: sqlite3.Connection, ss: str = "ss") -> int:
+    """
+    Replace the port -> session registry with the current listeners.
+
+    Returns:
+        Number of tunnel ports with a live session
+    """
+    seen = datetime.utcnow().isoformat()
+    current = {entry["port"]: entry for entry in listeners(ss)}
+    with conn:
+        conn.execute("DELETE FROM sessions")
+        conn.executemany(
+            "INSERT INTO sessions (port, pid, address, seen) VALUES (:port, :pid, :address, :seen)",
+            [dict(entry, seen=seen) for entry in current.values()],
+        )
+    return len(current)
+
+
+def find_sessions(conn: sqlite3.Connection, ports: Optional[List[int]] = None,
+                  tenant: Optional[str] = None, orphans: bool = False) -> List[Dict[str, Any]]:
+    """
+    Registered sessions with the device, tenant and key fingerprint
+    indexed for their port.
+
+    Args:
+        conn: Key index
+        ports: Only these ports
+        tenant: Only this tenant's probes
+        orphans: Only sessions whose port has no indexed key (revoked or
+            never registered, but still connected)
+    """
+    query = ("SELECT s.port, s.pid, s.address, s.seen, k.device, k.tenant, k.key "
+             "FROM sessions s LEFT JOIN keys k ON k.port = s.port")
+    clauses, params = [], []
+    if ports is not None:
+        clauses.append(f"s.port IN ({', '.join('?' * len(ports))})")
+        params.extend(ports)
+    if tenant:
+        clauses.append("k.tenant = ?")
+        params.append(tenant)
+    if orphans:
+        clauses.append("k.device IS NULL")
+    if clauses:
+        query += " WHERE " + " AND ".join(clauses)
+    sessions = []
+    for row in conn.execute(query + " ORDER BY s.port", params):
+        session = dict(row)
+        key = session.pop("key")
+        session["fingerprint"] = fingerprint(key) if key else None
+        sessions.append(session)
+    return sessions
+
+
+def is_sshd(pid: int) -> bool:
+    """
+    Guard against PID reuse: only signal processes that are still sshd.
+    """
+    try:
+        with open(f"/proc/{pid}/comm") as f:
+            return f.read().strip().startswith("sshd")
+    except OSError:
+        return False
+
+
+def kill_sessions(conn: sqlite3.Connection, ports: List[int], ss: str = "ss") -> List[Dict[str, Any]]:
+    """
+    Terminate the sshd sessions holding the given tunnel ports.
+
+    The registry is refreshed first (one `ss` call) so only current
+    session PIDs are signalled, then all of them are killed in one pass.
+
+    Returns:
+        Killed sessions (port, pid)
+    """
+    if not ports:
+        return []
+    snapshot(conn, ss)
+    killed = []
+    for session in find_sessions(conn, ports=ports):
+        if not is_sshd(session["pid"]):
+            continue
+        try:
+            os.kill(session["pid"], signal.SIGTERM)
+        except ProcessLookupError:
+            continue
+        killed.append({"port": session["port"], "pid": session["pid"]})
+    with conn:
+        conn.executemany("DELETE FROM sessions WHERE port = ?", [(s["port"],) for s in killed])
+    for session in killed:
+        logger.info(f"Killed tunnel session {session['pid']} on port {session['port']}")
+    return killed
+
+
+def main():
+    """
+    Main execution flow.
+    """
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+
+    parser = argparse.ArgumentParser(description="Indexed probe key manager for the proxy")
+    parser.add_argument('--db', default=PROBE_KEYS_DB, help="Key index database")
+    parser.add_argument('--authorized-keys', default=PROBE_KEYS_FILE, help="authorized_keys to render")
+    parser.add_argument('--no-render', action='store_true',
+                        help="Only update the index (keys served by AuthorizedKeysCommand)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    cmd = commands.add_parser('add', help="Add or replace a probe key")
+    cmd.add_argument('--device', required=True)
+    cmd.add_argument('--key', required=True, help="OpenSSH public key line")
+    cmd.add_argument('--mac')
+    cmd.add_argument('--port', type=int)
+    cmd.add_argument('--tenant')
+
+    cmd = commands.add_parser('revoke', help="Revoke keys by device, MAC, port or tenant")
+    cmd.add_argument('--device', action='append', default=[])
+    cmd.add_argument('--mac', action='append', default=[])
+    cmd.add_argument('--port', action='append', type=int, default=[])
+    cmd.add_argument('--tenant')
+    cmd.add_argument('--kill', action='store_true',
+                     help="Also terminate the revoked probes' tunnel sessions")
+
+    cmd = commands.add_parser('list', help="List indexed keys")
+    cmd.add_argument('--tenant')
+
+    commands.add_parser('import', help="Adopt legacy blockinfile probe keys")
+    commands.add_parser('render', help="Rewrite authorized_keys from the index")
+    commands.add_parser('snapshot', help="Refresh the port -> session registry from ss")
+
+    cmd = commands.add_parser('sessions', help="List registered tunnel sessions")
+    cmd.add_argument('--port', action='append', type=int)
+    cmd.add_argument('--tenant')
+    cmd.add_argument('--orphans', action='store_true', help="Only sessions without an indexed key")
+
+    cmd = commands.add_parser('lookup', help="AuthorizedKeysCommand (%%u %%t %%k)")
+    cmd.add_argument('user')
+    cmd.add_argument('key_type')
+    cmd.add_argument('key')
+
+    args = parser.parse_args()
+
+    if args.command == 'lookup':
+        # sshd only reads stdout; any failure simply means "no key"
+        try:
+            lines = lookup(args.db, args.user, args.key_type, args.key)
+        except sqlite3.Error as e:
+            logger.error(f"Key lookup failed: {e}")
+            sys.exit(1)
+        for line in lines:
+            print(line)
+        return
+
+    render_file = PROBE_KEYS_RENDER and not args.no_render
+    conn = connect(args.db)
+    try:
+        with locked(args.db):
+            if args.command == 'add':
+                result = {'added': add_key(conn, args.device, args.key, args.mac,
+                                           args.port, args.tenant)}
+            elif args.command == 'revoke':
+                if not (args.device or args.mac or args.port or args.tenant):
+                    parser.error("revoke needs --device, --mac, --port or --tenant")
+                revoked = revoke_keys(conn, devices=args.device, macs=args.mac,
+                                      ports=args.port, tenant=args.tenant)
+                result = {'revoked': revoked}
+                if args.kill:
+                    # Requested ports too, in case the key was already revoked
+                    ports = sorted({row['port'] for row in revoked if row['port']} | set(args.port))
+                    result['killed'] = kill_sessions(conn, ports)
+            elif args.command == 'list':
+                result = {'keys': find_keys(conn, tenant=args.tenant)}
+                render_file = False
+            elif args.command == 'snapshot':
+                result = {'sessions': snapshot(conn)}
+                render_file = False
+            elif args.command == 'sessions':
+                result = {'sessions': find_sessions(conn, args.port, args.tenant, args.orphans)}
+                render_file = False
+            elif args.command == 'import':
+                result = {'imported': import_legacy(conn, args.authorized_keys)}
+            else:
+                result = {}
+                render_file = True
+
+            if render_file:
+                result['rendered'] = render(conn, args.authorized_keys)
+    except (ValueError, OSError, subprocess.CalledProcessError) as e:
+        logger.error(str(e))
+        sys.exit(1)
+    finally:
+        conn.close()
+
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
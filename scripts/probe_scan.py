@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+"""
+Probe Scan Driver - Parallel, Adaptive nmap Sweeps
+
+Runs on the probe (or OPNsense) and replaces a single blocking
+`nmap -sn <subnets>` call:
+
+- Large IPv4 prefixes are split into chunks (default /24)
+- Chunks are scanned by several nmap workers in parallel, bounded by CPU
+  count and by a total packet rate budget for the customer link
+- The per-worker rate and timing template adapt to how responsive the
+  network is (AIMD on the round-trip times nmap reports)
+- Worker outputs are merged into one result holding only hosts that are
+  up, with the original subnets in the "args" attribute so parse_nmap.py
+  still derives the right prefixes
+- With a *.ndjson.gz (or .ndjson.zst) output, hosts are converted to
+  parse_nmap.py's compact record format and compressed on the probe, so
+  only a fraction of the XML size crosses the tunnel
+
+Stdlib only (zstandard optional), so it runs on a stock probe image;
+parse_nmap.py must sit next to this script.
+
+Usage:
+    python3 probe_scan.py -o /tmp/scan.ndjson.gz 192.168.1.0/24 10.0.0.0/16
+    python3 probe_scan.py -o /tmp/scan.xml --max-rate 1000 --workers 4 10.0.0.0/22
+
+Output:
+    nmap XML or compact scan file (to --output, or stdout)
+"""
+
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import ipaddress
+import statistics
+import subprocess
+import tempfile
+import threading
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional, TextIO
+from xml.sax.saxutils import quoteattr
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from parse_nmap import CompactWriter, is_compact, open_text, parse_host  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+# Total packets/sec across all workers; keeps small customer links usable
+DEFAULT_MAX_RATE = 300
+# Lowest per-worker rate the controller backs off to
+MIN_RATE = 10
+DEFAULT_CHUNK_PREFIX = 24
+# Median host RTT (ms) below which the network counts as fast, above
+# which it counts as slow
+FAST_RTT_MS = 20
+SLOW_RTT_MS = 200
+
+
+def split_subnets(subnets: List[str], chunk_prefix: int = DEFAULT_CHUNK_PREFIX) -> List[str]:
+    """
+    Split IPv4 prefixes larger than chunk_prefix into chunk_prefix blocks.
+
+    IPv6 prefixes and anything nmap accepts that is not a CIDR (single
+    hosts, ranges, names) are passed through unchanged.
+
+    Args:
+        subnets: Scan targets
+        chunk_prefix: Largest IPv4 block a worker scans at once
+
+    Returns:
+        Chunk targets, in address order per subnet
+    """
+    chunks = []
+    seen = set()
+    for subnet in subnets:
+        try:
+            network = ipaddress.ip_network(subnet, strict=False)
+        except ValueError:
+            targets = [subnet]
+        else:
+            if network.version == 4 and network.prefixlen < chunk_prefix:
+                targets = [str(block) for block in network.subnets(new_prefix=chunk_prefix)]
+            else:
+                targets = [str(network)]
+        for target in targets:
+            if target not in seen:
+                seen.add(target)
+                chunks.append(target)
+    return chunks
+
+
+class RateController:
+    """
+    AIMD controller for the per-worker nmap rate.
+
+    After each chunk, a low median RTT raises the rate by half (up to the
+    per-worker share of the link budget) and selects -T4; a high median
+    RTT or failed chunk halves it and falls back to -T3.
+
+    The rate never exceeds the per-worker share, so all workers together
+    stay within max_rate (see worker_count for keeping the share above
+    MIN_RATE).
+    """
+
+    def __init__(self, max_rate: int, workers: int):
+        self.cap = max(1, max_rate // max(workers, 1))
+        self.floor = min(MIN_RATE, self.cap)
+        # Start at a quarter of the share and grow once the network proves fast
+        self.rate = max(self.floor, self.cap // 4)
+        self.timing = 3
+        self._lock = threading.Lock()
+
+    def settings(self):
+        with self._lock:
+            return self.rate, self.timing
+
+    def update(self, rtts_ms: List[float], failed: bool = False) -> None:
+        """
+        Adjust the rate from the RTTs (ms) of hosts in a finished chunk.
+        """
+        with self._lock:
+            if failed:
+                self.rate = max(self.floor, self.rate // 2)
+                self.timing = 3
+            elif not rtts_ms:
+                # Nothing answered; no signal either way
+                return
+            else:
+                median = statistics.median(rtts_ms)
+                if median <= FAST_RTT_MS:
+                    self.rate = min(self.cap, int(self.rate * 1.5) + 1)
+                    self.timing = 4
+                elif median >= SLOW_RTT_MS:
+                    self.rate = max(self.floor, self.rate // 2)
+                    self.timing = 3
+            logger.debug(f"Rate now {self.rate} pps/worker, -T{self.timing}")
+
+
+def worker_count(workers: Optional[int], chunks: int, max_rate: int) -> int:
+    """
+    Number of parallel nmap workers for a scan.
+
+    Defaults to the CPU count (max 8), never more than there are chunks,
+    and reduced so each worker's share of max_rate is at least MIN_RATE.
+    """
+    count = max(1, min(workers or min(os.cpu_count() or 1, 8), chunks))
+    return max(1, min(count, max_rate // MIN_RATE))
+
+
+def host_rtts(xml_file: str) -> List[float]:
+    """
+    Return the smoothed RTT (ms) of every up host in an nmap XML file.
+    """
+    rtts = []
+    for _, elem in ET.iterparse(xml_file):
+        if elem.tag == 'times':
+            srtt = elem.get('srtt')
+            if srtt and srtt.isdigit():
+                rtts.append(int(srtt) / 1000.0)
+        elif elem.tag == 'host':
+            elem.clear()
+    return rtts
+
+
+def scan_chunk(target: str, controller: RateController, workdir: str,
+               nmap_args: List[str], nmap: str = 'nmap') -> Optional[str]:
+    """
+    Scan one chunk with nmap.
+
+    Args:
+        target: Chunk to scan
+        controller: Rate controller shared by the workers
+        workdir: Directory for the chunk's XML output
+        nmap_args: Extra nmap arguments
+        nmap: nmap binary
+
+    Returns:
+        Path of the chunk's XML output, or None if nmap failed
+    """
+    rate, timing = controller.settings()
+    fd, output = tempfile.mkstemp(suffix='.xml', dir=workdir)
+    os.close(fd)
+    cmd = [nmap, '-sn', f'-T{timing}', '--min-rate', str(rate), '--max-rate', str(rate),
+           *nmap_args, '-oX', output, target]
+    started = time.monotonic()
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        logger.warning(f"nmap failed for {target}: {result.stderr.strip()}")
+        controller.update([], failed=True)
+        return None
+
+    try:
+        rtts = host_rtts(output)
+    except ET.ParseError as e:
+        logger.warning(f"Unreadable nmap output for {target}: {e}")
+        controller.update([], failed=True)
+        return None
+    controller.update(rtts)
+    logger.info(f"Scanned {target} in {time.monotonic() - started:.1f}s "
+                f"({len(rtts)} up, {rate} pps, -T{timing})")
+    return output
+
+
+def merge_results(outputs: List[str], subnets: List[str], stream: TextIO,
+                  started: float, compact: bool = False) -> Dict[str, int]:
+    """
+    Merge chunk outputs into one nmap XML document or compact scan file.
+
+    Only hosts that are up are kept. The "args" attribute (or compact
+    header) lists the original subnets, not the chunks.
+
+    Returns:
+        Totals: up, down and total hosts
+    """
+    totals = {'up': 0, 'down': 0, 'total': 0}
+    args = ' '.join(['nmap', '-sn', *subnets])
+    if compact:
+        writer = CompactWriter(stream, args)
+    else:
+        stream.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        stream.write(f'<nmaprun scanner="nmap" args={quoteattr(args)} start="{int(started)}" '
+                     f'xmloutputversion="1.05">\n')
+
+    for output in outputs:
+        root = None
+        for event, elem in ET.iterparse(output, events=('start', 'end')):
+            if root is None:
+                root = elem
+            if event != 'end':
+                continue
+            if elem.tag == 'host':
+                if compact:
+                    host = parse_host(elem)
+                    if host is not None:
+                        writer.write(host)
+                else:
+                    status = elem.find('status')
+                    if status is not None and status.get('state') == 'up':
+                        stream.write(ET.tostring(elem, encoding='unicode').strip() + '\n')
+                elem.clear()
+                root.clear()
+            elif elem.tag == 'hosts':
+                # <runstats><hosts up= down= total=>
+                for key in totals:
+                    totals[key] += int(elem.get(key, 0))
+
+    if not compact:
+        finished = time.time()
+        stream.write(f'<runstats><finished time="{int(finished)}" elapsed="{finished - started:.2f}"/>'
+                     f'<hosts up="{totals["up"]}" down="{totals["down"]}" total="{totals["total"]}"/>'
+                     f'</runstats>\n')
+        stream.write('</nmaprun>\n')
+    return totals
+
+
+def run_scan(subnets: List[str], stream: TextIO, workers: Optional[int] = None,
+             max_rate: int = DEFAULT_MAX_RATE, chunk_prefix: int = DEFAULT_CHUNK_PREFIX,
+             nmap_args: Optional[List[str]] = None, nmap: str = 'nmap',
+             compact: bool = False) -> Dict[str, int]:
+    """
+    Scan subnets in parallel chunks and write the merged XML to stream.
+
+    Args:
+        subnets: Scan targets
+        stream: Output stream for the merged XML
+        workers: Parallel nmap processes (default: CPU count, max 8)
+        max_rate: Total packets/sec budget across all workers
+        chunk_prefix: Largest IPv4 block per chunk
+        nmap_args: Extra nmap arguments
+        nmap: nmap binary
+        compact: Write a compact scan file instead of nmap XML
+
+    Returns:
+        Host totals (up, down, total) and failed chunk count
+    """
+    chunks = split_subnets(subnets, chunk_prefix)
+    requested = workers
+    workers = worker_count(workers, len(chunks), max_rate)
+    if requested and workers < min(requested, len(chunks)):
+        logger.info(f"Using {workers} workers so each gets at least {MIN_RATE} pps of {max_rate}")
+    controller = RateController(max_rate, workers)
+    started = time.time()
+    logger.info(f"Scanning {len(subnets)} subnets as {len(chunks)} chunks with {workers} workers")
+
+    with tempfile.TemporaryDirectory(prefix='probe-scan-') as workdir:
+        outputs: Dict[str, Optional[str]] = {}
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {
+                pool.submit(scan_chunk, chunk, controller, workdir, nmap_args or [], nmap): chunk
+                for chunk in chunks
+            }
+            for future in as_completed(futures):
+                outputs[futures[future]] = future.result()
+
+        # Merge in chunk order so output is stable between runs
+        ordered = [outputs[chunk] for chunk in chunks if outputs.get(chunk)]
+        totals = merge_results(ordered, subnets, stream, started, compact)
+
+    totals['failed_chunks'] = len(chunks) - len(ordered)
+    logger.info(f"Scan finished in {time.time() - started:.1f}s: {totals['up']} up of "
+                f"{totals['total']} ({totals['failed_chunks']} chunks failed)")
+    return totals
+
+
+def main():
+    """
+    Main execution flow.
+    """
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+
+    parser = argparse.ArgumentParser(description="Parallel adaptive nmap sweep")
+    parser.add_argument('subnets', nargs='+', help="Subnets to scan")
+    parser.add_argument('-o', '--output', help="Merged XML output file (default: stdout)")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Parallel nmap processes (default: CPU count, max 8)")
+    parser.add_argument('--max-rate', type=int, default=DEFAULT_MAX_RATE,
+                        help="Total packets/sec across all workers")
+    parser.add_argument('--chunk-prefix', type=int, default=DEFAULT_CHUNK_PREFIX,
+                        help="Split IPv4 prefixes larger than this")
+    parser.add_argument('--nmap-arg', action='append', default=[],
+                        help="Extra nmap argument (repeatable), e.g. --nmap-arg=-sV")
+    parser.add_argument('--nmap', default=shutil.which('nmap') or 'nmap', help="nmap binary")
+    parser.add_argument('--format', choices=('xml', 'compact'), default=None,
+                        help="Output format (default: compact for *.ndjson[.gz|.zst] outputs, else xml)")
+    args = parser.parse_args()
+
+    compact = args.format == 'compact' or (args.format is None and bool(args.output)
+                                           and is_compact(args.output))
+    scan_args = (args.workers, args.max_rate, args.chunk_prefix, args.nmap_arg, args.nmap, compact)
+
+    try:
+        if args.output:
+            # Write next to the target and rename, so readers never see a
+            # partial file; the temp name keeps the compression extension
+            directory, name = os.path.split(args.output)
+            tmp = os.path.join(directory, f".tmp-{name}")
+            with open_text(tmp, 'wt') as f:
+                totals = run_scan(args.subnets, f, *scan_args)
+            os.replace(tmp, args.output)
+        else:
+            totals = run_scan(args.subnets, sys.stdout, *scan_args)
+    except Exception as e:
+        logger.error(f"Fatal error: {e}")
+        sys.exit(1)
+
+    if totals['failed_chunks']:
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
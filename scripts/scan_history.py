@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+"""
+Scan History Store
+
+Append-only SQLite history of discovery scans, fed by parse_nmap.py
+(--history DB). Answers "when did we first/last see this MAC or IP",
+churn and run-to-run diffs locally, without querying NetBox.
+
+Tables:
+    runs       one row per parsed scan file (source, tenant, VRF, time)
+    sightings  one row per address per run (append-only)
+    hosts      first/last seen per tenant, VRF, IP and MAC (upserted)
+
+Usage:
+    python3 scan_history.py --db history.db record discovered.json
+    python3 scan_history.py --db history.db seen --mac aa:bb:cc:dd:ee:ff
+    python3 scan_history.py --db history.db seen --ip 10.0.0.5 --tenant acme
+    python3 scan_history.py --db history.db churn --tenant acme --since 2026-01-01
+    python3 scan_history.py --db history.db diff --source probe-01
+    python3 scan_history.py --db history.db stale --days 30
+
+Output:
+    JSON
+"""
+
+import sys
+import json
+import sqlite3
+import logging
+import argparse
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    scanned_at TEXT NOT NULL,
+    source TEXT NOT NULL,
+    tenant TEXT NOT NULL DEFAULT '',
+    vrf TEXT NOT NULL DEFAULT '',
+    file TEXT,
+    host_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS runs_source ON runs (source, id);
+CREATE INDEX IF NOT EXISTS runs_group ON runs (tenant, vrf, id);
+
+CREATE TABLE IF NOT EXISTS sightings (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    ip TEXT NOT NULL,
+    mac TEXT NOT NULL DEFAULT '',
+    hostname TEXT,
+    vendor TEXT
+);
+CREATE INDEX IF NOT EXISTS sightings_run ON sightings (run_id, ip);
+CREATE INDEX IF NOT EXISTS sightings_mac ON sightings (mac);
+CREATE INDEX IF NOT EXISTS sightings_ip ON sightings (ip);
+
+CREATE TABLE IF NOT EXISTS hosts (
+    tenant TEXT NOT NULL,
+    vrf TEXT NOT NULL,
+    ip TEXT NOT NULL,
+    mac TEXT NOT NULL,
+    hostname TEXT,
+    vendor TEXT,
+    source TEXT,
+    first_seen TEXT NOT NULL,
+    last_seen TEXT NOT NULL,
+    first_run_id INTEGER NOT NULL,
+    last_run_id INTEGER NOT NULL,
+    PRIMARY KEY (tenant, vrf, ip, mac)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS hosts_mac ON hosts (mac);
+CREATE INDEX IF NOT EXISTS hosts_ip ON hosts (ip);
+CREATE INDEX IF NOT EXISTS hosts_last_seen ON hosts (tenant, vrf, last_seen);
+CREATE INDEX IF NOT EXISTS hosts_first_seen ON hosts (tenant, vrf, first_seen);
+"""
+
+
+def connect(path: str) -> sqlite3.Connection:
+    """
+    Open (and create if needed) a history database.
+    """
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def normalize_mac(mac: Optional[str]) -> str:
+    """
+    Lowercase colon-separated MAC, or '' if none.
+    """
+    if not mac:
+        return ''
+    clean = mac.lower().replace(':', '').replace('-', '').replace('.', '')
+    if len(clean) != 12:
+        return mac.lower()
+    return ':'.join(clean[i:i + 2] for i in range(0, 12, 2))
+
+
+def rows(cursor: Iterable[sqlite3.Row]) -> List[Dict[str, Any]]:
+    return [dict(row) for row in cursor]
+
+
+def record_results(conn: sqlite3.Connection, results: Iterable[Dict],
+                   scanned_at: Optional[str] = None) -> int:
+    """
+    Record per-source parse results (parse_nmap.parse_source) as runs.
+
+    Every address of every host is appended to sightings and upserted
+    into hosts, in one transaction.
+
+    Args:
+        conn: History database
+        results: Per-source results with raw host records
+        scanned_at: Scan time (ISO 8601, default now)
+
+    Returns:
+        Number of runs recorded
+    """
+    scanned_at = scanned_at or datetime.utcnow().isoformat()
+    count = 0
+    with conn:
+        for result in results:
+            if 'error' in result:
+                continue
+            tenant = result.get('tenant') or ''
+            vrf = result.get('vrf') or ''
+            run_id = conn.execute(
+                "INSERT INTO runs (scanned_at, source, tenant, vrf, file, host_count) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (scanned_at, result['source'], tenant, vrf, result.get('file'),
+                 result.get('discovered_count', len(result['hosts']))),
+            ).lastrowid
+
+            sightings = []
+            for host in result['hosts']:
+                mac = normalize_mac(host.get('mac'))
+                addresses = host.get('addresses') or ([host['ip']] if host.get('ip') else [''])
+                for ip in addresses:
+                    sightings.append((run_id, ip, mac, host.get('hostname'), host.get('vendor')))
+
+            conn.executemany(
+                "INSERT INTO sightings (run_id, ip, mac, hostname, vendor) VALUES (?, ?, ?, ?, ?)",
+                sightings,
+            )
+            conn.executemany(
+                "INSERT INTO hosts (tenant, vrf, ip, mac, hostname, vendor, source, first_seen, "
+                "last_seen, first_run_id, last_run_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (tenant, vrf, ip, mac) DO UPDATE SET "
+                "hostname = COALESCE(excluded.hostname, hostname), "
+                "vendor = COALESCE(excluded.vendor, vendor), "
+                "source = excluded.source, last_seen = excluded.last_seen, "
+                "last_run_id = excluded.last_run_id",
+                [(tenant, vrf, ip, mac, hostname, vendor, result['source'], scanned_at,
+                  scanned_at, run_id, run_id)
+                 for run_id, ip, mac, hostname, vendor in sightings],
+            )
+            count += 1
+    logger.info(f"Recorded {count} runs at {scanned_at}")
+    return count
+
+
+def seen(conn: sqlite3.Connection, mac: Optional[str] = None, ip: Optional[str] = None,
+         tenant: Optional[str] = None, vrf: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    First/last seen for a MAC and/or IP.
+    """
+    where, params = [], []
+    if mac:
+        where.append("mac = ?")
+        params.append(normalize_mac(mac))
+    if ip:
+        where.append("ip = ?")
+        params.append(ip)
+    if tenant is not None:
+        where.append("tenant = ?")
+        params.append(tenant)
+    if vrf is not None:
+        where.append("vrf = ?")
+        params.append(vrf)
+    sql = "SELECT * FROM hosts"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    return rows(conn.execute(sql + " ORDER BY last_seen DESC", params))
+
+
+def stale(conn: sqlite3.Connection, days: float, tenant: Optional[str] = None,
+          now: Optional[datetime] = None) -> List[Dict[str, Any]]:
+    """
+    Hosts not seen for more than days.
+    """
+    cutoff = ((now or datetime.utcnow()) - timedelta(days=days)).isoformat()
+    sql = "SELECT * FROM hosts WHERE last_seen < ?"
+    params: List[Any] = [cutoff]
+    if tenant is not None:
+        sql += " AND tenant = ?"
+        params.append(tenant)
+    return rows(conn.execute(sql + " ORDER BY last_seen", params))
+
+
+def churn(conn: sqlite3.Connection, since: str, tenant: Optional[str] = None,
+          vrf: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Per tenant/VRF: hosts first seen since a time, and hosts that have
+    gone (last seen since then, but missing from the latest run of the
+    source that saw them).
+    """
+    where, params = ["1 = 1"], []
+    if tenant is not None:
+        where.append("h.tenant = ?")
+        params.append(tenant)
+    if vrf is not None:
+        where.append("h.vrf = ?")
+        params.append(vrf)
+    sql = f"""
+        WITH latest AS (
+            SELECT source, MAX(scanned_at) AS scanned_at FROM runs GROUP BY source
+        )
+        SELECT h.tenant, h.vrf,
+               COUNT(*) AS known,
+               SUM(h.first_seen >= ?) AS new,
+               SUM(h.last_seen >= ? AND h.last_seen < l.scanned_at) AS gone,
+               SUM(h.last_seen = l.scanned_at) AS current
+        FROM hosts h JOIN latest l ON l.source = h.source
+        WHERE {' AND '.join(where)}
+        GROUP BY h.tenant, h.vrf
+        ORDER BY h.tenant, h.vrf
+    """
+    return rows(conn.execute(sql, [since, since] + params))
+
+
+def diff(conn: sqlite3.Connection, old_run: int, new_run: int) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Compare two runs: addresses added, removed, or with a different MAC
+    or hostname.
+    """
+    def snapshot(run_id: int) -> Dict[str, Dict[str, Any]]:
+        return {row['ip']: dict(row) for row in conn.execute(
+            "SELECT ip, mac, hostname, vendor FROM sightings WHERE run_id = ?", (run_id,))}
+
+    old, new = snapshot(old_run), snapshot(new_run)
+    return {
+        'added': [new[ip] for ip in sorted(new.keys() - old.keys())],
+        'removed': [old[ip] for ip in sorted(old.keys() - new.keys())],
+        'changed': [
+            {'ip': ip, 'old': old[ip], 'new': new[ip]}
+            for ip in sorted(old.keys() & new.keys())
+            if (old[ip]['mac'], old[ip]['hostname']) != (new[ip]['mac'], new[ip]['hostname'])
+        ],
+    }
+
+
+def last_runs(conn: sqlite3.Connection, source: str, count: int = 2) -> List[int]:
+    """
+    IDs of the latest runs of a source, oldest first.
+    """
+    ids = [row[0] for row in conn.execute(
+        "SELECT id FROM runs WHERE source = ? ORDER BY id DESC LIMIT ?", (source, count))]
+    return ids[::-1]
+
+
+def main():
+    """
+    Main execution flow.
+    """
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+
+    parser = argparse.ArgumentParser(description="Query the discovery scan history")
+    parser.add_argument('--db', required=True, help="History database")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    cmd = commands.add_parser('record', help="Record parse_nmap.py output (--format hosts)")
+    cmd.add_argument('input', nargs='?', default='-')
+
+    cmd = commands.add_parser('seen', help="First/last seen of a MAC or IP")
+    cmd.add_argument('--mac')
+    cmd.add_argument('--ip')
+    cmd.add_argument('--tenant')
+    cmd.add_argument('--vrf')
+
+    cmd = commands.add_parser('stale', help="Hosts not seen for N days")
+    cmd.add_argument('--days', type=float, required=True)
+    cmd.add_argument('--tenant')
+
+    cmd = commands.add_parser('churn', help="New and gone hosts per tenant/VRF")
+    cmd.add_argument('--since', required=True, help="ISO date or time")
+    cmd.add_argument('--tenant')
+    cmd.add_argument('--vrf')
+
+    cmd = commands.add_parser('diff', help="Compare two runs")
+    cmd.add_argument('--source', help="Compare the last two runs of this source")
+    cmd.add_argument('--runs', nargs=2, type=int, metavar=('OLD', 'NEW'))
+
+    args = parser.parse_args()
+    conn = connect(args.db)
+
+    if args.command == 'record':
+        if args.input == '-':
+            discovery = json.load(sys.stdin)
+        else:
+            with open(args.input) as f:
+                discovery = json.load(f)
+        result = {'runs': record_results(conn, discovery.get('sources', []),
+                                         discovery.get('scan_timestamp'))}
+    elif args.command == 'seen':
+        if not args.mac and not args.ip:
+            parser.error("seen needs --mac or --ip")
+        result = seen(conn, args.mac, args.ip, args.tenant, args.vrf)
+    elif args.command == 'stale':
+        result = stale(conn, args.days, args.tenant)
+    elif args.command == 'churn':
+        result = churn(conn, args.since, args.tenant, args.vrf)
+    else:
+        if args.runs:
+            old_run, new_run = args.runs
+        elif args.source:
+            runs = last_runs(conn, args.source)
+            if len(runs) < 2:
+                parser.error(f"fewer than two runs recorded for {args.source}")
+            old_run, new_run = runs
+        else:
+            parser.error("diff needs --source or --runs")
+        result = dict(diff(conn, old_run, new_run), old_run=old_run, new_run=new_run)
+
+    json.dump(result, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+import gatekeeper
+
+LAUNCH_URL = "http://awx.test/api/v2/job_templates/7/launch/"
+
+
+def run_queue(handler, submissions, workers=1):
+    """
+    Submit registrations to a queue backed by handler; return the futures'
+    outcomes and whether the workers are still running.
+    """
+    async def main():
+        queue = gatekeeper.RegistrationQueue(LAUNCH_URL, "token", workers=workers, attempts=1,
+                                             transport=httpx.MockTransport(handler))
+        await queue.start()
+        try:
+            futures = [queue.submit(mac, {"mac": mac})[1] for mac in submissions]
+            done = await asyncio.wait_for(asyncio.gather(*futures, return_exceptions=True), 5)
+            alive = all(not task.done() for task in queue._tasks)
+            return done, alive, len(queue)
+        finally:
+            await queue.close()
+
+    return asyncio.run(main())
+
+
+def test_worker_survives_failed_launch():
+    def handler(request):
+        mac = json.loads(request.content)["extra_vars"]["mac"]
+        if mac == "aa:00:00:00:00:01":
+            raise RuntimeError("launch blew up")
+        if mac == "aa:00:00:00:00:02":
+            return httpx.Response(201, text="<html>not json</html>")
+        return httpx.Response(201, json={"job": 42})
+
+    done, alive, pending = run_queue(handler, ["aa:00:00:00:00:01", "aa:00:00:00:00:02",
+                                               "aa:00:00:00:00:03"])
+
+    assert isinstance(done[0], RuntimeError)
+    assert done[1] is None
+    assert done[2] == 42
+    assert alive
+    assert pending == 0
+
+
+def test_exhausted_retries_fail_the_future():
+    def handler(request):
+        return httpx.Response(502)
+
+    done, alive, pending = run_queue(handler, ["aa:00:00:00:00:01"])
+
+    assert isinstance(done[0], httpx.HTTPStatusError)
+    assert alive
+    assert pending == 0
+
+
+def test_update_before_launch_shares_the_job():
+    async def main():
+        launches = []
+
+        def handler(request):
+            launches.append(json.loads(request.content)["extra_vars"])
+            return httpx.Response(201, json={"job": len(launches)})
+
+        queue = gatekeeper.RegistrationQueue(LAUNCH_URL, None, workers=1,
+                                             transport=httpx.MockTransport(handler))
+        await queue.start()
+        try:
+            first, future = queue.submit("aa:00:00:00:00:01", {"v": 1})
+            second, same = queue.submit("aa:00:00:00:00:01", {"v": 2})
+            assert (first, second) == ("queued", "updated")
+            assert same is future
+            assert await asyncio.wait_for(future, 5) == 1
+            return launches
+        finally:
+            await queue.close()
+
+    assert asyncio.run(main()) == [{"v": 2}]
+
+
+def test_restart_replays_pending_registrations(tmp_path):
+    db = str(tmp_path / "registrations.db")
+
+    async def main():
+        def down(request):
+            return httpx.Response(502)
+
+        queue = gatekeeper.RegistrationQueue(LAUNCH_URL, None, workers=0,
+                                             store=gatekeeper.RegistrationStore(db),
+                                             transport=httpx.MockTransport(down))
+        await queue.start()
+        queue.submit("aa:00:00:00:00:01", {"mac": "aa:00:00:00:00:01"})
+        await queue.close()
+
+        def up(request):
+            return httpx.Response(201, json={"job": 7})
+
+        queue = gatekeeper.RegistrationQueue(LAUNCH_URL, None, workers=1,
+                                             store=gatekeeper.RegistrationStore(db),
+                                             transport=httpx.MockTransport(up))
+        await queue.start()
+        try:
+            assert len(queue) == 1
+            await asyncio.wait_for(queue.pending["aa:00:00:00:00:01"]["future"], 5)
+            return queue.store.get("aa:00:00:00:00:01")
+        finally:
+            await queue.close()
+
+    row = asyncio.run(main())
+    assert (row["status"], row["job"]) == ("launched", 7)
+
+
+def test_status_follows_the_awx_job():
+    async def main():
+        def handler(request):
+            if request.method == "POST":
+                return httpx.Response(201, json={"job": 9})
+            assert request.url.path == "/api/v2/jobs/9/"
+            return httpx.Response(200, json={"status": "failed"})
+
+        queue = gatekeeper.RegistrationQueue(LAUNCH_URL, None, workers=1,
+                                             jobs_url="http://awx.test/api/v2/jobs/",
+                                             transport=httpx.MockTransport(handler))
+        await queue.start()
+        try:
+            _, future = queue.submit("aa:00:00:00:00:01", {"mac": "aa:00:00:00:00:01"})
+            await asyncio.wait_for(future, 5)
+            return await queue.status("aa:00:00:00:00:01"), await queue.status("aa:00:00:00:00:02")
+        finally:
+            await queue.close()
+
+    row, unknown = asyncio.run(main())
+    assert (row["status"], row["job"]) == ("failed", 9)
+    assert unknown is None
+
+
+def test_register_requires_the_host_config_key(monkeypatch):
+    monkeypatch.setattr(gatekeeper, "REGISTRATION_KEY", "secret")
+    request = gatekeeper.RegisterRequest(
+        mac="aa:00:00:00:00:01", tenant_name="T", tenant_slug="t", site_name="S",
+        site_slug="s", public_key="ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIE probe", hostname="probe")
+
+    for key in (None, "wrong"):
+        with pytest.raises(HTTPException) as raised:
+            asyncio.run(gatekeeper.register(request, x_host_config_key=key))
+        assert raised.value.status_code == 403
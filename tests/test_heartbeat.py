@@ -0,0 +1,106 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+import heartbeat
+
+
+@pytest.mark.parametrize('argv', [
+    ['--state', 's.db', 'sweep', '--host', '10.9.9.9', '--timeout', '5'],
+    ['--state', 's.db', '--host', '10.9.9.9', '--timeout', '5'],
+    ['--host', '10.9.9.9', '--timeout', '5', '--state', 's.db'],
+])
+def test_sweep_options_are_kept(argv):
+    args = heartbeat.parse_args(argv)
+    assert (args.command, args.state, args.host, args.timeout) == ('sweep', 's.db', '10.9.9.9', 5.0)
+
+
+def test_sweep_option_before_subcommand_is_rejected():
+    with pytest.raises(SystemExit):
+        heartbeat.parse_args(['--host', '10.9.9.9', 'sweep'])
+
+
+def test_sweep_requires_host(monkeypatch):
+    monkeypatch.setattr(heartbeat, 'HEARTBEAT_HOST', None)
+    with pytest.raises(SystemExit):
+        heartbeat.parse_args(['sweep'])
+    assert heartbeat.parse_args(['stale', '--days', '3']).days == 3
+
+
+class FakeNetBox:
+    """
+    In-memory dcim/devices endpoint: GET lists, bulk PATCH updates status.
+    """
+
+    def __init__(self, devices):
+        self.devices = {device['id']: device for device in devices}
+        self.patches = []
+
+    def handler(self, request):
+        if request.method == 'GET':
+            results = list(self.devices.values())
+            return httpx.Response(200, json={'count': len(results), 'next': None, 'results': results})
+        body = json.loads(request.content)
+        self.patches.append(body)
+        updated = []
+        for change in body:
+            device = self.devices[change['id']]
+            device['status'] = {'value': change['status'], 'label': change['status'].title()}
+            updated.append(device)
+        return httpx.Response(200, json=updated)
+
+
+def device(device_id, name, port, status):
+    return {'id': device_id, 'name': name, 'status': {'value': status},
+            'custom_fields': {heartbeat.CUSTOM_FIELD_NAME: port}}
+
+
+def sweep_once(monkeypatch, netbox, state, up_ports):
+    async def check_port(host, port, timeout):
+        return (True, 1.0, 2.0) if port in up_ports else (False, None, None)
+
+    monkeypatch.setattr(heartbeat, 'check_port', check_port)
+    monkeypatch.setattr(heartbeat.netbox_sync, 'NETBOX_URL', 'http://netbox.test')
+    args = heartbeat.parse_args(['--state', state, 'sweep', '--host', '127.0.0.1',
+                                 '--offline-after', '1', '--decommission-after', '3'])
+    return asyncio.run(heartbeat.run(args, httpx.MockTransport(netbox.handler)))
+
+
+def statuses(netbox):
+    return {d['name']: d['status']['value'] for d in netbox.devices.values()}
+
+
+def test_heartbeat_decommissioning_is_restored_when_probe_returns(monkeypatch, tmp_path):
+    netbox = FakeNetBox([
+        device(1, 'probe-a', 10001, 'active'),
+        # Decommissioning set by an operator: never touched
+        device(2, 'probe-b', 10002, 'decommissioning'),
+    ])
+    state = str(tmp_path / 'heartbeat.db')
+
+    sweep_once(monkeypatch, netbox, state, up_ports=set())
+    assert statuses(netbox) == {'probe-a': 'offline', 'probe-b': 'decommissioning'}
+    sweep_once(monkeypatch, netbox, state, up_ports=set())
+    sweep_once(monkeypatch, netbox, state, up_ports=set())
+    assert statuses(netbox) == {'probe-a': 'decommissioning', 'probe-b': 'decommissioning'}
+
+    report = sweep_once(monkeypatch, netbox, state, up_ports={10001, 10002})
+    assert statuses(netbox) == {'probe-a': 'active', 'probe-b': 'decommissioning'}
+    assert report['changes'] == [{'name': 'probe-a', 'status': 'active'}]
+
+
+def test_operator_status_change_clears_heartbeat_ownership(monkeypatch, tmp_path):
+    netbox = FakeNetBox([device(1, 'probe-a', 10001, 'active')])
+    state = str(tmp_path / 'heartbeat.db')
+    for _ in range(3):
+        sweep_once(monkeypatch, netbox, state, up_ports=set())
+    assert statuses(netbox) == {'probe-a': 'decommissioning'}
+
+    # Operator takes over (planned), then sets decommissioning by hand
+    netbox.devices[1]['status'] = {'value': 'planned'}
+    sweep_once(monkeypatch, netbox, state, up_ports=set())
+    netbox.devices[1]['status'] = {'value': 'decommissioning'}
+    sweep_once(monkeypatch, netbox, state, up_ports={10001})
+    assert statuses(netbox) == {'probe-a': 'decommissioning'}
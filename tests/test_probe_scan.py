@@ -0,0 +1,70 @@
+import io
+import threading
+import time
+
+import pytest
+
+import probe_scan
+
+CHUNK_XML = """<?xml version="1.0"?>
+<nmaprun args="nmap -sn">
+<host><status state="up"/><address addr="{ip}" addrtype="ipv4"/><times srtt="1000" rttvar="500" to="100000"/></host>
+<runstats><hosts up="1" down="0" total="1"/></runstats>
+</nmaprun>
+"""
+
+
+class FakeNmap:
+    """
+    Stand-in for subprocess.run that tracks the summed --max-rate of the
+    nmap processes running at the same time.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = 0
+        self.peak = 0
+        self.calls = 0
+
+    def __call__(self, cmd, **kwargs):
+        rate = int(cmd[cmd.index('--max-rate') + 1])
+        assert int(cmd[cmd.index('--min-rate') + 1]) <= rate
+        with self.lock:
+            self.calls += 1
+            self.active += rate
+            self.peak = max(self.peak, self.active)
+        time.sleep(0.005)
+        target = cmd[-1]
+        with open(cmd[cmd.index('-oX') + 1], 'w') as f:
+            f.write(CHUNK_XML.format(ip=target.split('/')[0]))
+        with self.lock:
+            self.active -= rate
+
+        class Result:
+            returncode = 0
+            stderr = ''
+        return Result()
+
+
+@pytest.mark.parametrize('max_rate,workers', [
+    (300, None), (300, 8), (1000, 4), (50, 8), (25, 16), (5, 4), (10, 1),
+])
+def test_concurrent_max_rates_within_budget(monkeypatch, max_rate, workers):
+    fake = FakeNmap()
+    monkeypatch.setattr(probe_scan.subprocess, 'run', fake)
+
+    totals = probe_scan.run_scan(['10.0.0.0/18'], io.StringIO(), workers=workers,
+                                 max_rate=max_rate)
+
+    assert fake.calls == 64
+    assert totals['failed_chunks'] == 0
+    assert 0 < fake.peak <= max_rate
+
+
+def test_worker_count_keeps_min_rate_share():
+    assert probe_scan.worker_count(8, 64, 50) == 50 // probe_scan.MIN_RATE
+    assert probe_scan.worker_count(8, 64, 5) == 1
+    assert probe_scan.worker_count(4, 2, 1000) == 2
+    controller = probe_scan.RateController(50, probe_scan.worker_count(8, 64, 50))
+    assert controller.cap * probe_scan.worker_count(8, 64, 50) <= 50
+    assert controller.floor <= controller.rate <= controller.cap